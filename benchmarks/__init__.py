@@ -0,0 +1,8 @@
+"""
+Load-test and micro-benchmarks for the CTS REST views, run against
+stub cts_calcs calculators and MongoDBHandler (see stubs.py).
+
+Usage (from the directory that contains cts_app):
+
+	python -m cts_app.cts_api.benchmarks.run --help
+"""
@@ -0,0 +1,340 @@
+"""
+Runs the CTS REST benchmark scenarios through the Django test client
+against the stubs, and compares them to a stored baseline.
+
+	python -m cts_app.cts_api.benchmarks.run
+	python -m cts_app.cts_api.benchmarks.run --scenarios run_epi,metabolizer_gen4 --latency 50
+	python -m cts_app.cts_api.benchmarks.run --save-baseline
+
+Each scenario is run --repeats times and the medians are kept. Exits
+with status 1 if a scenario's p50, throughput, memory, or errors
+regressed past the tolerance (p99s are reported, but too noisy to gate on).
+With --scenarios, --save-baseline only replaces those scenarios' entries.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from . import stubs
+
+
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+chemical_ids = itertools.count()
+
+
+
+class Scenario(object):
+	"""
+	A request to benchmark. body is a dict, or a function of
+	a chemical for requests that should vary per request.
+	"""
+	def __init__(self, name, method, url, body=None):
+		self.name = name
+		self.method = method
+		self.url = url
+		self.body = body
+
+	def get_body(self, warm):
+		if not callable(self.body):
+			return self.body
+		chemical = "CCO" if warm else "C{}CO".format(next(chemical_ids))
+		return self.body(chemical)
+
+
+
+def pchem_scenario(calc, prop, **inputs):
+	return Scenario(
+		'run_{}'.format(calc), 'post', '/{}/run'.format(calc),
+		lambda chemical: dict(inputs, chemical=chemical, calc=calc, prop=prop)
+	)
+
+
+def metabolizer_scenario(gen_limit):
+	return Scenario(
+		'metabolizer_gen{}'.format(gen_limit), 'post', '/metabolizer/run',
+		lambda chemical: {'structure': chemical, 'calc': 'metabolizer', 'generationLimit': gen_limit}
+	)
+
+
+scenarios = [
+	pchem_scenario('chemaxon', 'water_sol'),
+	pchem_scenario('epi', 'kow_no_ph'),
+	pchem_scenario('testws', 'water_sol'),
+	pchem_scenario('sparc', 'water_sol'),
+	pchem_scenario('measured', 'koc'),
+	pchem_scenario('opera', 'kow_wph', ph=7.0),
+	pchem_scenario('biotrans', 'biodeg'),
+	pchem_scenario('envipath', 'biodeg'),
+	Scenario('run_speciation', 'post', '/speciation/run', lambda chemical: {
+		'chemical': chemical, 'calc': 'speciation', 'run_type': 'speciation',
+		'pKa_decimals': 2, 'pKa_pH_lower': 0, 'pKa_pH_upper': 14, 'pKa_pH_increment': 0.2,
+	}),
+	metabolizer_scenario(1),
+	metabolizer_scenario(2),
+	metabolizer_scenario(3),
+	metabolizer_scenario(4),
+	Scenario('molecule', 'post', '/molecule', lambda chemical: {'chemical': chemical}),
+	Scenario('molecule_structure', 'post', '/molecule', lambda chemical: {'chemical': chemical, 'get_structure_data': True}),
+	Scenario('swagger', 'get', '/swag'),
+	Scenario('swagger_v2', 'get', '/v2/swag/'),
+	Scenario('metadata_cts', 'get', '/cts'),
+	Scenario('metadata_calc', 'get', '/chemaxon'),
+	Scenario('metadata_inputs', 'post', '/chemaxon/inputs', {'chemical': "CCO", 'prop': 'water_sol'}),
+]
+
+
+
+def setup_django():
+	"""
+	Configures minimal settings for the cts_api urls, unless
+	DJANGO_SETTINGS_MODULE is set.
+	"""
+	import django
+	from django.conf import settings
+	if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+		settings.configure(
+			DEBUG=False,
+			SECRET_KEY='cts-benchmarks',
+			ALLOWED_HOSTS=['testserver'],
+			INSTALLED_APPS=['cts_app.cts_api'],
+			ROOT_URLCONF='cts_app.cts_api.urls',
+			MIDDLEWARE=[],
+			TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}],
+		)
+	django.setup()
+
+
+def send_request(client, scenario, warm):
+	"""
+	Returns (seconds, is_error) for one request.
+	"""
+	body = scenario.get_body(warm)
+	start = time.perf_counter()
+	if scenario.method == 'get':
+		response = client.get(scenario.url)
+	else:
+		response = client.post(scenario.url, json.dumps(body), content_type='application/json')
+	content = b''.join(response) if response.streaming else response.content
+	elapsed = time.perf_counter() - start
+	return elapsed, is_error_response(response.status_code, content)
+
+
+def is_error_response(status_code, content):
+	"""
+	CTS REST returns most errors as JSON with an 'error' key
+	(or status False) and a 200 status.
+	"""
+	if status_code >= 400:
+		return True
+	try:
+		response_obj = json.loads(content)
+	except ValueError:
+		return not content.lstrip().startswith(b'{')
+	if not isinstance(response_obj, dict):
+		return False
+	data = response_obj.get('data')
+	return 'error' in response_obj or response_obj.get('status') is False or (isinstance(data, dict) and 'error' in data)
+
+
+def run_scenario(scenario, num_requests, concurrency, warm):
+	"""
+	Sends num_requests requests, concurrency at a time.
+	"""
+	from django.test import Client
+	clients = threading.local()
+
+	def timed_request(_):
+		if not hasattr(clients, 'client'):
+			clients.client = Client()
+		return send_request(clients.client, scenario, warm)
+
+	send_request(Client(), scenario, warm)  # warm up imports and prepared responses
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		results = list(executor.map(timed_request, range(num_requests)))
+	elapsed = time.perf_counter() - start
+
+	latencies = sorted(seconds for seconds, _ in results)
+	return {
+		'requests': num_requests,
+		'errors': sum(1 for _, is_error in results if is_error),
+		'throughput': round(num_requests / elapsed, 2),
+		'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+		'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+	}
+
+
+def run_repeated(scenario, num_requests, concurrency, warm, repeats):
+	"""
+	Median of each run_scenario() measure over repeats runs.
+	"""
+	runs = [run_scenario(scenario, num_requests, concurrency, warm) for _ in range(max(repeats, 1))]
+	result = runs[0].copy()
+	for key in ('errors', 'throughput', 'p50_ms', 'p99_ms'):
+		result[key] = statistics.median(run[key] for run in runs)
+	return result
+
+
+def measure_memory(scenario, num_requests, warm):
+	"""
+	Peak traced memory (KB) for num_requests sequential requests.
+	"""
+	from django.test import Client
+	client = Client()
+	tracemalloc.start()
+	try:
+		for _ in range(num_requests):
+			send_request(client, scenario, warm)
+		_, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return round(peak / 1024.0, 1)
+
+
+def percentile(sorted_values, percent):
+	"""
+	Nearest-rank percentile.
+	"""
+	if not sorted_values:
+		return 0.0
+	rank = max(int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+	return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def compare(results, baseline, tolerance, min_delta_ms=5):
+	"""
+	Returns {scenario: [regression descriptions]} for results that are
+	worse than baseline by more than tolerance (a fraction). p50s also
+	have to be min_delta_ms worse, as a few ms of thread scheduling and
+	GC are more than the tolerance for fast requests. p99s aren't compared,
+	they vary by 2x between identical runs (one slow request in 100).
+	Only errors are compared for scenarios that had errors in baseline.
+	"""
+	regressions = {}
+	for name, result in results.items():
+		base = baseline.get(name)
+		if not base:
+			continue
+		problems = []
+		if result['errors'] > base.get('errors', 0):
+			problems.append("errors {} > {}".format(result['errors'], base.get('errors', 0)))
+			regressions[name] = problems
+		if base.get('errors'):
+			continue  # error responses' timings aren't comparable to results'
+		for key in ('p50_ms', 'peak_kb'):
+			if not key in result or not base.get(key):
+				continue
+			min_delta = min_delta_ms if key.endswith('_ms') else 0
+			if result[key] > base[key] * (1 + tolerance) and result[key] - base[key] > min_delta:
+				problems.append("{} {} > {}".format(key, result[key], base[key]))
+		if base.get('throughput') and result['throughput'] < base['throughput'] * (1 - tolerance):
+			problems.append("throughput {} < {}".format(result['throughput'], base['throughput']))
+		if problems:
+			regressions[name] = problems
+	return regressions
+
+
+def print_results(results, baseline):
+	columns = ('requests', 'errors', 'throughput', 'p50_ms', 'p99_ms', 'peak_kb')
+	print("{:<20}".format('scenario') + ''.join("{:>12}".format(column) for column in columns))
+	for name, result in results.items():
+		row = "{:<20}".format(name) + ''.join("{:>12}".format(result.get(column, '-')) for column in columns)
+		base = baseline.get(name)
+		if base and base.get('p50_ms'):
+			row += "   p50 {:+.0%}".format(result['p50_ms'] / base['p50_ms'] - 1)
+		print(row)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="CTS REST benchmarks against stub calculators.")
+	parser.add_argument('--scenarios', help="comma-separated scenario names (default: all)")
+	parser.add_argument('--requests', type=int, default=200, help="requests per scenario")
+	parser.add_argument('--concurrency', type=int, default=8)
+	parser.add_argument('--repeats', type=int, default=3, help="runs per scenario, medians are kept")
+	parser.add_argument('--memory-requests', type=int, default=20, help="requests per scenario for memory (0 to skip)")
+	parser.add_argument('--latency', type=float, default=10, help="stub latency, ms")
+	parser.add_argument('--jitter', type=float, default=0, help="extra random stub latency, up to ms")
+	parser.add_argument('--failure-rate', type=float, default=0, help="fraction of stub calls that fail")
+	parser.add_argument('--no-mongo', action='store_true', help="stub MongoDB is unavailable")
+	parser.add_argument('--warm', action='store_true', help="same chemical for every request (cached path)")
+	parser.add_argument('--baseline', default=baseline_path)
+	parser.add_argument('--save-baseline', action='store_true')
+	parser.add_argument('--tolerance', type=float, default=0.25, help="allowed regression, as a fraction")
+	parser.add_argument('--min-delta-ms', type=float, default=5, help="ignore p50 regressions smaller than this")
+	parser.add_argument('--output', help="write results JSON to this path")
+	parser.add_argument('--list', action='store_true', help="list scenario names")
+	args = parser.parse_args(argv)
+
+	if args.list:
+		print("\n".join(scenario.name for scenario in scenarios))
+		return 0
+
+	logging.basicConfig(level=logging.ERROR)
+	stub_config = stubs.install(stubs.StubConfig(
+		latency=args.latency / 1000.0,
+		jitter=args.jitter / 1000.0,
+		failure_rate=args.failure_rate,
+		mongo=not args.no_mongo,
+	))
+	setup_django()
+
+	selected = scenarios
+	if args.scenarios:
+		names = args.scenarios.split(',')
+		selected = [scenario for scenario in scenarios if scenario.name in names]
+
+	results = {}
+	for scenario in selected:
+		results[scenario.name] = run_repeated(scenario, args.requests, args.concurrency, args.warm, args.repeats)
+		if args.memory_requests:
+			results[scenario.name]['peak_kb'] = measure_memory(scenario, args.memory_requests, args.warm)
+
+	run_info = {
+		'config': dict(stub_config.to_dict(), requests=args.requests, concurrency=args.concurrency, warm=args.warm),
+		'python': sys.version.split()[0],
+		'results': results,
+	}
+	baseline = {}
+	baseline_info = None
+	if os.path.exists(args.baseline):
+		with open(args.baseline, 'r') as baseline_file:
+			baseline_info = json.load(baseline_file)
+		if baseline_info.get('config') != run_info['config']:
+			print("Baseline was run with a different config: {}".format(baseline_info.get('config')))
+			baseline_info = None
+		elif not args.save_baseline:
+			baseline = baseline_info.get('results', {})
+
+	print_results(results, baseline)
+
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			json.dump(run_info, output_file, indent=2)
+	if args.save_baseline:
+		if args.scenarios and baseline_info is not None:
+			# keeps the other scenarios' entries:
+			run_info['results'] = dict(baseline_info.get('results', {}), **results)
+		with open(args.baseline, 'w') as baseline_file:
+			json.dump(run_info, baseline_file, indent=2)
+		print("Saved baseline to {}".format(args.baseline))
+		return 0
+
+	regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+	for name, problems in regressions.items():
+		print("REGRESSION {}: {}".format(name, ", ".join(problems)))
+	return 1 if regressions else 0
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,435 @@
+"""
+Stub cts_calcs calculators, ChemInfo, SMILESFilter, and MongoDBHandler
+for benchmarking the CTS REST views without the calculator servers or
+MongoDB. Each stub call waits for a configurable latency and can fail
+at a configurable rate.
+
+install() has to run before cts_rest is imported, as it replaces the
+cts_calcs modules in sys.modules.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+import types
+import zlib
+
+
+
+class StubConfig(object):
+	"""
+	Latency and failure injection settings shared by all stubs.
+	Each call waits latency seconds, plus up to jitter seconds,
+	and raises StubFailure with probability failure_rate.
+	"""
+	def __init__(self, latency=0.01, jitter=0.0, failure_rate=0.0, mongo=True,
+			metabolizer_branching=2, structure_data_size=20000, seed=1):
+		self.latency = latency
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		self.mongo = mongo  # False for no MongoDB (OPERA runs the model)
+		self.metabolizer_branching = metabolizer_branching  # products per metabolizer node
+		self.structure_data_size = structure_data_size  # bytes of <cml> structureData
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.calls = {}  # stub name: number of calls
+
+	def to_dict(self):
+		return {
+			'latency': self.latency,
+			'jitter': self.jitter,
+			'failure_rate': self.failure_rate,
+			'mongo': self.mongo,
+			'metabolizer_branching': self.metabolizer_branching,
+			'structure_data_size': self.structure_data_size,
+		}
+
+
+
+class StubFailure(ConnectionError):
+	"""
+	Injected calculator/DB failure.
+	"""
+
+
+
+config = StubConfig()
+
+
+
+def stub_call(name):
+	"""
+	Counts a call to a stub, waits for its latency, and
+	raises StubFailure for injected failures.
+	"""
+	with config.lock:
+		config.calls[name] = config.calls.get(name, 0) + 1
+		delay = config.latency + (config.random.uniform(0, config.jitter) if config.jitter else 0)
+		failed = config.failure_rate > 0 and config.random.random() < config.failure_rate
+	if delay > 0:
+		time.sleep(delay)
+	if failed:
+		raise StubFailure("injected {} failure".format(name))
+
+
+def meta_info(model):
+	return {
+		'metaInfo': {
+			'model': model,
+			'collection': "qed",
+			'modelVersion': "stub",
+			'description': "Stub {} calculator for benchmarks.".format(model),
+			'status': '',
+			'timestamp': '',
+			'url': {'type': "application/json", 'href': "http://localhost/cts/rest/{}".format(model)},
+		}
+	}
+
+
+
+class StubCalc(object):
+	"""
+	Calculator returning a p-chem value for the requested prop.
+	"""
+	name = 'calc'
+
+	def __init__(self):
+		self.meta_info = meta_info(self.name)
+
+	def data_request_handler(self, request_dict):
+		stub_call(self.name)
+		return {
+			'valid': True,
+			'calc': self.name,
+			'prop': request_dict.get('prop'),
+			'chemical': request_dict.get('chemical'),
+			'data': 1.23,
+		}
+
+	def convert_units_for_cts(self, prop, data):
+		return data
+
+
+
+class JchemCalc(StubCalc):
+	name = 'chemaxon'
+
+	def data_request_handler(self, request_dict):
+		if request_dict.get('run_type') != 'speciation' and request_dict.get('calc') != 'speciation':
+			return super(JchemCalc, self).data_request_handler(request_dict)
+		stub_call('speciation')
+		lower = float(request_dict.get('pKa_pH_lower', 0))
+		upper = float(request_dict.get('pKa_pH_upper', 14))
+		increment = float(request_dict.get('pKa_pH_increment', 0.2))
+		phs = [round(lower + index * increment, 4) for index in range(int(round((upper - lower) / increment)) + 1)]
+		acid_percents = [100.0 / (1 + 10 ** (4.2 - ph)) for ph in phs]
+		return {
+			'calc': self.name,
+			'chemical': request_dict.get('chemical'),
+			'data': {
+				'pka': {
+					'mostBasicPka': [9.1],
+					'mostAcidicPka': [4.2],
+					'microDistData': {
+						'microspecies1': [[ph, 100.0 - percent] for ph, percent in zip(phs, acid_percents)],
+						'microspecies2': [[ph, percent] for ph, percent in zip(phs, acid_percents)],
+					},
+				},
+				'isoelectricPoint': 6.6,
+				'majorMicrospecies': {'smiles': request_dict.get('chemical')},
+			},
+		}
+
+
+
+class EpiCalc(StubCalc):
+	"""
+	EPI Suite returns every prop in one response, water solubility
+	with two methods.
+	"""
+	name = 'epi'
+	propMap = {
+		'melting_point': {'result_key': 'melting_point'},
+		'boiling_point': {'result_key': 'boiling_point'},
+		'water_sol': {'result_key': 'water_solubility', 'methods': {'WSKOW': 'WSKOW', 'WATERNT': 'WATERNT'}},
+		'vapor_press': {'result_key': 'vapor_pressure'},
+		'henrys_law_con': {'result_key': 'henrys_law_constant'},
+		'kow_no_ph': {'result_key': 'log_kow'},
+		'koc': {'result_key': 'log_koc'},
+	}
+
+	def data_request_handler(self, request_dict):
+		stub_call(self.name)
+		data = []
+		for prop_map in self.propMap.values():
+			for method in prop_map.get('methods', [None]):
+				data_obj = {'prop': prop_map['result_key'], 'data': 1.23}
+				if method:
+					data_obj['method'] = method
+				data.append(data_obj)
+		return {'valid': True, 'calc': self.name, 'prop': request_dict.get('prop'), 'chemical': request_dict.get('chemical'), 'data': data}
+
+
+
+class MeasuredCalc(StubCalc):
+	name = 'measured'
+	propMap = {prop: {'result_key': prop_map['result_key']} for prop, prop_map in EpiCalc.propMap.items()}
+
+	def data_request_handler(self, request_dict):
+		stub_call(self.name)
+		data = [{'prop': prop_map['result_key'], 'data': 1.23} for prop_map in self.propMap.values()]
+		return {'valid': True, 'calc': self.name, 'prop': request_dict.get('prop'), 'chemical': request_dict.get('chemical'), 'data': data}
+
+
+
+class TestWSCalc(StubCalc):
+	name = 'testws'
+
+
+
+class SparcCalc(StubCalc):
+	name = 'sparc'
+
+
+
+class BiotransCalc(StubCalc):
+	name = 'biotrans'
+
+
+
+class EnvipathCalc(StubCalc):
+	name = 'envipath'
+
+
+
+class OperaCalc(StubCalc):
+	"""
+	OPERA runs one model request for a list of chemicals.
+	"""
+	name = 'opera'
+
+	def data_request_handler(self, request_dict):
+		stub_call(self.name)
+		chemicals = request_dict.get('chemical')
+		if not isinstance(chemicals, list):
+			chemicals = [chemicals]
+		data = [{'chemical': chemical, 'prop': request_dict.get('prop'), 'data': 1.23} for chemical in chemicals]
+		return {'valid': True, 'calc': self.name, 'prop': request_dict.get('prop'), 'data': data}
+
+
+
+class MetabolizerCalc(object):
+	"""
+	Metabolizer with config.metabolizer_branching products per
+	node, returning trees shaped like MetabolizerCalc().recursive.
+	"""
+	def __init__(self):
+		self.meta_info = meta_info('metabolizer')
+		self.metID = 0
+
+	def getTransProducts(self, request_dict):
+		stub_call('metabolizer')
+		return {'results': {'structure': request_dict['structure']}}
+
+	def recursive(self, response, gen_limit, unranked=False):
+		def build_node(smiles, generation):
+			self.metID += 1
+			node = {
+				'id': self.metID,
+				'name': smiles,
+				'data': {'smiles': smiles, 'generation': generation, 'likelihood': 'LIKELY', 'routes': 'stub'},
+				'children': [],
+			}
+			if generation < gen_limit:
+				node['children'] = [
+					build_node("{}.{}".format(smiles, index), generation + 1)
+					for index in range(config.metabolizer_branching)
+				]
+			return node
+		return json.dumps(build_node(response['results']['structure'], 0))
+
+
+
+class Calculator(object):
+	pass
+
+
+
+class SMILESFilter(object):
+	def filterSMILES(self, smiles):
+		stub_call('smiles_filter')
+		return smiles.strip()
+
+
+
+class ChemInfo(object):
+	def get_cheminfo(self, request_post, only_dsstox=False):
+		chemical = request_post.get('chemical')
+		stub_call('dsstox' if only_dsstox else 'chem_info')
+		chemical_id = zlib.crc32(chemical.encode('utf-8'))
+		dsstox_id = "DTXSID{}".format(chemical_id)
+		if only_dsstox:
+			return {'dsstoxSubstanceId': dsstox_id}
+		data = {
+			'chemical': chemical,
+			'orig_smiles': chemical,
+			'smiles': chemical,
+			'preferredName': chemical,
+			'iupac': chemical,
+			'formula': "C2H6O",
+			'casrn': "{}-{}-{}".format(chemical_id // 1000, chemical_id // 10 % 100, chemical_id % 10),
+			'cas': "{}-{}-{}".format(chemical_id // 1000, chemical_id // 10 % 100, chemical_id % 10),
+			'dsstoxSubstanceId': dsstox_id,
+			'mass': 46.07,
+			'exactMass': 46.04,
+		}
+		if request_post.get('get_structure_data') in (True, 'true'):
+			data['structureData'] = "<cml>{}</cml>".format("x" * config.structure_data_size)
+		return {'status': True, 'request_post': dict(request_post), 'data': data}
+
+
+
+class MongoDBHandler(object):
+	"""
+	MongoDBHandler with in-memory documents: every DSSTox ID has
+	a DTXCID, and every DTXCID has p-chem data for every prop.
+	Chem info documents are kept in stub_db.
+	"""
+	def __init__(self):
+		self.is_connected = False
+		self.mongodb_conn = None
+
+	def connect_to_db(self):
+		stub_call('mongo_connect')
+		self.mongodb_conn = StubMongoClient()
+		self.is_connected = config.mongo
+
+	def find_dtxcid_document(self, query):
+		stub_call('mongo')
+		return dtxcid_document(query.get('DTXSID'))
+
+	def find_pchem_document(self, query):
+		stub_call('mongo')
+		return pchem_document(query.get('dsstoxSubstanceId'), query.get('prop'), query.get('ph'))
+
+	def find_chem_info_document(self, query):
+		stub_call('mongo')
+		with stub_db.lock:
+			for document in stub_db.chem_info:
+				if any(document.get(key) == value for subquery in query.get('$or', [query]) for key, value in subquery.items()):
+					return dict(document)
+		return None
+
+	def insert_chem_info_data(self, data):
+		stub_call('mongo')
+		with stub_db.lock:
+			stub_db.chem_info.append(dict(data, _id=len(stub_db.chem_info)))
+
+
+
+class StubDB(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.chem_info = []  # chem info documents
+		self.structures = {}  # _id: structure data document
+
+
+
+stub_db = StubDB()
+
+
+
+class StubMongoClient(object):
+	def __init__(self):
+		self.admin = types.SimpleNamespace(command=lambda command: {'ok': 1})
+
+	def __getitem__(self, db_name):
+		collections = {collection_name: StubCollection(collection_name) for collection_name in ('dsstox', 'pchem')}
+		collections['chem_info_structures'] = StubStructureCollection()
+		return collections
+
+	def close(self):
+		pass
+
+
+
+class StubCollection(object):
+	"""
+	Supports the $in queries used by cts_db's bulk lookups.
+	"""
+	def __init__(self, name):
+		self.name = name
+
+	def find(self, query):
+		stub_call('mongo')
+		if self.name == 'dsstox':
+			return [dtxcid_document(dtxsid) for dtxsid in query['DTXSID']['$in']]
+		documents = []
+		for dtxcid in query['dsstoxSubstanceId']['$in']:
+			for prop_query in query.get('$or', []):
+				props = prop_query['prop']['$in'] if isinstance(prop_query['prop'], dict) else [prop_query['prop']]
+				phs = prop_query['ph']['$in'] if 'ph' in prop_query else [None]
+				documents.extend(pchem_document(dtxcid, prop, ph) for prop in props for ph in phs)
+		return documents
+
+
+
+class StubStructureCollection(object):
+	def find_one(self, query):
+		stub_call('mongo')
+		with stub_db.lock:
+			return stub_db.structures.get(query['_id'])
+
+	def replace_one(self, query, document, upsert=False):
+		stub_call('mongo')
+		with stub_db.lock:
+			stub_db.structures[query['_id']] = document
+
+
+
+def dtxcid_document(dtxsid):
+	return {'_id': dtxsid, 'DTXSID': dtxsid, 'DTXCID': dtxsid.replace('DTXSID', 'DTXCID')}
+
+
+def pchem_document(dtxcid, prop, ph=None):
+	document = {'_id': "{}-{}".format(dtxcid, prop), 'dsstoxSubstanceId': dtxcid, 'prop': prop, 'data': 1.23}
+	if ph is not None:
+		document['ph'] = ph
+	return document
+
+
+def install(stub_config=None):
+	"""
+	Registers the stubs as the cts_app.cts_calcs (and models.chemspec)
+	modules cts_rest imports. Returns the StubConfig in use.
+	"""
+	global config
+	if stub_config is not None:
+		config = stub_config
+	modules = {
+		'cts_app.cts_calcs': {},
+		'cts_app.cts_calcs.calculator': {'Calculator': Calculator},
+		'cts_app.cts_calcs.calculator_chemaxon': {'JchemCalc': JchemCalc},
+		'cts_app.cts_calcs.calculator_epi': {'EpiCalc': EpiCalc},
+		'cts_app.cts_calcs.calculator_measured': {'MeasuredCalc': MeasuredCalc},
+		'cts_app.cts_calcs.calculator_test': {'TestWSCalc': TestWSCalc},
+		'cts_app.cts_calcs.calculator_sparc': {'SparcCalc': SparcCalc},
+		'cts_app.cts_calcs.calculator_metabolizer': {'MetabolizerCalc': MetabolizerCalc},
+		'cts_app.cts_calcs.calculator_biotrans': {'BiotransCalc': BiotransCalc},
+		'cts_app.cts_calcs.calculator_opera': {'OperaCalc': OperaCalc},
+		'cts_app.cts_calcs.calculator_envipath': {'EnvipathCalc': EnvipathCalc},
+		'cts_app.cts_calcs.smilesfilter': {'SMILESFilter': SMILESFilter},
+		'cts_app.cts_calcs.chemical_information': {'ChemInfo': ChemInfo},
+		'cts_app.cts_calcs.mongodb_handler': {'MongoDBHandler': MongoDBHandler},
+		'cts_app.models': {},
+		'cts_app.models.chemspec': {'chemspec_output': None},
+	}
+	for module_name, attributes in modules.items():
+		module = types.ModuleType(module_name)
+		module.__dict__.update(attributes)
+		if not '.' in module_name.split('cts_app.', 1)[1]:
+			module.__path__ = []  # package
+		sys.modules[module_name] = module
+	return config
@@ -0,0 +1,77 @@
+"""
+Asyncio versions of the CTS REST entry points, for ASGI deployments.
+
+The cts_calcs calculators make blocking HTTP requests, so their calls
+are run on one shared, bounded thread pool and awaited, leaving the
+event loop free to take other requests while calculators respond.
+Streamed responses are iterated on the pool too, one record at a time.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.http import StreamingHttpResponse
+
+from . import cts_context
+from . import cts_rest
+
+
+
+calc_executor = ThreadPoolExecutor(
+	max_workers=int(os.environ.get('CTS_ASYNC_CALC_WORKERS', 256)),
+	thread_name_prefix='cts-calc'
+)
+
+
+
+async def run_blocking(func, *args, **kwargs):
+	"""
+	Awaits a blocking call on calc_executor, in the
+	current request's context (see cts_context).
+	"""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(calc_executor, cts_context.run_in_context(functools.partial(func, *args, **kwargs)))
+
+
+async def iter_blocking(iterator):
+	"""
+	Async iterator over a blocking iterator (e.g., a streamed
+	response's records), getting each item on calc_executor.
+	"""
+	done = object()
+	while True:
+		item = await run_blocking(next, iterator, done)
+		if item is done:
+			return
+		yield item
+
+
+def async_streaming(response):
+	"""
+	Gives a streamed response an async iterator, so ASGI sends
+	each record as it's ready. Django buffers a whole sync
+	iterator before sending it from an async view.
+	"""
+	if isinstance(response, StreamingHttpResponse) and not response.is_async:
+		response.streaming_content = iter_blocking(response.streaming_content)
+	return response
+
+
+async def runCalc(calc, request_dict, stream_format=None):
+	response = await run_blocking(cts_rest.getSharedCTSREST().runCalc, calc, request_dict, stream_format)
+	return async_streaming(response)
+
+
+async def runBatch(request_dict, stream_format=None):
+	response = await run_blocking(cts_rest.getSharedCTSREST().runBatch, request_dict, stream_format)
+	return async_streaming(response)
+
+
+async def getCalcInputs(chemical, calc, prop=None, request=None):
+	return cts_rest.getCalcInputsResponse(chemical, calc, prop, request)  # prepared, no calculator I/O
+
+
+async def getChemicalEditorData(request_post):
+	return await run_blocking(cts_rest.getChemicalEditorData, request_post)
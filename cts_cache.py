@@ -0,0 +1,349 @@
+"""
+Result caching for CTS REST calculator requests.
+
+Cache entries are stored as JSON strings, so every backend returns
+a fresh copy of the cached object.
+"""
+
+import logging
+import json
+import hashlib
+import os
+import time
+import threading
+import collections
+import re
+import sys
+
+from . import cts_json
+
+try:
+	import redis
+except ImportError:
+	redis = None
+
+
+
+class MemoryCacheBackend(object):
+	"""
+	In-process cache with LRU eviction and TTL expiry.
+	"""
+	def __init__(self, max_entries=10000):
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()  # key: (expires, value)
+		self.lock = threading.Lock()
+		self.evictions = 0
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			if entry[0] < time.time():
+				del self.entries[key]
+				return None
+			self.entries.move_to_end(key)
+			return entry[1]
+
+	def set(self, key, value, ttl):
+		with self.lock:
+			self.entries[key] = (time.time() + ttl, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def size(self):
+		return len(self.entries)
+
+
+
+class RedisCacheBackend(object):
+	"""
+	Shared cache on a Redis-compatible server. Expiry uses the
+	key's TTL, LRU eviction is left to the server's maxmemory-policy.
+	"""
+	def __init__(self, url, prefix='cts:'):
+		if redis is None:
+			raise ImportError("redis package is required for the redis cache backend")
+		self.conn = redis.Redis.from_url(url)
+		self.prefix = prefix
+		self.evictions = 0
+
+	def get(self, key):
+		value = self.conn.get(self.prefix + key)
+		return value.decode('utf-8') if value is not None else None
+
+	def set(self, key, value, ttl):
+		self.conn.set(self.prefix + key, value, ex=int(ttl))
+
+	def clear(self):
+		for key in self.conn.scan_iter(self.prefix + '*'):
+			self.conn.delete(key)
+
+	def size(self):
+		return sum(1 for _ in self.conn.scan_iter(self.prefix + '*'))
+
+
+
+class FileCacheBackend(object):
+	"""
+	Shared on-disk cache, one file per entry. File mtimes are
+	used as access times for LRU eviction.
+	"""
+	def __init__(self, cache_dir, max_entries=100000, prune_every=100):
+		self.cache_dir = cache_dir
+		self.max_entries = max_entries
+		self.prune_every = prune_every
+		self.set_count = 0
+		self.evictions = 0
+		self.lock = threading.Lock()  # for set_count and evictions
+		os.makedirs(cache_dir, exist_ok=True)
+
+	def _path(self, key):
+		return os.path.join(self.cache_dir, key + '.json')
+
+	def get(self, key):
+		path = self._path(key)
+		try:
+			with open(path, 'r') as cache_file:
+				expires, value = json.load(cache_file)
+		except (OSError, ValueError):
+			return None
+		if expires < time.time():
+			self._remove(path)
+			return None
+		os.utime(path, None)  # marks entry as recently used
+		return value
+
+	def set(self, key, value, ttl):
+		path = self._path(key)
+		# thread idents are reused across processes, so the pid is needed too:
+		tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+		try:
+			with open(tmp_path, 'w') as cache_file:
+				json.dump([time.time() + ttl, value], cache_file)
+			os.replace(tmp_path, path)  # atomic for other processes reading the entry
+		except BaseException:
+			self._remove(tmp_path)
+			raise
+		with self.lock:
+			self.set_count += 1
+			should_prune = self.set_count % self.prune_every == 0
+		if should_prune:
+			self.prune()
+
+	def prune(self):
+		"""
+		Removes least recently used entries over max_entries.
+		"""
+		paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+		if len(paths) <= self.max_entries:
+			return
+		paths.sort(key=lambda path: os.path.getmtime(path))
+		for path in paths[:len(paths) - self.max_entries]:
+			self._remove(path)
+			with self.lock:
+				self.evictions += 1
+
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+	def clear(self):
+		for name in os.listdir(self.cache_dir):
+			if name.endswith('.json'):
+				self._remove(os.path.join(self.cache_dir, name))
+
+	def size(self):
+		return sum(1 for name in os.listdir(self.cache_dir) if name.endswith('.json'))
+
+
+
+class ResultCache(object):
+	"""
+	Content-addressed cache for calculator results, keyed
+	on a hash of the request inputs that determine the result.
+	"""
+	def __init__(self, backend, ttl=86400, name='results'):
+		self.backend = backend
+		self.ttl = ttl
+		self.name = name
+		self.lock = threading.Lock()  # for the stats counters
+		self.hits = 0
+		self.misses = 0
+		self.errors = 0
+
+	@staticmethod
+	def make_key(*parts):
+		"""
+		Builds a key from the JSON of parts, e.g., (smiles, calc, prop, ph, method).
+		"""
+		key_json = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+		return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+	def get(self, key):
+		"""
+		Returns the cached object, or None if it's not cached.
+		"""
+		try:
+			value = self.backend.get(key)
+		except Exception as e:
+			logging.warning("{} cache get error: {}".format(self.name, e))
+			self.count('errors')
+			value = None
+		if value is None:
+			self.count('misses')
+			return None
+		self.count('hits')
+		return cts_json.loads(value)
+
+	def set(self, key, obj, ttl=None):
+		try:
+			self.backend.set(key, cts_json.dumps_str(obj), ttl or self.ttl)
+		except Exception as e:
+			logging.warning("{} cache set error: {}".format(self.name, e))
+			self.count('errors')
+
+	def count(self, counter):
+		with self.lock:
+			setattr(self, counter, getattr(self, counter) + 1)
+
+	def clear(self):
+		self.backend.clear()
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			'backend': type(self.backend).__name__,
+			'hits': self.hits,
+			'misses': self.misses,
+			'errors': self.errors,
+			'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+			'evictions': self.backend.evictions,
+		}
+
+
+
+class NullCache(object):
+	"""
+	Stands in for ResultCache when caching is turned off.
+	"""
+	name = 'none'
+
+	def get(self, key):
+		return None
+
+	def set(self, key, obj, ttl=None):
+		pass
+
+	def clear(self):
+		pass
+
+	def stats(self):
+		return {'backend': None}
+
+	make_key = staticmethod(ResultCache.make_key)
+
+
+
+class MemoTable(object):
+	"""
+	Size-bounded, thread-safe memo table (LRU) of string inputs to
+	interned string outputs, e.g., raw input SMILES to filtered SMILES.
+	Inputs are normalized so whitespace and escaped backslash
+	variants of a string share an entry.
+	"""
+	whitespace_re = re.compile(r'\s+')
+
+	def __init__(self, max_entries=50000, name='memo'):
+		self.max_entries = max_entries
+		self.name = name
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	@classmethod
+	def normalize(cls, value):
+		value = cls.whitespace_re.sub(' ', value).strip()
+		return value.replace('\\\\', '\\')  # swagger/json double-escaped backslashes
+
+	def get(self, value):
+		key = self.normalize(value)
+		with self.lock:
+			result = self.entries.get(key)
+			if result is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return result
+
+	def set(self, value, result):
+		key = self.normalize(value)
+		with self.lock:
+			self.entries[key] = sys.intern(result)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def load(self, path):
+		"""
+		Warms the table from a JSON file of {input: output}.
+		"""
+		with open(path, 'r') as memo_file:
+			entries = json.load(memo_file)
+		for value, result in entries.items():
+			self.set(value, result)
+		logging.info("Loaded {} {} entries from {}".format(len(entries), self.name, path))
+
+	def dump(self, path):
+		"""
+		Saves the table as a JSON file that load() can read.
+		"""
+		with self.lock:
+			entries = dict(self.entries)
+		with open(path, 'w') as memo_file:
+			json.dump(entries, memo_file)
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			'entries': len(self.entries),
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+		}
+
+
+
+def create_cache(name, default_ttl=86400, default_max_entries=10000):
+	"""
+	Creates a cache from CTS_CACHE_* environment settings:
+	CTS_CACHE_BACKEND ("memory", "redis", "file", or "none"),
+	CTS_CACHE_TTL (seconds), CTS_CACHE_MAX_ENTRIES, CTS_CACHE_URL (redis),
+	and CTS_CACHE_DIR (file).
+	"""
+	backend_name = os.environ.get('CTS_CACHE_BACKEND', 'memory')
+	ttl = int(os.environ.get('CTS_CACHE_TTL', default_ttl))
+	max_entries = int(os.environ.get('CTS_CACHE_MAX_ENTRIES', default_max_entries))
+	try:
+		if backend_name == 'none':
+			return NullCache()
+		elif backend_name == 'redis':
+			backend = RedisCacheBackend(os.environ.get('CTS_CACHE_URL', 'redis://localhost:6379/0'), prefix="cts:{}:".format(name))
+		elif backend_name == 'file':
+			backend = FileCacheBackend(os.path.join(os.environ.get('CTS_CACHE_DIR', '/tmp/cts_cache'), name), max_entries)
+		else:
+			backend = MemoryCacheBackend(max_entries)
+	except Exception as e:
+		logging.warning("Could not create {} cache backend ({}), using memory: {}".format(backend_name, name, e))
+		backend = MemoryCacheBackend(max_entries)
+	return ResultCache(backend, ttl, name)
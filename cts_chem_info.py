@@ -0,0 +1,201 @@
+"""
+Read-through cache for chemical information (/molecule).
+"""
+
+import logging
+
+from .cts_cache import MemoTable
+
+
+
+class ChemInfoCache(object):
+	"""
+	Chemical information from an in-process LRU cache, then the
+	MongoDB chem_info collection, then the calc server (with
+	request_cheminfo, e.g., ChemInfo().get_cheminfo).
+
+	Info is cached under the request's chemical and its canonical
+	SMILES, DSSTox ID, and CAS number, so any of them hit the same
+	entry. Its request-specific fields ('chemical' and 'orig_smiles')
+	are derived from the request that hits it, not the one that
+	populated it, see get_orig_smiles. The Marvin <cml> structureData is cached separately (it's
+	much larger than the rest), and only fetched when requested
+	with 'get_structure_data'.
+
+	A miss in both caches costs a DB round trip before the calc
+	server request. An indexed chem_info lookup is a few ms, against a
+	calc server request that's usually hundreds of ms, and it saves
+	that request for chemicals cached by other processes or before a
+	restart. Without a db_pool (None) the DB tier is skipped.
+	"""
+	def __init__(self, info_cache, structure_cache, db_pool, request_cheminfo, flight, executor=None):
+		self.info_cache = info_cache  # cts_cache.ResultCache, in-process
+		self.structure_cache = structure_cache  # cts_cache.ResultCache, in-process
+		self.db_pool = db_pool  # cts_db.MongoHandlerPool, or None
+		self.request_cheminfo = request_cheminfo  # e.g., ChemInfo().get_cheminfo
+		self.flight = flight  # cts_concurrency.SingleFlight
+		self.executor = executor  # for DB writes, inline if None
+		self.db_hits = 0
+		self.calc_requests = 0
+
+	def get_cheminfo(self, request_post):
+		"""
+		Same response as ChemInfo().get_cheminfo(request_post).
+		"""
+		chemical = MemoTable.normalize(request_post.get('chemical') or '')
+		with_structure = request_post.get('get_structure_data') in (True, 'true', 'True')
+		key = self.info_cache.make_key('chem_info', chemical, with_structure)
+		results = self.flight.do(key, lambda: self.read_through(request_post, chemical, with_structure))
+		return self.for_request(results, request_post)
+
+	def read_through(self, request_post, chemical, with_structure):
+		record = self.info_cache.get(self.info_key(chemical))
+		if record is None:
+			record = self.find_db_record(chemical)
+		if record is not None:
+			structure_data = None
+			if with_structure:
+				structure_data = self.get_structure_data(record.get('structureKey'))
+			if not with_structure or structure_data is not None:
+				return self.build_response(request_post, record, structure_data)
+
+		self.calc_requests += 1
+		results = self.request_cheminfo(request_post)  # calc server
+		if isinstance(results, dict) and results.get('status') is not False and isinstance(results.get('data'), dict):
+			info = dict(results['data'])
+			structure_data = info.pop('structureData', None)
+			self.save_record(chemical, info, structure_data, save_info=record is None)
+		return results
+
+	def find_db_record(self, chemical):
+		if self.db_pool is None:
+			return None
+		try:
+			db_results = self.db_pool.find_chem_info_document({'$or': [
+				{'dsstoxSubstanceId': chemical},
+				{'smiles': chemical},
+				{'casrn': chemical},
+				{'chemical': chemical},
+			]})
+		except Exception as e:
+			logging.warning("Error requesting chem info from DB: {}".format(e))
+			return None
+		if not db_results:
+			return None
+		logging.info("Getting chem info from DB.")
+		self.db_hits += 1
+		info = dict(db_results)
+		info.pop('_id', None)
+		structure_data = info.pop('structureData', None)  # documents saved with structureData
+		return self.save_record(chemical, info, structure_data, save_info=False)
+
+	def get_structure_data(self, structure_key):
+		if not structure_key:
+			return None
+		structure_data = self.structure_cache.get(structure_key)
+		if structure_data is not None or self.db_pool is None:
+			return structure_data
+		try:
+			document = self.db_pool.find_structure_document(structure_key)
+		except Exception as e:
+			logging.warning("Error requesting structure data from DB: {}".format(e))
+			return None
+		if document and document.get('structureData'):
+			self.structure_cache.set(structure_key, document['structureData'])
+			return document['structureData']
+		return None
+
+	def save_record(self, chemical, info, structure_data=None, save_info=True):
+		"""
+		Caches info under chemical and its aliases, and structure_data
+		under its structure key. save_info also saves info to the DB.
+		Returns chemical's record.
+		"""
+		structure_key = self.get_structure_key(info)
+		source = MemoTable.normalize(info.get('chemical') or chemical)  # the chemical info was requested with
+		record = None
+		for alias in self.get_aliases(chemical, info):
+			alias_record = {'info': info, 'structureKey': structure_key, 'origSmiles': self.get_orig_smiles(alias, source, info)}
+			self.info_cache.set(self.info_key(alias), alias_record)
+			if alias == chemical:
+				record = alias_record
+		if structure_data and structure_key:
+			self.structure_cache.set(structure_key, structure_data)
+		if self.db_pool is not None and (save_info or (structure_data and structure_key)):
+			self.run_db_write(self.save_db_record, info if save_info else None, structure_key, structure_data)
+		return record
+
+	def save_db_record(self, info, structure_key, structure_data):
+		try:
+			if info is not None:
+				self.db_pool.insert_chem_info_data(dict(info))
+			if structure_data and structure_key:
+				self.db_pool.insert_structure_document(structure_key, structure_data)
+		except Exception as e:
+			logging.warning("Error saving chem info to DB: {}".format(e))
+
+	def run_db_write(self, func, *args):
+		if self.executor is None:
+			func(*args)
+		else:
+			self.executor.submit(func, *args)
+
+	def build_response(self, request_post, record, structure_data=None):
+		data = dict(record['info'], chemical=request_post.get('chemical'))
+		if 'orig_smiles' in data:
+			data['orig_smiles'] = record.get('origSmiles')
+		if structure_data is not None:
+			data['structureData'] = structure_data
+		return {'status': True, 'request_post': request_post, 'data': data}
+
+	@staticmethod
+	def for_request(results, request_post):
+		"""
+		Copy of results with request_post's own request fields, as
+		concurrent requests for the same chemical share one response.
+		"""
+		if not isinstance(results, dict) or not isinstance(results.get('data'), dict):
+			return results
+		return dict(results, request_post=request_post, data=dict(results['data'], chemical=request_post.get('chemical')))
+
+	@staticmethod
+	def get_aliases(chemical, info):
+		aliases = set([chemical])
+		for key in ('smiles', 'dsstoxSubstanceId', 'casrn'):
+			value = info.get(key)
+			if isinstance(value, str) and value and value != "N/A":
+				aliases.add(MemoTable.normalize(value))
+		return aliases
+
+	@staticmethod
+	def get_orig_smiles(alias, source, info):
+		"""
+		The 'orig_smiles' (the request's chemical as SMILES, before
+		filtering) for a request with alias. That's info's own for the
+		chemical it was requested with, otherwise alias is its SMILES, or a
+		DSSTox ID or CAS number, which the calc server converts to its SMILES.
+		"""
+		if alias == source or not info.get('smiles'):
+			return info.get('orig_smiles')
+		return info['smiles']
+
+	@staticmethod
+	def get_structure_key(info):
+		dsstox_id = info.get('dsstoxSubstanceId')
+		if isinstance(dsstox_id, str) and dsstox_id and dsstox_id != "N/A":
+			return dsstox_id
+		return info.get('smiles') or None
+
+	@staticmethod
+	def info_key(chemical):
+		return 'info:{}'.format(chemical)
+
+	def stats(self):
+		stats = {"memory_{}".format(key): value for key, value in self.info_cache.stats().items()}
+		stats.update({
+			'db_hits': self.db_hits,
+			'calc_requests': self.calc_requests,
+			'structure_hits': self.structure_cache.hits,
+			'structure_misses': self.structure_cache.misses,
+		})
+		return stats
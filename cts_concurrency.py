@@ -0,0 +1,411 @@
+"""
+Concurrency controls for CTS REST calculator requests.
+"""
+
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # no cross-process locks (e.g., windows)
+
+
+
+class _FlightCall(object):
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.error = None
+
+
+
+class SingleFlight(object):
+	"""
+	Coalesces concurrent calls with the same key into one call, whose
+	result is shared with every waiting caller. With lock_dir, calls are
+	also coalesced across processes: one process at a time holds a file
+	lock for the key, and the others check a shared store (e.g., a redis
+	or file cache) with recheck() once they get the lock. Each key has
+	its own lock file, so unrelated keys never wait on each other. Lock
+	files unused for lock_max_age seconds are removed every
+	prune_interval seconds.
+	"""
+	def __init__(self, lock_dir=None, lock_timeout=120, lock_max_age=3600, prune_interval=600, name='flight'):
+		self.lock_dir = lock_dir if fcntl is not None else None
+		self.lock_timeout = lock_timeout
+		self.lock_max_age = lock_max_age
+		self.prune_interval = prune_interval
+		self.name = name
+		self.lock = threading.Lock()
+		self.calls = {}  # key: _FlightCall
+		self.leaders = 0
+		self.followers = 0
+		self.last_prune = time.time()
+		if self.lock_dir:
+			os.makedirs(self.lock_dir, exist_ok=True)
+
+	def do(self, key, func, recheck=None):
+		"""
+		Returns func(), running it once for all concurrent callers with key.
+		recheck() is used in cross-process mode, a non-None result is
+		returned instead of running func.
+		"""
+		with self.lock:
+			call = self.calls.get(key)
+			is_leader = call is None
+			if is_leader:
+				call = _FlightCall()
+				self.calls[key] = call
+				self.leaders += 1
+			else:
+				self.followers += 1
+
+		if not is_leader:
+			call.event.wait()
+			if call.error is not None:
+				raise call.error
+			return copy.deepcopy(call.result)
+
+		try:
+			call.result = self._run(key, func, recheck)
+			return call.result
+		except Exception as e:
+			call.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.event.set()
+
+	def _run(self, key, func, recheck):
+		if not self.lock_dir:
+			return func()
+		self._maybe_prune()
+		lock_path = os.path.join(self.lock_dir, "{}.lock".format(hashlib.sha256(key.encode('utf-8')).hexdigest()))
+		lock_file = self._acquire_file_lock(lock_path)
+		try:
+			if lock_file is not None and recheck is not None:
+				result = recheck()
+				if result is not None:
+					return result
+			return func()
+		finally:
+			if lock_file is not None:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+				lock_file.close()
+
+	def _acquire_file_lock(self, lock_path):
+		"""
+		Waits up to lock_timeout for the key's file lock, returning the
+		locked file, or None if it times out (the call then runs
+		without the lock). A lock file that was pruned while waiting
+		for it is opened again.
+		"""
+		deadline = time.time() + self.lock_timeout
+		delay = 0.01
+		lock_file = open(lock_path, 'a')
+		while True:
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except OSError:
+				if time.time() > deadline:
+					logging.warning("{} lock timed out for {}".format(self.name, lock_path))
+					lock_file.close()
+					return None
+				time.sleep(delay)
+				delay = min(delay * 2, 0.5)
+				continue
+			if self._is_current(lock_file, lock_path):
+				os.utime(lock_path, None)  # marks the lock file as used, see prune_lock_files
+				return lock_file
+			lock_file.close()  # pruned, lock the new file
+			lock_file = open(lock_path, 'a')
+
+	@staticmethod
+	def _is_current(lock_file, lock_path):
+		try:
+			return os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+		except OSError:
+			return False
+
+	def _maybe_prune(self):
+		now = time.time()
+		if now - self.last_prune < self.prune_interval:
+			return
+		with self.lock:
+			if now - self.last_prune < self.prune_interval:
+				return
+			self.last_prune = now
+		self.prune_lock_files()
+
+	def prune_lock_files(self):
+		"""
+		Removes lock files unused for lock_max_age seconds, each
+		while holding its lock so no call is using it.
+		"""
+		cutoff = time.time() - self.lock_max_age
+		for name in os.listdir(self.lock_dir):
+			lock_path = os.path.join(self.lock_dir, name)
+			try:
+				if not name.endswith('.lock') or os.path.getmtime(lock_path) > cutoff:
+					continue
+				with open(lock_path, 'a') as lock_file:
+					fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					if self._is_current(lock_file, lock_path):
+						os.remove(lock_path)
+			except OSError:
+				continue  # in use, or removed by another process
+
+	def stats(self):
+		return {
+			'in_flight': len(self.calls),
+			'leaders': self.leaders,
+			'followers': self.followers,
+			'cross_process': bool(self.lock_dir),
+		}
+
+
+
+class CalcUnavailableError(Exception):
+	"""
+	Raised when a calculator request isn't admitted, with the
+	seconds a client should wait before retrying.
+	"""
+	def __init__(self, message, retry_after=1):
+		super().__init__(message)
+		self.retry_after = retry_after
+
+
+
+class CircuitOpenError(CalcUnavailableError):
+	pass
+
+
+
+class AdmissionTimeoutError(CalcUnavailableError):
+	pass
+
+
+
+class AdaptiveLimiter(object):
+	"""
+	Concurrency limit that adapts to a backend's latency (AIMD): the
+	limit grows by about one per round trip of fast calls, and is cut
+	by backoff_ratio, at most once per round trip, when a call fails or
+	takes longer than latency_tolerance times the usual latency.
+	Callers over the limit wait in a queue of up to max_queue callers,
+	each until its own deadline.
+	"""
+	def __init__(self, initial_limit=8, min_limit=1, max_limit=64, max_queue=256,
+			latency_tolerance=2.0, backoff_ratio=0.75, name='limiter'):
+		self.limit = float(initial_limit)
+		self.min_limit = min_limit
+		self.max_limit = max_limit
+		self.max_queue = max_queue
+		self.latency_tolerance = latency_tolerance
+		self.backoff_ratio = backoff_ratio
+		self.name = name
+		self.condition = threading.Condition()
+		self.in_flight = 0
+		self.queued = 0
+		self.usual_latency = None  # slow moving average of successful calls
+		self.last_decrease = 0
+		self.rejected = 0
+		self.timeouts = 0
+
+	def acquire(self, timeout):
+		"""
+		Waits up to timeout seconds for a slot. Raises
+		AdmissionTimeoutError if the queue is full or the wait times out.
+		"""
+		deadline = time.monotonic() + timeout
+		with self.condition:
+			if self.in_flight >= int(self.limit):
+				if self.queued >= self.max_queue:
+					self.rejected += 1
+					raise AdmissionTimeoutError("{} queue is full".format(self.name), self.retry_after())
+				self.queued += 1
+				try:
+					while self.in_flight >= int(self.limit):
+						remaining = deadline - time.monotonic()
+						if remaining <= 0:
+							self.timeouts += 1
+							raise AdmissionTimeoutError("{} is busy".format(self.name), self.retry_after())
+						self.condition.wait(remaining)
+				finally:
+					self.queued -= 1
+			self.in_flight += 1
+
+	def release(self, latency=None, success=True):
+		"""
+		Frees a slot, adjusting the limit with the call's
+		latency (in seconds) unless it's None.
+		"""
+		with self.condition:
+			self.in_flight -= 1
+			if latency is not None:
+				self.adjust(latency, success)
+			self.condition.notify_all()
+
+	def adjust(self, latency, success):
+		now = time.monotonic()
+		is_slow = self.usual_latency is not None and latency > self.usual_latency * self.latency_tolerance
+		if not success or is_slow:
+			if now - self.last_decrease > max(latency, self.usual_latency or 0):
+				self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+				self.last_decrease = now
+		else:
+			self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+		if success:
+			self.usual_latency = latency if self.usual_latency is None else 0.95 * self.usual_latency + 0.05 * latency
+
+	def retry_after(self):
+		return max(1, int(round(self.usual_latency or 1)))
+
+	def stats(self):
+		return {
+			'limit': round(self.limit, 2),
+			'in_flight': self.in_flight,
+			'queued': self.queued,
+			'usual_latency': round(self.usual_latency or 0, 4),
+			'rejected': self.rejected,
+			'timeouts': self.timeouts,
+		}
+
+
+
+class CircuitBreaker(object):
+	"""
+	Fails fast for a backend after failure_threshold consecutive
+	failures. Once open for reset_timeout seconds, one probe call at
+	a time is let through (half open): a success closes the circuit,
+	a failure opens it again with double the timeout (up to
+	max_reset_timeout).
+	"""
+	closed, half_open, open = 'closed', 'half_open', 'open'
+
+	def __init__(self, failure_threshold=5, reset_timeout=30, max_reset_timeout=300, name='circuit'):
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.max_reset_timeout = max_reset_timeout
+		self.name = name
+		self.lock = threading.Lock()
+		self.state = self.closed
+		self.failures = 0
+		self.opened_at = 0
+		self.open_timeout = reset_timeout
+		self.probing = False
+		self.trips = 0
+		self.rejected = 0
+
+	def check(self):
+		"""
+		Raises CircuitOpenError while the circuit is open.
+		"""
+		if self.state == self.open:
+			remaining = self.opened_at + self.open_timeout - time.monotonic()
+			if remaining > 0:
+				self.rejected += 1
+				raise CircuitOpenError("{} is unavailable".format(self.name), max(1, int(remaining)))
+
+	def before_call(self):
+		"""
+		Admits a call, taking the probe when the circuit is ready to
+		be tested. Raises CircuitOpenError if the call isn't allowed.
+		"""
+		with self.lock:
+			if self.state == self.closed:
+				return
+			self.check()
+			if self.probing:
+				self.rejected += 1
+				raise CircuitOpenError("{} is being tested for recovery".format(self.name), 1)
+			self.state = self.half_open
+			self.probing = True
+
+	def record_success(self):
+		with self.lock:
+			self.failures = 0
+			if self.state == self.half_open:  # only the probe closes an open circuit
+				logging.warning("{} recovered, closing circuit".format(self.name))
+				self.state = self.closed
+				self.open_timeout = self.reset_timeout
+				self.probing = False
+
+	def record_failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.state == self.half_open:
+				self.open_timeout = min(self.open_timeout * 2, self.max_reset_timeout)
+				self.trip()
+			elif self.state == self.closed and self.failures >= self.failure_threshold:
+				self.trip()
+
+	def trip(self):
+		logging.warning("{} failed {} times, opening circuit for {}s".format(self.name, self.failures, self.open_timeout))
+		self.state = self.open
+		self.opened_at = time.monotonic()
+		self.probing = False
+		self.trips += 1
+
+	def stats(self):
+		return {
+			'state': {self.closed: 0, self.half_open: 1, self.open: 2}[self.state],
+			'failures': self.failures,
+			'trips': self.trips,
+			'rejected': self.rejected,
+		}
+
+
+
+class CalcAdmission(object):
+	"""
+	Admission control for one calculator backend: a circuit breaker
+	to fail fast while the backend is down, and an adaptive limiter so
+	a slow backend can't take every request thread. Errors in
+	ignore_errors (e.g., invalid input) don't count as backend failures,
+	nor do results unless is_failure(result) says so.
+	"""
+	def __init__(self, limiter, breaker, queue_timeout=30, ignore_errors=(), is_failure=None):
+		self.limiter = limiter
+		self.breaker = breaker
+		self.queue_timeout = queue_timeout
+		self.ignore_errors = tuple(ignore_errors)
+		self.is_failure = is_failure
+
+	def call(self, func, *args, **kwargs):
+		self.breaker.check()  # fail fast without queueing
+		self.limiter.acquire(self.queue_timeout)
+		try:
+			self.breaker.before_call()
+		except CircuitOpenError:
+			self.limiter.release()
+			raise
+		start = time.monotonic()
+		try:
+			result = func(*args, **kwargs)
+		except self.ignore_errors:
+			self.record(start, True)
+			raise
+		except Exception:
+			self.record(start, False)
+			raise
+		self.record(start, self.is_failure is None or not self.is_failure(result))
+		return result
+
+	def record(self, start, success):
+		self.limiter.release(time.monotonic() - start, success)
+		if success:
+			self.breaker.record_success()
+		else:
+			self.breaker.record_failure()
+
+	def stats(self):
+		stats = self.limiter.stats()
+		stats.update({"circuit_{}".format(key): value for key, value in self.breaker.stats().items()})
+		return stats
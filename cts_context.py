@@ -0,0 +1,236 @@
+"""
+Per-request context for CTS REST: a trace ID, and timing spans for
+the stages of the request (from cts_metrics.time_stage), returned in
+X-Request-ID and Server-Timing headers and written to JSON logs.
+"""
+
+import asyncio
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+
+
+tracing_enabled = os.environ.get('CTS_TRACING', 'True') == 'True'
+server_timing_enabled = os.environ.get('CTS_SERVER_TIMING', 'False') == 'True'
+json_logs_enabled = os.environ.get('CTS_JSON_LOGS', 'False') == 'True'
+request_log_enabled = os.environ.get('CTS_REQUEST_LOG', 'False') == 'True'  # a log record per request, with its spans
+trace_id_pattern = re.compile(r'[A-Za-z0-9._-]{1,64}')  # X-Request-ID, with fullmatch (no trailing newline)
+traceparent_pattern = re.compile(r'(?!ff)[0-9a-f]{2}-(?!0{32})([0-9a-f]{32})-(?!0{16})[0-9a-f]{16}-[0-9a-f]{2}')  # W3C version-trace_id-parent_id-flags
+max_spans = 200  # per request, later spans are only counted
+current_context = contextvars.ContextVar('cts_request_context', default=None)
+request_logger = logging.getLogger('cts_app.cts_api.requests')
+
+
+
+class RequestContext(object):
+	"""
+	Trace ID and stage spans for one request. The spans list is shared
+	with threads the request's work is handed to (see run_in_context).
+	"""
+	def __init__(self, trace_id, path=None, method=None):
+		self.trace_id = trace_id
+		self.path = path
+		self.method = method
+		self.start = time.perf_counter()
+		self.spans = []  # (stage, calc, start, seconds)
+		self.dropped_spans = 0
+		self.entry = None
+		self.calc = None
+		self.prop = None
+		self.is_error = False
+
+	def add_span(self, stage, calc, start, seconds):
+		if len(self.spans) < max_spans:
+			self.spans.append((stage, calc, start, seconds))
+		else:
+			self.dropped_spans += 1
+
+	def annotate(self, entry=None, calc=None, prop=None):
+		"""
+		Sets the entry point, calc, and prop (e.g., from
+		cts_metrics.track_request), unless they're set already.
+		"""
+		self.entry = self.entry or entry
+		self.calc = self.calc or calc
+		self.prop = self.prop or prop
+
+	def server_timing(self):
+		"""
+		Server-Timing header value, with stages' total ms.
+		"""
+		stages = {}  # stage: [ms, calcs]
+		for stage, calc, _, seconds in self.spans:
+			stage_timing = stages.setdefault(stage, [0.0, []])
+			stage_timing[0] += seconds * 1000
+			if calc and not calc in stage_timing[1]:
+				stage_timing[1].append(calc)
+		metrics = []
+		for stage, (ms, calcs) in stages.items():
+			metric = "{};dur={:.1f}".format(stage, ms)
+			if calcs:
+				metric += ';desc="{}"'.format(",".join(calcs)[:100])
+			metrics.append(metric)
+		metrics.append("total;dur={:.1f}".format((time.perf_counter() - self.start) * 1000))
+		return ", ".join(metrics)
+
+	def to_dict(self):
+		return {
+			'trace_id': self.trace_id,
+			'entry': self.entry,
+			'calc': self.calc,
+			'prop': self.prop,
+			'path': self.path,
+			'method': self.method,
+			'duration_ms': round((time.perf_counter() - self.start) * 1000, 3),
+			'error': self.is_error,
+			'spans': [
+				{
+					'stage': stage,
+					'calc': calc,
+					'start_ms': round((start - self.start) * 1000, 3),
+					'duration_ms': round(seconds * 1000, 3),
+				}
+				for stage, calc, start, seconds in self.spans
+			],
+			'dropped_spans': self.dropped_spans,
+		}
+
+
+
+class JSONLogFormatter(logging.Formatter):
+	"""
+	Formats log records as JSON lines, with the current request's
+	trace ID. A record's extra 'data' dict is added to it, e.g.,
+	logging.info("...", extra={'data': {...}}).
+	"""
+	def format(self, record):
+		log_record = {
+			'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+			'level': record.levelname,
+			'logger': record.name,
+			'message': record.getMessage(),
+		}
+		context = current_context.get()
+		if context is not None:
+			log_record.update({'trace_id': context.trace_id, 'entry': context.entry, 'calc': context.calc})
+		if isinstance(getattr(record, 'data', None), dict):
+			log_record.update(record.data)
+		if record.exc_info:
+			log_record['exception'] = self.formatException(record.exc_info)
+		return json.dumps(log_record, default=str)
+
+
+
+def get_context():
+	return current_context.get()
+
+
+def add_span(stage, calc, start, seconds):
+	context = current_context.get()
+	if context is not None:
+		context.add_span(stage, calc, start, seconds)
+
+
+def get_trace_id(request):
+	"""
+	The request's X-Request-ID, or the trace ID of its W3C
+	traceparent, or a new ID. Invalid IDs (e.g., too long, or with
+	characters that don't belong in headers and logs) are ignored.
+	"""
+	request_id = request.META.get('HTTP_X_REQUEST_ID', '')
+	if trace_id_pattern.fullmatch(request_id):
+		return request_id
+	traceparent = traceparent_pattern.fullmatch(request.META.get('HTTP_TRACEPARENT', '').strip())
+	if traceparent is not None:
+		return traceparent.group(1)
+	return uuid.uuid4().hex
+
+
+def run_in_context(func):
+	"""
+	Wraps func to run in a copy of the current context (e.g., for
+	thread pools), so its spans are added to the current request.
+	"""
+	return functools.partial(contextvars.copy_context().run, func)
+
+
+def trace_view(view):
+	"""
+	Decorator for views (sync or async), running them in a RequestContext
+	and adding X-Request-ID (and Server-Timing) response headers.
+	Streamed responses are traced until the view returns.
+	"""
+	if not tracing_enabled:
+		return view
+
+	if asyncio.iscoroutinefunction(view):
+		@functools.wraps(view)
+		async def traced_async_view(request, *args, **kwargs):
+			context, token = start_request(request)
+			try:
+				response = await view(request, *args, **kwargs)
+			except Exception:
+				context.is_error = True
+				finish_request(context, None)
+				raise
+			finally:
+				current_context.reset(token)
+			return finish_request(context, response)
+		return traced_async_view
+
+	@functools.wraps(view)
+	def traced_view(request, *args, **kwargs):
+		context, token = start_request(request)
+		try:
+			response = view(request, *args, **kwargs)
+		except Exception:
+			context.is_error = True
+			finish_request(context, None)
+			raise
+		finally:
+			current_context.reset(token)
+		return finish_request(context, response)
+	return traced_view
+
+
+def start_request(request):
+	context = RequestContext(get_trace_id(request), request.path, request.method)
+	return context, current_context.set(context)
+
+
+def finish_request(context, response):
+	if response is not None:
+		response['X-Request-ID'] = context.trace_id
+		if server_timing_enabled:
+			response['Server-Timing'] = context.server_timing()
+	if request_log_enabled:
+		request_data = context.to_dict()
+		request_data['status'] = response.status_code if response is not None else None
+		request_logger.info("{} {} {:.0f}ms".format(context.method, context.path, request_data['duration_ms']), extra={'data': request_data})
+	return response
+
+
+def configure_json_logging():
+	"""
+	Formats the root logger's records with JSONLogFormatter
+	(adding a stream handler if it has none).
+	"""
+	root_logger = logging.getLogger()
+	if not root_logger.handlers:
+		root_logger.addHandler(logging.StreamHandler())
+	for handler in root_logger.handlers:
+		handler.setFormatter(JSONLogFormatter())
+
+
+
+if json_logs_enabled:
+	configure_json_logging()
+if request_log_enabled:
+	request_logger.setLevel(logging.INFO)
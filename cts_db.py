@@ -0,0 +1,225 @@
+"""
+Process-wide MongoDB connection handling for CTS REST.
+"""
+
+import logging
+import os
+import time
+import threading
+
+try:
+	import pymongo
+except ImportError:
+	pymongo = None
+
+
+
+# "<db>.<collection>" names for bulk queries, same collections
+# as MongoDBHandler's find_dtxcid_document and find_pchem_document:
+dsstox_collection = os.environ.get('CTS_MONGO_DSSTOX_COLLECTION', 'dsstox.dsstox')
+pchem_collection = os.environ.get('CTS_MONGO_PCHEM_COLLECTION', 'cts.pchem')
+structure_collection = os.environ.get('CTS_MONGO_STRUCTURE_COLLECTION', 'cts.chem_info_structures')  # structureData by DSSTox ID/SMILES
+
+
+
+class MongoHandlerPool(object):
+	"""
+	Shares one connected MongoDBHandler across all threads
+	in the process instead of connecting and closing per request.
+	pymongo's MongoClient pools its sockets and is thread-safe, so
+	the pool only has to health check it and reconnect (with backoff)
+	when the DB becomes unreachable. One thread at a time checks or
+	reconnects, without holding the lock, and the others carry on with
+	the current handler (or None) rather than waiting for it.
+	"""
+	def __init__(self, handler_class, health_check_interval=30, backoff_min=1, backoff_max=60, ping_timeout=2):
+		self.handler_class = handler_class
+		self.health_check_interval = health_check_interval
+		self.backoff_min = backoff_min
+		self.backoff_max = backoff_max
+		self.ping_timeout = ping_timeout  # seconds, including server selection
+		self.backoff = backoff_min
+		self.handler = None
+		self.last_check = 0
+		self.next_attempt = 0
+		self.checking = False  # a thread is health checking or reconnecting
+		self.lock = threading.Lock()
+
+	def get_handler(self):
+		"""
+		Returns the connected handler, or None if the DB
+		can't be reached (callers should fall back to models).
+		"""
+		handler = self.handler
+		if handler is not None and time.time() - self.last_check < self.health_check_interval:
+			return handler
+
+		with self.lock:
+			handler = self.handler
+			now = time.time()
+			if self.checking or (handler is not None and now - self.last_check < self.health_check_interval):
+				return handler
+			if handler is None and now < self.next_attempt:
+				return None  # still backing off from a failed connection
+			self.checking = True
+		try:
+			return self._check(handler)
+		finally:
+			with self.lock:
+				self.checking = False
+
+	def _check(self, handler):
+		"""
+		Health checks handler (None if there isn't one), reconnecting
+		if it fails. Only called by one thread at a time, see get_handler.
+		"""
+		if handler is not None:
+			if self._ping(handler):
+				self.last_check = time.time()
+				return handler
+			logging.warning("MongoDB health check failed, reconnecting..")
+			with self.lock:
+				self.handler = None
+			self._close(handler)
+			if time.time() < self.next_attempt:
+				return None
+
+		handler = self.handler_class()
+		try:
+			handler.connect_to_db()
+		except Exception as e:
+			logging.warning("Error connecting to MongoDB: {}".format(e))
+		if getattr(handler, 'is_connected', False):
+			with self.lock:
+				self.handler = handler
+				self.last_check = time.time()
+				self.backoff = self.backoff_min
+			return handler
+
+		self._close(handler)
+		with self.lock:
+			self.next_attempt = time.time() + self.backoff
+			logging.warning("MongoDB not available, next attempt in {}s".format(self.backoff))
+			self.backoff = min(self.backoff * 2, self.backoff_max)
+		return None
+
+	def mark_failed(self):
+		"""
+		Forces a health check on the next get_handler(),
+		e.g., after a query error.
+		"""
+		self.last_check = 0
+
+	def close(self):
+		with self.lock:
+			if self.handler is not None:
+				self._close(self.handler)
+				self.handler = None
+
+	def find_dtxcid_document(self, query):
+		return self._query('find_dtxcid_document', query)
+
+	def find_pchem_document(self, query):
+		return self._query('find_pchem_document', query)
+
+	def find_chem_info_document(self, query):
+		return self._query('find_chem_info_document', query)
+
+	def insert_chem_info_data(self, data):
+		return self._query('insert_chem_info_data', data)
+
+	def find_structure_document(self, structure_key):
+		"""
+		Finds the structureData document for a DSSTox ID or SMILES.
+		"""
+		collection = self._get_collection(structure_collection)
+		if collection is None:
+			return None
+		try:
+			return collection.find_one({'_id': structure_key})
+		except Exception:
+			self.mark_failed()
+			raise
+
+	def insert_structure_document(self, structure_key, structure_data):
+		collection = self._get_collection(structure_collection)
+		if collection is None:
+			return None
+		try:
+			return collection.replace_one({'_id': structure_key}, {'_id': structure_key, 'structureData': structure_data}, upsert=True)
+		except Exception:
+			self.mark_failed()
+			raise
+
+	def find_dtxcid_documents(self, dtxsids):
+		"""
+		Finds the DTXCID documents for a list of DTXSIDs with one $in query.
+		"""
+		return self._find_many(dsstox_collection, {'DTXSID': {'$in': list(dtxsids)}})
+
+	def find_pchem_documents(self, query):
+		"""
+		Finds all p-chem documents matching query (e.g., with $in).
+		"""
+		return self._find_many(pchem_collection, query)
+
+	def _find_many(self, collection_path, query):
+		collection = self._get_collection(collection_path)
+		if collection is None:
+			return None
+		try:
+			return list(collection.find(query))
+		except Exception:
+			self.mark_failed()
+			raise
+
+	def _get_collection(self, collection_path):
+		handler = self.get_handler()
+		if handler is None:
+			return None
+		db_name, collection_name = collection_path.split('.', 1)
+		return handler.mongodb_conn[db_name][collection_name]
+
+	def _query(self, method_name, query):
+		handler = self.get_handler()
+		if handler is None:
+			return None
+		try:
+			return getattr(handler, method_name)(query)
+		except Exception:
+			self.mark_failed()
+			raise
+
+	def _ping(self, handler):
+		try:
+			if pymongo is not None and hasattr(pymongo, 'timeout'):
+				# pymongo 4.2+, bounds server selection too (the client's serverSelectionTimeoutMS is 30s by default):
+				with pymongo.timeout(self.ping_timeout):
+					handler.mongodb_conn.admin.command('ping')
+			else:
+				handler.mongodb_conn.admin.command('ping')
+			return True
+		except Exception as e:
+			logging.warning("MongoDB ping error: {}".format(e))
+			return False
+
+	def _close(self, handler):
+		try:
+			if handler.mongodb_conn is not None:
+				handler.mongodb_conn.close()
+		except Exception as e:
+			logging.warning("Error closing MongoDB connection: {}".format(e))
+
+
+
+def create_pool(handler_class):
+	"""
+	Creates a MongoHandlerPool with CTS_MONGO_* environment settings.
+	"""
+	return MongoHandlerPool(
+		handler_class,
+		health_check_interval=float(os.environ.get('CTS_MONGO_HEALTH_CHECK_INTERVAL', 30)),
+		backoff_min=float(os.environ.get('CTS_MONGO_BACKOFF_MIN', 1)),
+		backoff_max=float(os.environ.get('CTS_MONGO_BACKOFF_MAX', 60)),
+		ping_timeout=float(os.environ.get('CTS_MONGO_PING_TIMEOUT', 2))
+	)
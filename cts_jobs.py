@@ -0,0 +1,181 @@
+"""
+Background jobs for long CTS REST requests (e.g., deep metabolizer
+trees, big batches), submitted and then polled for status and results.
+
+Job records and results are kept in a ResultCache, so with a shared
+backend (redis, file) any process can report on a job, though each
+job runs on a worker pool in the process it was submitted to.
+"""
+
+import base64
+import logging
+import threading
+import time
+import zlib
+
+
+
+class JobQueueFullError(Exception):
+	"""
+	Raised when a process has too many jobs waiting for a worker.
+	"""
+	retry_after = 30
+
+
+
+class JobError(Exception):
+	"""
+	A job's response was a server error (e.g., calculator
+	unavailable), so the job is failed and can be rerun.
+	"""
+	def __init__(self, body):
+		super(JobError, self).__init__(body.decode('utf-8', 'replace')[:500])
+
+
+
+class JobManager(object):
+	"""
+	Runs jobs on executor and keeps their records in store. A job's
+	ID comes from its kind and inputs, so resubmitting a job that's
+	queued, running, or done returns the existing job instead of
+	running it again. Failed jobs, and queued or running jobs that
+	haven't been updated for stale_timeout (e.g., their process exited),
+	are run again.
+	"""
+	def __init__(self, store, executor, ttl=86400, stale_timeout=3600, max_queued=1000):
+		self.store = store  # cts_cache.ResultCache
+		self.executor = executor
+		self.ttl = ttl
+		self.stale_timeout = stale_timeout
+		self.max_queued = max_queued
+		self.lock = threading.Lock()
+		self.queued = 0
+		self.running = 0
+		self.submitted = 0
+		self.deduplicated = 0
+		self.completed = 0
+		self.failed = 0
+
+	def submit(self, kind, params, run_job):
+		"""
+		Submits run_job(progress) for kind and params (e.g., 'run' and
+		the request dict), which returns (response bytes, status code)
+		and can report progress(done, total). Returns the job record.
+		"""
+		job_id = self.make_job_id(kind, params)
+		with self.lock:
+			job = self.get_job(job_id)
+			if job is not None and not self.should_rerun(job):
+				self.deduplicated += 1
+				return job
+			if self.queued >= self.max_queued:
+				raise JobQueueFullError("Too many queued jobs")
+			now = time.time()
+			job = {
+				'jobId': job_id,
+				'kind': kind,
+				'calc': params.get('calc'),
+				'status': 'queued',
+				'progress': None,
+				'submitted': now,
+				'updated': now,
+			}
+			self.save_job(job)
+			self.queued += 1
+			self.submitted += 1
+		self.executor.submit(self.run, job, run_job)
+		return job
+
+	def run(self, job, run_job):
+		with self.lock:
+			self.queued -= 1
+			self.running += 1
+		job = dict(job, status='running', started=time.time())
+		self.save_job(job)
+		try:
+			body, status_code = run_job(JobProgress(self, job))
+			if status_code >= 500:
+				raise JobError(body)
+			self.save_result(job['jobId'], body)
+			job.update({'status': 'done', 'resultSize': len(body)})
+			with self.lock:
+				self.completed += 1
+		except Exception as e:
+			logging.warning("Error running {} job {}: {}".format(job['kind'], job['jobId'], e))
+			job.update({'status': 'failed', 'error': "{}".format(e)})
+			with self.lock:
+				self.failed += 1
+		finally:
+			with self.lock:
+				self.running -= 1
+		job['finished'] = time.time()
+		self.save_job(job)
+
+	def get_job(self, job_id):
+		return self.store.get(self.job_key(job_id))
+
+	def get_result(self, job_id):
+		"""
+		The done job's response bytes, or None.
+		"""
+		encoded = self.store.get(self.result_key(job_id))
+		if encoded is None:
+			return None
+		return zlib.decompress(base64.b64decode(encoded))
+
+	def save_job(self, job):
+		job['updated'] = time.time()
+		self.store.set(self.job_key(job['jobId']), job, self.ttl)
+
+	def save_result(self, job_id, body):
+		# compressed (JSON compresses well), and base64 for the JSON cache entry:
+		encoded = base64.b64encode(zlib.compress(body, 6)).decode('ascii')
+		self.store.set(self.result_key(job_id), encoded, self.ttl)
+
+	def should_rerun(self, job):
+		if job['status'] == 'failed':
+			return True
+		if job['status'] == 'done':
+			return self.store.get(self.result_key(job['jobId'])) is None  # result expired or evicted
+		return time.time() - job.get('updated', 0) > self.stale_timeout
+
+	def make_job_id(self, kind, params):
+		return self.store.make_key('job', kind, params)[:32]
+
+	@staticmethod
+	def job_key(job_id):
+		return 'job-{}'.format(job_id)
+
+	@staticmethod
+	def result_key(job_id):
+		return 'job-result-{}'.format(job_id)
+
+	def stats(self):
+		return {
+			'queued': self.queued,
+			'running': self.running,
+			'submitted': self.submitted,
+			'deduplicated': self.deduplicated,
+			'completed': self.completed,
+			'failed': self.failed,
+		}
+
+
+
+class JobProgress(object):
+	"""
+	Progress callback for a running job, saving
+	at most once per interval (seconds).
+	"""
+	def __init__(self, manager, job, interval=1.0):
+		self.manager = manager
+		self.job = job
+		self.interval = interval
+		self.last_saved = 0
+
+	def __call__(self, done, total):
+		self.job['progress'] = {'done': done, 'total': total}
+		now = time.time()
+		if now - self.last_saved >= self.interval or done >= total:
+			self.last_saved = now
+			self.manager.save_job(self.job)
@@ -0,0 +1,109 @@
+"""
+JSON encoding for CTS REST responses and caches, with orjson
+if it's installed, otherwise the standard library json.
+"""
+
+import json
+import logging
+import os
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+
+use_orjson = orjson is not None and os.environ.get('CTS_ORJSON', 'True') == 'True'
+orjson_options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_SUBCLASS) if orjson is not None else 0  # e.g., {7.4: ...}, like json
+
+
+
+class RawJSON(object):
+	"""
+	Already encoded JSON (e.g., a cached progeny tree or static metaInfo),
+	spliced into an envelope by dumps_envelope as is.
+	"""
+	__slots__ = ('encoded',)
+
+	def __init__(self, encoded):
+		self.encoded = encoded.encode('utf-8') if isinstance(encoded, str) else encoded
+
+	@classmethod
+	def encode(cls, obj):
+		return cls(dumps(obj))
+
+	def decode(self):
+		return loads(self.encoded)
+
+	def with_fields(self, fields):
+		"""
+		Copy of an encoded object with fields (not RawJSON) added
+		at the end, e.g., a per-response timestamp.
+		"""
+		encoded_fields = dumps_envelope(fields)
+		if self.encoded == b'{}':
+			return RawJSON(encoded_fields)
+		return RawJSON(self.encoded[:-1] + b',' + encoded_fields[1:])
+
+
+
+def dumps(obj):
+	"""
+	Encodes obj as JSON bytes.
+	"""
+	if use_orjson:
+		try:
+			return orjson.dumps(obj, default=encode_subclass, option=orjson_options)
+		except TypeError as e:
+			# e.g., ints over 64 bits, which json handles:
+			logging.debug("orjson can't encode object, using json: {}".format(e))
+	return json.dumps(obj).encode('utf-8')
+
+
+def encode_subclass(obj):
+	"""
+	orjson default for subclasses of dict, list, str, and int, which are
+	encoded like json does. orjson would encode a QueryDict (request.POST)
+	as its lists of values, json (and so CTS REST) uses each key's last value.
+	"""
+	if isinstance(obj, dict):
+		return dict(obj.items())
+	if isinstance(obj, list):
+		return list(obj)
+	if isinstance(obj, str):
+		return str(obj)
+	if isinstance(obj, int):
+		return int(obj)
+	raise TypeError("Type is not JSON serializable: {}".format(type(obj).__name__))
+
+
+def dumps_str(obj):
+	"""
+	Encodes obj as a JSON string (e.g., for cache backends).
+	"""
+	if use_orjson:
+		return dumps(obj).decode('utf-8')
+	return json.dumps(obj)
+
+
+def loads(data):
+	"""
+	Decodes JSON str or bytes. Invalid JSON raises ValueError.
+	"""
+	if use_orjson:
+		return orjson.loads(data)
+	return json.loads(data)
+
+
+def dumps_envelope(fields):
+	"""
+	Encodes a response envelope, a dict (or (key, value) pairs) whose values
+	can be RawJSON, without decoding and encoding the RawJSON values again.
+	"""
+	items = fields.items() if isinstance(fields, dict) else fields
+	parts = []
+	for key, value in items:
+		encoded = value.encoded if isinstance(value, RawJSON) else dumps(value)
+		parts.append(dumps(str(key)) + b':' + encoded)
+	return b'{' + b','.join(parts) + b'}'
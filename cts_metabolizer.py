@@ -0,0 +1,271 @@
+"""
+Metabolizer progeny tree caching for CTS REST.
+
+Trees are the JSON objects from MetabolizerCalc().recursive: nodes
+with an 'id', 'data' (with 'smiles' and 'generation'), and 'children'.
+"""
+
+import copy
+import logging
+
+from . import cts_json
+from .cts_json import RawJSON
+
+
+
+class ProgenyTreeCache(object):
+	"""
+	Caches the deepest progeny tree built for a parent structure and
+	transformation library set. Shallower requests are pruned from the
+	cached tree, deeper requests extend it by expanding only its leaves.
+	"""
+	def __init__(self, cache, tree_builder=None):
+		self.cache = cache  # cts_cache.ResultCache
+		self.tree_builder = tree_builder  # ConcurrentTreeBuilder, optional
+		self.pruned = 0
+		self.extended = 0
+
+	def get_tree(self, key, structure, gen_limit, build_tree, population_limit=0, likely_limit=None, encoded=False):
+		"""
+		Gets the progeny tree for key, using build_tree(structure, gen_limit)
+		for the parts that aren't cached. build_tree can return the tree or its
+		JSON (from MetabolizerCalc().recursive). The limits are used by tree_builder.
+		With encoded, the tree is returned as cts_json.RawJSON, which isn't
+		decoded at all for a cached tree with the same generation limit.
+		"""
+		limits = {'population_limit': population_limit, 'likely_limit': likely_limit}
+		cached = self.cache.get(key)
+		if cached is not None and cached['generationLimit'] >= gen_limit:
+			self.pruned += 1
+			if encoded and cached['generationLimit'] == gen_limit and 'treeJSON' in cached:
+				return RawJSON(cached['treeJSON'])
+			tree = prune_tree(get_cached_tree(cached), gen_limit)
+			return RawJSON.encode(tree) if encoded else tree
+
+		build_subtree = lambda subtree_structure, subtree_gen_limit: decode_tree(build_tree(subtree_structure, subtree_gen_limit))
+		tree = None
+		if cached is not None:
+			try:
+				tree = self.extend_tree(get_cached_tree(cached), cached['generationLimit'], gen_limit, build_subtree, **limits)
+				self.extended += 1
+			except (KeyError, TypeError) as e:
+				logging.warning("Could not extend cached progeny tree, rebuilding: {}".format(e))
+		if tree is None and self.tree_builder is not None and gen_limit > 1:
+			tree = self.tree_builder.build(structure, gen_limit, build_subtree, **limits)
+		elif tree is None:
+			tree = build_tree(structure, gen_limit)
+
+		tree_json = self.save_tree(key, gen_limit, tree)  # encoded once, for the cache and response
+		if encoded:
+			return RawJSON(tree_json)
+		return decode_tree(tree)
+
+	def iter_tree(self, key, structure, gen_limit, build_tree, population_limit=0, likely_limit=None):
+		"""
+		Generator version of get_tree, for streaming: yields (tree,
+		generation) each time the tree's nodes down to generation are
+		done, building the generations that aren't cached one at a time
+		with tree_builder. Without one, the whole tree is yielded once.
+		"""
+		if self.tree_builder is None:
+			yield self.get_tree(key, structure, gen_limit, build_tree, population_limit, likely_limit), gen_limit
+			return
+
+		limits = {'population_limit': population_limit, 'likely_limit': likely_limit}
+		cached = self.cache.get(key)
+		tree = None
+		if cached is not None:
+			try:
+				tree = get_cached_tree(cached)
+			except (KeyError, TypeError) as e:
+				logging.warning("Could not read cached progeny tree, rebuilding: {}".format(e))
+		if tree is not None and cached['generationLimit'] >= gen_limit:
+			self.pruned += 1
+			yield prune_tree(tree, gen_limit), gen_limit
+			return
+
+		build_subtree = lambda subtree_structure, subtree_gen_limit: decode_tree(build_tree(subtree_structure, subtree_gen_limit))
+		if tree is not None:
+			self.extended += 1
+			yield tree, cached['generationLimit']
+			updates = self.tree_builder.iter_grow(tree, cached['generationLimit'], gen_limit, build_subtree, **limits)
+		else:
+			updates = self.tree_builder.iter_build(structure, gen_limit, build_subtree, **limits)
+		for tree, generation in updates:
+			yield tree, generation
+		self.save_tree(key, gen_limit, tree)
+
+	def save_tree(self, key, gen_limit, tree):
+		"""
+		Caches tree (or its JSON) and returns its JSON.
+		"""
+		tree_json = tree if isinstance(tree, str) else cts_json.dumps_str(tree)
+		self.cache.set(key, {'generationLimit': gen_limit, 'treeJSON': tree_json})
+		return tree_json
+
+	def extend_tree(self, tree, from_gen, to_gen, build_tree, population_limit=0, likely_limit=None):
+		"""
+		Grows tree from from_gen to to_gen generations by building
+		subtrees for the leaves in its last generation.
+		"""
+		if self.tree_builder is not None:
+			return self.tree_builder.grow(tree, from_gen, to_gen, build_tree, population_limit, likely_limit)
+		for leaf in get_generation(tree, from_gen):
+			subtree = build_tree(leaf['data']['smiles'], to_gen - from_gen)
+			graft_subtree(leaf, subtree, from_gen)
+		renumber_tree(tree)
+		return tree
+
+	def stats(self):
+		stats = self.cache.stats()
+		stats.update({'pruned': self.pruned, 'extended': self.extended})
+		return stats
+
+
+
+class ConcurrentTreeBuilder(object):
+	"""
+	Builds progeny trees one generation at a time, expanding every
+	node in a generation at once on a bounded thread pool. Products that
+	show up in more than one branch are only expanded once.
+	"""
+	def __init__(self, executor):
+		self.executor = executor
+
+	def build(self, structure, gen_limit, build_tree, population_limit=0, likely_limit=None):
+		"""
+		Same tree as build_tree(structure, gen_limit), built
+		from single-generation expansions.
+		"""
+		tree = build_tree(structure, 1)
+		return self.grow(tree, 1, gen_limit, build_tree, population_limit, likely_limit)
+
+	def iter_build(self, structure, gen_limit, build_tree, population_limit=0, likely_limit=None):
+		"""
+		Generator version of build, see iter_grow.
+		"""
+		tree = build_tree(structure, 1)
+		yield tree, 1
+		for tree, generation in self.iter_grow(tree, 1, gen_limit, build_tree, population_limit, likely_limit):
+			yield tree, generation
+
+	def grow(self, tree, from_gen, to_gen, build_tree, population_limit=0, likely_limit=None):
+		"""
+		Expands tree's nodes generation by generation, from from_gen up
+		to to_gen generations. Stops once the tree has population_limit
+		nodes (0 for no limit), and skips nodes with a numeric likelihood
+		below likely_limit.
+		"""
+		for tree, _ in self.iter_grow(tree, from_gen, to_gen, build_tree, population_limit, likely_limit):
+			pass
+		return tree
+
+	def iter_grow(self, tree, from_gen, to_gen, build_tree, population_limit=0, likely_limit=None):
+		"""
+		Generator version of grow, yielding (tree, generation) once the
+		nodes down to generation are done. Node ids are only renumbered
+		(depth-first) after the last generation.
+		"""
+		expansions = {}  # smiles: future of its single-generation subtree
+		num_nodes = count_nodes(tree)
+		for generation in range(from_gen, to_gen):
+			if population_limit and num_nodes >= population_limit:
+				logging.info("Progeny tree reached population limit at generation {}".format(generation))
+				break
+			nodes = [node for node in get_generation(tree, generation) if should_expand(node, likely_limit)]
+			for node in nodes:
+				smiles = node['data']['smiles']
+				if not smiles in expansions:
+					expansions[smiles] = self.executor.submit(build_tree, smiles, 1)
+			for node in nodes:
+				subtree = copy.deepcopy(expansions[node['data']['smiles']].result())
+				graft_subtree(node, subtree, generation)
+				num_nodes += len(node['children'])
+			yield tree, generation + 1
+			if not any(node['children'] for node in nodes):
+				break
+		renumber_tree(tree)
+
+
+
+def decode_tree(tree):
+	if isinstance(tree, (str, bytes)):
+		return cts_json.loads(tree)
+	return tree
+
+
+def get_cached_tree(cached):
+	"""
+	Cache entries have the tree's JSON ('treeJSON'),
+	or the tree itself in older entries.
+	"""
+	if 'treeJSON' in cached:
+		return cts_json.loads(cached['treeJSON'])
+	return cached['tree']
+
+
+def should_expand(node, likely_limit=None):
+	likelihood = node.get('data', {}).get('likelihood')
+	if likely_limit is not None and isinstance(likelihood, (int, float)) and not isinstance(likelihood, bool):
+		return likelihood >= likely_limit
+	return True
+
+
+def count_nodes(tree):
+	num_nodes, stack = 0, [tree]
+	while stack:
+		node = stack.pop()
+		num_nodes += 1
+		stack.extend(node.get('children', []))
+	return num_nodes
+
+
+def get_generation(tree, generation):
+	"""
+	Returns the nodes that are generation levels below the root.
+	"""
+	level = [tree]
+	for _ in range(generation):
+		level = [child for node in level for child in node.get('children', [])]
+	return level
+
+
+def prune_tree(tree, gen_limit):
+	"""
+	Removes nodes deeper than gen_limit and renumbers the rest.
+	"""
+	for node in get_generation(tree, gen_limit):
+		node['children'] = []
+	renumber_tree(tree)
+	return tree
+
+
+def graft_subtree(leaf, subtree, generation_offset):
+	"""
+	Adds subtree's children (the leaf's products) to leaf, shifting
+	their generations to start after the leaf's.
+	"""
+	stack = list(subtree.get('children', []))
+	while stack:
+		node = stack.pop()
+		node_data = node.get('data')
+		if isinstance(node_data, dict) and isinstance(node_data.get('generation'), int):
+			node_data['generation'] += generation_offset
+		stack.extend(node.get('children', []))
+	leaf['children'] = subtree.get('children', [])
+
+
+def renumber_tree(tree):
+	"""
+	Gives nodes consecutive ids in depth-first order, starting
+	from the root's id, as MetabolizerCalc().recursive numbers them.
+	"""
+	next_id = tree.get('id', 1)
+	stack = [tree]
+	while stack:
+		node = stack.pop()
+		if 'id' in node:
+			node['id'] = next_id
+			next_id += 1
+		stack.extend(reversed(node.get('children', [])))
+	return tree
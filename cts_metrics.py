@@ -0,0 +1,265 @@
+"""
+In-process request metrics for CTS REST, rendered in the
+Prometheus text exposition format.
+
+Each worker process keeps its own metrics, so a scraper sees
+the process that served the metrics request.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+from . import cts_context
+
+
+
+metrics_enabled = os.environ.get('CTS_METRICS', 'True') == 'True'
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+max_label_sets = 2000  # per metric, later label sets are counted as 'other'
+
+
+
+class Metric(object):
+	"""
+	Base for metrics with labels. Values are kept by label
+	values tuple, so labels are passed in labelnames order.
+	"""
+	metric_type = 'untyped'
+
+	def __init__(self, name, description, labelnames=()):
+		self.name = name
+		self.description = description
+		self.labelnames = tuple(labelnames)
+		self.lock = threading.Lock()
+		self.values = {}  # label values: value
+
+	def get_labels(self, labels):
+		labels = tuple('' if label is None else str(label)[:100] for label in labels)
+		if not labels in self.values and len(self.values) >= max_label_sets:
+			return ('other',) * len(self.labelnames)
+		return labels
+
+	def render(self):
+		lines = [
+			"# HELP {} {}".format(self.name, self.description),
+			"# TYPE {} {}".format(self.name, self.metric_type),
+		]
+		with self.lock:
+			values = list(self.values.items())
+		for labels, value in sorted(values):
+			lines.extend(self.render_value(labels, value))
+		return lines
+
+	def render_value(self, labels, value):
+		return ["{}{} {}".format(self.name, format_labels(self.labelnames, labels), format_value(value))]
+
+
+
+class Counter(Metric):
+	metric_type = 'counter'
+
+	def inc(self, *labels, amount=1):
+		labels = self.get_labels(labels)
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+
+
+class Gauge(Metric):
+	metric_type = 'gauge'
+
+	def inc(self, *labels, amount=1):
+		labels = self.get_labels(labels)
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+	def dec(self, *labels, amount=1):
+		self.inc(*labels, amount=-amount)
+
+
+
+class Histogram(Metric):
+	"""
+	Cumulative histogram of observed values (e.g., seconds),
+	with a count, sum, and count per bucket upper bound.
+	"""
+	metric_type = 'histogram'
+
+	def __init__(self, name, description, labelnames=(), buckets=default_buckets):
+		super(Histogram, self).__init__(name, description, labelnames)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, *labels):
+		labels = self.get_labels(labels)
+		bucket = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			observations = self.values.get(labels)
+			if observations is None:
+				observations = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+			observations[0][bucket] += 1
+			observations[1] += value
+
+	def render_value(self, labels, value):
+		bucket_counts, total = value
+		lines, count = [], 0
+		for upper_bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+			count += bucket_count
+			bucket_labels = format_labels(self.labelnames + ('le',), labels + (format_value(upper_bound),))
+			lines.append("{}_bucket{} {}".format(self.name, bucket_labels, count))
+		labels = format_labels(self.labelnames, labels)
+		lines.append("{}_sum{} {}".format(self.name, labels, format_value(total)))
+		lines.append("{}_count{} {}".format(self.name, labels, count))
+		return lines
+
+
+
+class MetricsRegistry(object):
+	"""
+	Holds the metrics and the stats functions (e.g., a cache's
+	stats()) whose numeric values are exported as gauges.
+	"""
+	def __init__(self):
+		self.metrics = []
+		self.stats_funcs = []  # (prefix, stats function)
+
+	def counter(self, name, description, labelnames=()):
+		return self.add(Counter(name, description, labelnames))
+
+	def gauge(self, name, description, labelnames=()):
+		return self.add(Gauge(name, description, labelnames))
+
+	def histogram(self, name, description, labelnames=(), buckets=default_buckets):
+		return self.add(Histogram(name, description, labelnames, buckets))
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def add_stats(self, prefix, stats_func):
+		self.stats_funcs.append((prefix, stats_func))
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		for prefix, stats_func in self.stats_funcs:
+			try:
+				stats = stats_func()
+			except Exception as e:
+				logging.warning("Error getting {} stats: {}".format(prefix, e))
+				continue
+			for key, value in sorted(stats.items()):
+				if isinstance(value, (int, float)):
+					name = "{}_{}".format(prefix, key)
+					lines.append("# TYPE {} gauge".format(name))
+					lines.append("{} {}".format(name, format_value(value)))
+		return "\n".join(lines) + "\n"
+
+
+
+class RequestTracker(object):
+	"""
+	Times a request to an entry point (e.g., runCalc) and tracks
+	it as in flight. Exceptions, and requests marked with failed()
+	(e.g., for error responses), are counted as errors.
+	"""
+	__slots__ = ('entry', 'calc', 'prop', 'start', 'is_error')
+
+	def __init__(self, entry, calc=None, prop=None):
+		self.entry = entry
+		self.calc = calc
+		self.prop = prop
+		self.is_error = False
+
+	def __enter__(self):
+		context = cts_context.get_context()
+		if context is not None:
+			context.annotate(self.entry, self.calc, self.prop)
+		if metrics_enabled:
+			requests_in_flight.inc(self.entry, self.calc)
+			self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if not metrics_enabled:
+			return False
+		request_seconds.observe(time.perf_counter() - self.start, self.entry, self.calc, self.prop)
+		requests_in_flight.dec(self.entry, self.calc)
+		if exc_type is not None or self.is_error:
+			request_errors.inc(self.entry, self.calc, self.prop)
+		return False
+
+	def failed(self):
+		self.is_error = True
+		context = cts_context.get_context()
+		if context is not None:
+			context.is_error = True
+
+
+
+class StageTimer(object):
+	"""
+	Times a stage of a request (e.g., filter, dsstox, mongo,
+	calculator, json), also added as a span to the request's
+	cts_context.RequestContext.
+	"""
+	__slots__ = ('stage', 'calc', 'prop', 'start')
+
+	def __init__(self, stage, calc=None, prop=None):
+		self.stage = stage
+		self.calc = calc
+		self.prop = prop
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		seconds = time.perf_counter() - self.start
+		if metrics_enabled:
+			stage_seconds.observe(seconds, self.stage, self.calc, self.prop)
+		cts_context.add_span(self.stage, self.calc, self.start, seconds)
+		return False
+
+
+
+def format_labels(labelnames, labels):
+	if not labelnames:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(name, escape_label(value)) for name, value in zip(labelnames, labels)) + '}'
+
+
+def escape_label(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+	if isinstance(value, str):
+		return value
+	if isinstance(value, bool):
+		return str(int(value))
+	return repr(value)
+
+
+def track_request(entry, calc=None, prop=None):
+	return RequestTracker(entry, calc, prop)
+
+
+def time_stage(stage, calc=None, prop=None):
+	return StageTimer(stage, calc, prop)
+
+
+
+registry = MetricsRegistry()
+request_seconds = registry.histogram(
+	'cts_request_seconds', "Time to handle CTS REST requests.", ('entry', 'calc', 'prop'))
+stage_seconds = registry.histogram(
+	'cts_stage_seconds', "Time spent in each stage of CTS REST requests.", ('stage', 'calc', 'prop'))
+request_errors = registry.counter(
+	'cts_request_errors_total', "CTS REST requests that raised or returned an error.", ('entry', 'calc', 'prop'))
+requests_in_flight = registry.gauge(
+	'cts_requests_in_flight', "CTS REST requests being handled.", ('entry', 'calc'))
@@ -0,0 +1,159 @@
+"""
+Bulk OPERA p-chem lookups for CTS REST batch runs.
+"""
+
+import logging
+
+
+
+class OperaBulkResolver(object):
+	"""
+	Resolves OPERA p-chem data for many chemicals and props at once:
+	DSSTox IDs are resolved once per unique chemical, DTXCIDs and
+	p-chem documents are fetched with one $in query each, and only the
+	misses are run through the OPERA model, in one run per prop.
+	"""
+	def __init__(self, db_pool, chem_info_obj, opera_calc_class, executor):
+		self.db_pool = db_pool
+		self.chem_info_obj = chem_info_obj
+		self.opera_calc_class = opera_calc_class
+		self.executor = executor
+
+	def resolve(self, cells):
+		"""
+		Gets p-chem data for a list of request dicts, each with a filtered
+		'chemical', a 'prop', and optional 'ph'. Returns the p-chem data
+		for each cell, in the same order as cells.
+		"""
+		results = [None] * len(cells)
+		opera_calc = self.opera_calc_class()
+
+		if self.db_pool.get_handler() is not None:
+			try:
+				documents = self.find_documents(cells)
+			except Exception as e:
+				logging.warning("Error requesting bulk opera data: {}".format(e))
+				documents = {}
+			for index, cell in enumerate(cells):
+				db_results = documents.get(self.document_key(cell))
+				if db_results:
+					db_results = dict(db_results)
+					del db_results['_id']
+					pchem_data = {'status': True, 'request_post': cell, 'data': db_results}
+					pchem_data['data'].update(cell)
+					pchem_data['data'] = opera_calc.convert_units_for_cts(cell['prop'], pchem_data['data'])
+					results[index] = pchem_data
+
+		misses = [index for index, result in enumerate(results) if result is None]
+		if misses:
+			logging.info("Running OPERA model for {} p-chem cells.".format(len(misses)))
+			for index, pchem_data in self.run_model(opera_calc, [cells[index] for index in misses]):
+				results[misses[index]] = pchem_data
+		return results
+
+	def find_documents(self, cells):
+		"""
+		Returns p-chem documents for cells, by (chemical, prop, ph).
+		"""
+		chemicals = list(set(cell['chemical'] for cell in cells))
+		dtxsids = dict(zip(chemicals, self.executor.map(self.get_dtxsid, chemicals)))
+
+		valid_dtxsids = set(dtxsid for dtxsid in dtxsids.values() if dtxsid and dtxsid != "N/A")
+		if not valid_dtxsids:
+			return {}
+		dtxcids = {}
+		for dtxcid_result in self.db_pool.find_dtxcid_documents(valid_dtxsids) or []:
+			dtxcids[dtxcid_result.get('DTXSID')] = dtxcid_result.get('DTXCID')
+		if not dtxcids:
+			return {}
+
+		props = list(set(cell['prop'] for cell in cells if cell['prop'] != 'kow_wph'))
+		phs = list(set(float(cell.get('ph', 7.4)) for cell in cells if cell['prop'] == 'kow_wph'))
+		prop_queries = []
+		if props:
+			prop_queries.append({'prop': {'$in': props}})
+		if phs:
+			prop_queries.append({'prop': 'kow_wph', 'ph': {'$in': phs}})
+		db_results = self.db_pool.find_pchem_documents({
+			'dsstoxSubstanceId': {'$in': list(dtxcids.values())},  # TODO: change key to DTXCID
+			'$or': prop_queries
+		}) or []
+
+		chemicals_by_dtxcid = {}
+		for chemical, dtxsid in dtxsids.items():
+			if dtxcids.get(dtxsid):
+				chemicals_by_dtxcid.setdefault(dtxcids[dtxsid], []).append(chemical)
+
+		documents = {}
+		for db_result in db_results:
+			ph = float(db_result['ph']) if db_result.get('prop') == 'kow_wph' else None
+			for chemical in chemicals_by_dtxcid.get(db_result.get('dsstoxSubstanceId'), []):
+				documents[(chemical, db_result.get('prop'), ph)] = db_result
+		return documents
+
+	def get_dtxsid(self, chemical):
+		try:
+			dsstox_result = self.chem_info_obj.get_cheminfo({'chemical': chemical}, only_dsstox=True)
+			return dsstox_result.get('dsstoxSubstanceId')
+		except Exception as e:
+			logging.warning("Error getting DSSTox ID for {}: {}".format(chemical, e))
+			return None
+
+	def run_model(self, opera_calc, cells):
+		"""
+		Runs the OPERA model once per prop (and pH) for all the
+		cells' chemicals. Chemicals that aren't in the multi-chemical
+		response are run one at a time. Yields (index, pchem_data)
+		for cells.
+		"""
+		groups = {}
+		for index, cell in enumerate(cells):
+			groups.setdefault(self.document_key(cell)[1:], []).append(index)
+
+		for indexes in groups.values():
+			request_dict = dict(cells[indexes[0]])
+			chemicals = [cells[index]['chemical'] for index in indexes]
+			responses = self.split_model_response(self.request_model(opera_calc, request_dict, chemicals), chemicals)
+			for index, chemical, pchem_data in zip(indexes, chemicals, responses):
+				if pchem_data is None:
+					logging.warning("No OPERA data for {} in multi-chemical response, running it alone.".format(chemical))
+					pchem_data = self.request_model(opera_calc, request_dict, [chemical])
+				yield index, pchem_data
+
+	def request_model(self, opera_calc, request_dict, chemicals):
+		request_dict = dict(request_dict, chemical=chemicals)
+		try:
+			return opera_calc.data_request_handler(request_dict)
+		except Exception as e:
+			logging.warning("Error running OPERA model: {}".format(e))
+			return {'status': False, 'request_post': request_dict, 'data': "Cannot reach OPERA"}
+
+	def split_model_response(self, response, chemicals):
+		"""
+		Splits a multi-chemical OPERA response into one response per
+		chemical, using the 'chemical' key of each data object. Chemicals
+		with no data object get None. Error responses are shared by
+		every chemical (they aren't cached).
+		"""
+		if len(chemicals) == 1:
+			return [response]
+		if not isinstance(response, dict) or response.get('status') is False or response.get('valid') is False:
+			return [response] * len(chemicals)
+		data = response.get('data')
+		data_by_chemical = {}
+		for data_obj in data if isinstance(data, list) else []:
+			if isinstance(data_obj, dict) and data_obj.get('chemical') in chemicals:
+				data_by_chemical.setdefault(data_obj['chemical'], []).append(data_obj)
+		responses = []
+		for chemical in chemicals:
+			chemical_data = data_by_chemical.get(chemical)
+			if not chemical_data:
+				responses.append(None)
+			else:
+				responses.append(dict(response, data=chemical_data[0] if len(chemical_data) == 1 else chemical_data))
+		return responses
+
+	@staticmethod
+	def document_key(cell):
+		ph = float(cell.get('ph', 7.4)) if cell['prop'] == 'kow_wph' else None
+		return (cell['chemical'], cell['prop'], ph)
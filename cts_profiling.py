@@ -0,0 +1,319 @@
+"""
+Opt-in request profiling for the CTS REST views.
+
+With CTS_PROFILING=True, requests with an X-CTS-Profile header (and a
+CTS_PROFILE_SAMPLE_RATE fraction of the rest) are profiled:
+
+	sample (default): a background thread samples the request thread's
+		stack, counting samples as wall time, and as CPU time when the
+		thread's CPU clock advanced. Saved as collapsed stacks
+		(flamegraph.pl, speedscope, etc.).
+	cprofile: cProfile with every function call, saved as a .prof
+		file (pstats, snakeviz, etc.). Slower, so header only.
+
+Each profile also has a JSON summary with wall and CPU time and the top
+functions. Only the view's own thread is profiled, not work it hands
+to thread pools, and streamed responses only until the view returns.
+"""
+
+import collections
+import cProfile
+import functools
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+
+
+profiling_enabled = os.environ.get('CTS_PROFILING', 'False') == 'True'
+profile_dir = os.environ.get('CTS_PROFILE_DIR', '/tmp/cts_profiles')
+profile_sample_rate = float(os.environ.get('CTS_PROFILE_SAMPLE_RATE', 0))  # fraction of requests
+profile_slow_ms = float(os.environ.get('CTS_PROFILE_SLOW_MS', 1000))  # sampled requests are saved if slower
+profile_interval = float(os.environ.get('CTS_PROFILE_INTERVAL_MS', 5)) / 1000.0
+profile_max_files = int(os.environ.get('CTS_PROFILE_MAX_FILES', 200))  # summaries kept, oldest are removed
+profile_header = 'HTTP_X_CTS_PROFILE'
+profile_modes = ('sample', 'cprofile')
+max_stack_depth = 128
+
+
+
+class StackSampler(object):
+	"""
+	Samples the stacks of profiled threads from one background
+	thread, which only runs while there are profiles.
+	"""
+	def __init__(self, interval):
+		self.interval = interval
+		self.profiles = {}  # thread id: SampledProfile
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def start(self, profile):
+		with self.lock:
+			self.profiles[profile.thread_id] = profile
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, name='cts-profile-sampler', daemon=True)
+				self.thread.start()
+
+	def stop(self, profile):
+		with self.lock:
+			self.profiles.pop(profile.thread_id, None)
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			with self.lock:
+				profiles = list(self.profiles.values())
+				if not profiles:
+					self.thread = None
+					return
+			frames = sys._current_frames()
+			for profile in profiles:
+				frame = frames.get(profile.thread_id)
+				if frame is not None:
+					profile.add_sample(frame)
+
+
+
+class SampledProfile(object):
+	"""
+	Stack samples for one request, by collapsed stack
+	(e.g., "views.py:runCalc;cts_rest.py:runCalc").
+	"""
+	mode = 'sample'
+
+	def __init__(self, thread_id):
+		self.thread_id = thread_id
+		self.wall_stacks = collections.Counter()
+		self.cpu_stacks = collections.Counter()
+		try:
+			self.cpu_clock = time.pthread_getcpuclockid(thread_id)
+			self.last_cpu = time.clock_gettime(self.cpu_clock)
+		except (AttributeError, OSError):
+			self.cpu_clock = None  # no per-thread CPU clock, wall samples only
+		self.last_sample = time.perf_counter()
+
+	def add_sample(self, frame):
+		stack = collapse_stack(frame)
+		self.wall_stacks[stack] += 1
+		now = time.perf_counter()
+		if self.cpu_clock is not None:
+			cpu = time.clock_gettime(self.cpu_clock)
+			if cpu - self.last_cpu >= (now - self.last_sample) / 2:  # on CPU for most of the interval
+				self.cpu_stacks[stack] += 1
+			self.last_cpu = cpu
+		self.last_sample = now
+
+	def save(self, path_prefix):
+		write_collapsed(path_prefix + '.wall.collapsed', self.wall_stacks)
+		if self.cpu_clock is not None:
+			write_collapsed(path_prefix + '.cpu.collapsed', self.cpu_stacks)
+
+	def top_functions(self, count=20):
+		"""
+		Functions by wall samples (self time, i.e., on top of the stack).
+		"""
+		wall, cpu = collections.Counter(), collections.Counter()
+		for stacks, counter in ((self.wall_stacks, wall), (self.cpu_stacks, cpu)):
+			for stack, samples in stacks.items():
+				counter[stack.rsplit(';', 1)[-1]] += samples
+		return [
+			{'function': function, 'wallSamples': samples, 'cpuSamples': cpu[function]}
+			for function, samples in wall.most_common(count)
+		]
+
+
+
+class DeterministicProfile(object):
+	"""
+	cProfile of one request.
+	"""
+	mode = 'cprofile'
+
+	def __init__(self):
+		self.profiler = cProfile.Profile()
+
+	def start(self):
+		self.profiler.enable()
+
+	def stop(self):
+		self.profiler.disable()
+
+	def save(self, path_prefix):
+		self.profiler.dump_stats(path_prefix + '.prof')
+
+	def top_functions(self, count=20):
+		"""
+		Functions by cumulative time, seconds.
+		"""
+		self.profiler.create_stats()
+		stats = sorted(self.profiler.stats.items(), key=lambda item: item[1][3], reverse=True)
+		return [
+			{
+				'function': format_function(filename, line, name),
+				'calls': call_count,
+				'selfSeconds': round(self_time, 6),
+				'cumulativeSeconds': round(cumulative_time, 6),
+			}
+			for (filename, line, name), (_, call_count, self_time, cumulative_time, _) in stats[:count]
+		]
+
+
+
+sampler = StackSampler(profile_interval)
+
+
+
+def get_profile_mode(request):
+	"""
+	The profile mode for request, or None if it's not profiled.
+	"""
+	if not profiling_enabled:
+		return None
+	header = request.META.get(profile_header)
+	if header:
+		return header if header in profile_modes else 'sample'
+	if profile_sample_rate > 0 and random.random() < profile_sample_rate:
+		return 'sample'
+	return None
+
+
+def profile_view(view):
+	"""
+	Decorator for (sync) views, profiling the requests
+	get_profile_mode picks.
+	"""
+	@functools.wraps(view)
+	def profiled_view(request, *args, **kwargs):
+		mode = get_profile_mode(request)
+		if mode is None:
+			return view(request, *args, **kwargs)
+		return run_profiled(view, mode, request, *args, **kwargs)
+	return profiled_view
+
+
+def run_profiled(view, mode, request, *args, **kwargs):
+	requested = bool(request.META.get(profile_header))
+	profile = None
+	if mode == 'cprofile':
+		profile = DeterministicProfile()
+		try:
+			profile.start()
+		except ValueError as e:
+			logging.warning("cProfile unavailable, sampling instead: {}".format(e))  # another profiler is active
+			profile = None
+	if profile is None:
+		profile = SampledProfile(threading.get_ident())
+		sampler.start(profile)
+
+	start_wall, start_cpu = time.perf_counter(), time.thread_time()
+	try:
+		response = view(request, *args, **kwargs)
+	finally:
+		wall_ms = (time.perf_counter() - start_wall) * 1000
+		cpu_ms = (time.thread_time() - start_cpu) * 1000
+		if profile.mode == 'cprofile':
+			profile.stop()
+		else:
+			sampler.stop(profile)
+
+	if requested or wall_ms >= profile_slow_ms:
+		profile_id = save_profile(profile, request, response, wall_ms, cpu_ms)
+		if profile_id is not None and requested:
+			response['X-CTS-Profile-Id'] = profile_id
+	return response
+
+
+def save_profile(profile, request, response, wall_ms, cpu_ms):
+	"""
+	Saves profile and its JSON summary to profile_dir,
+	returning the profile ID (the files' name).
+	"""
+	now = time.time()
+	# microseconds, so IDs sort by time for prune_profiles and list_profiles:
+	profile_id = "{}{:06d}-{}-{:.0f}ms".format(
+		time.strftime('%Y%m%d%H%M%S', time.localtime(now)), int(now % 1 * 1000000), '{:06x}'.format(random.getrandbits(24)), wall_ms)
+	path_prefix = os.path.join(profile_dir, profile_id)
+	summary = {
+		'id': profile_id,
+		'path': request.path,
+		'method': request.method,
+		'status': response.status_code,
+		'mode': profile.mode,
+		'time': now,
+		'wallMs': round(wall_ms, 3),
+		'cpuMs': round(cpu_ms, 3),
+		'topFunctions': profile.top_functions(),
+	}
+	try:
+		os.makedirs(profile_dir, exist_ok=True)
+		profile.save(path_prefix)
+		with open(path_prefix + '.json', 'w') as summary_file:
+			json.dump(summary, summary_file)
+		prune_profiles()
+	except (OSError, TypeError, ValueError) as e:
+		logging.warning("Error saving profile {}: {}".format(profile_id, e))
+		return None
+	return profile_id
+
+
+def prune_profiles():
+	"""
+	Removes the oldest profiles past profile_max_files.
+	"""
+	summary_paths = sorted(glob.glob(os.path.join(profile_dir, '*.json')))
+	for summary_path in summary_paths[:max(len(summary_paths) - profile_max_files, 0)]:
+		for path in glob.glob(summary_path[:-len('.json')] + '.*'):
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+def list_profiles(min_ms=0, limit=50):
+	"""
+	Summaries of the most recent saved profiles
+	at least min_ms long, newest first.
+	"""
+	profiles = []
+	for summary_path in sorted(glob.glob(os.path.join(profile_dir, '*.json')), reverse=True):
+		try:
+			with open(summary_path, 'r') as summary_file:
+				summary = json.load(summary_file)
+		except (OSError, ValueError):
+			continue
+		if summary.get('wallMs', 0) < min_ms:
+			continue
+		summary['files'] = sorted(os.path.basename(path) for path in glob.glob(summary_path[:-len('.json')] + '.*'))
+		profiles.append(summary)
+		if len(profiles) >= limit:
+			break
+	return profiles
+
+
+def collapse_stack(frame):
+	"""
+	Frame's stack, root first, in the collapsed stack
+	format (functions separated by ';').
+	"""
+	functions = []
+	while frame is not None and len(functions) < max_stack_depth:
+		code = frame.f_code
+		functions.append(format_function(code.co_filename, code.co_firstlineno, code.co_name))
+		frame = frame.f_back
+	return ';'.join(reversed(functions))
+
+
+def format_function(filename, line, name):
+	return "{}:{}:{}".format(os.path.basename(filename), line, name).replace(';', ',').replace(' ', '_')
+
+
+def write_collapsed(path, stacks):
+	with open(path, 'w') as collapsed_file:
+		for stack, samples in stacks.most_common():
+			collapsed_file.write("{} {}\n".format(stack, samples))
@@ -0,0 +1,139 @@
+"""
+Registry of CTS calculators, for dispatching REST
+requests by calc name.
+"""
+
+import logging
+import threading
+
+from .cts_json import RawJSON
+
+
+
+class CalcHandler(object):
+	"""
+	Requests p-chem data from a cts_calcs calculator (calc_class),
+	which is built once per thread and reused across requests. The
+	REST metadata object (rest_class, e.g., Chemaxon_CTS_REST) is
+	built once, it's the calculator itself if there's no rest_class.
+
+	Subclasses customize requests with the pre_request, request,
+	and post_request hooks.
+	"""
+	def __init__(self, name, calc_class=None, rest_class=None, pchem=True):
+		self.name = name
+		self.calc_class = calc_class
+		self.rest_class = rest_class
+		self.pchem = pchem  # False for non p-chem endpoints (e.g., cts, metabolizer)
+		self.registry = None  # set by CalcRegistry.register
+		self.rest_obj = None
+		self.meta_info_json = None
+		self.timestamp_keys = ()  # meta_info keys with a per-response timestamp
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+	def get_calc(self):
+		"""
+		Calculator instance for the current thread.
+		"""
+		calc_obj = getattr(self.local, 'calc_obj', None)
+		if calc_obj is None:
+			calc_obj = self.local.calc_obj = self.calc_class()
+		return calc_obj
+
+	def get_rest_obj(self):
+		"""
+		REST metadata object (with meta_info), built once
+		per process (don't modify it).
+		"""
+		if self.rest_obj is None:
+			with self.lock:
+				if self.rest_obj is None:
+					self.rest_obj = (self.rest_class or self.calc_class)()
+		return self.rest_obj
+
+	def get_meta_info_json(self, timestamp=None):
+		"""
+		The REST object's meta_info with its values pre-encoded
+		(RawJSON), built once for splicing into responses. Values
+		with a 'timestamp' (e.g., metaInfo) get timestamp spliced in.
+		"""
+		if self.meta_info_json is None:
+			meta_info = self.get_rest_obj().meta_info
+			timestamp_keys = tuple(key for key, value in meta_info.items() if isinstance(value, dict) and 'timestamp' in value)
+			self.timestamp_keys = timestamp_keys  # set first, meta_info_json is checked without the lock
+			self.meta_info_json = {
+				key: RawJSON.encode({k: v for k, v in value.items() if k != 'timestamp'} if key in timestamp_keys else value)
+				for key, value in meta_info.items()
+			}
+		if not self.timestamp_keys:
+			return self.meta_info_json
+		meta_info_json = dict(self.meta_info_json)
+		for key in self.timestamp_keys:
+			meta_info_json[key] = meta_info_json[key].with_fields({'timestamp': timestamp})
+		return meta_info_json
+
+	def run(self, request_dict):
+		"""
+		Gets p-chem data for a single chemical and prop.
+		"""
+		request_dict = self.pre_request(request_dict)
+		pchem_data = self.request(request_dict)
+		return self.post_request(pchem_data, request_dict)
+
+	def pre_request(self, request_dict):
+		return request_dict
+
+	def request(self, request_dict):
+		return self.registry.request_calculator(
+			self.name, self.get_calc().data_request_handler, request_dict, prop=request_dict.get('prop'))
+
+	def post_request(self, pchem_data, request_dict):
+		return pchem_data
+
+
+
+class CalcRegistry(object):
+	"""
+	CalcHandlers by calc name. request_calculator(calc, func, *args, prop=None)
+	makes the calculator server requests (e.g., cts_rest.requestCalculator).
+	"""
+	def __init__(self, request_calculator):
+		self.request_calculator = request_calculator
+		self.handlers = {}  # calc name or alias: CalcHandler
+		self.lock = threading.Lock()
+
+	def register(self, handler, aliases=()):
+		"""
+		Adds handler under its name and aliases (e.g., 'test' for 'testws'),
+		replacing any handler already registered for them.
+		"""
+		handler.registry = self
+		with self.lock:
+			for name in (handler.name,) + tuple(aliases):
+				if name in self.handlers:
+					logging.warning("Replacing calc handler for {}".format(name))
+				self.handlers[name] = handler
+		return handler
+
+	def get(self, calc):
+		return self.handlers.get(calc)
+
+	def get_name(self, calc):
+		"""
+		The registered name for calc or its alias (e.g., 'testws'
+		for 'test'), for keying per-calc state. Unknown calcs are
+		returned as is.
+		"""
+		handler = self.handlers.get(calc)
+		return handler.name if handler is not None else calc
+
+	def names(self, pchem=None):
+		"""
+		Registered calc names (without aliases), optionally
+		only p-chem calcs (pchem=True) or the rest (pchem=False).
+		"""
+		return [
+			name for name, handler in self.handlers.items()
+			if name == handler.name and (pchem is None or handler.pchem == pchem)
+		]
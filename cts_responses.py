@@ -0,0 +1,141 @@
+"""
+Pre-serialized HTTP responses with ETag and conditional GET support.
+"""
+
+import hashlib
+import gzip
+import json
+import logging
+import os
+import threading
+
+from django.http import HttpResponse, HttpResponseNotModified
+
+from . import cts_json
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+
+
+metadata_max_age = int(os.environ.get('CTS_METADATA_MAX_AGE', 300))  # seconds
+
+
+
+class PreparedResponse(object):
+	"""
+	Response body serialized once, with an ETag from its content
+	(or from etag_body, e.g., the body without volatile values).
+	Each response() is a copy of the same bytes. With compress,
+	gzip (and brotli, if installed) bodies are prepared too and
+	picked by the request's Accept-Encoding.
+	"""
+	def __init__(self, body, content_type='application/json', max_age=None, compress=False, etag_body=None):
+		self.body = body
+		self.content_type = content_type
+		self.max_age = metadata_max_age if max_age is None else max_age
+		self.etag = '"{}"'.format(hashlib.sha1(body if etag_body is None else etag_body).hexdigest())
+		self.encoded_bodies = {}  # content-encoding: body
+		if compress:
+			if brotli is not None:
+				self.encoded_bodies['br'] = brotli.compress(body)
+			self.encoded_bodies['gzip'] = gzip.compress(body, compresslevel=9)
+
+	def response(self, request=None):
+		"""
+		Returns an HttpResponse, or a 304 if the request's
+		If-None-Match matches the ETag.
+		"""
+		encoding = self.get_encoding(request)
+		etag = self.etag if encoding is None else '{}-{}"'.format(self.etag[:-1], encoding)
+		if request is not None and etag_matches(request, etag):
+			response = HttpResponseNotModified()
+		elif encoding is None:
+			response = HttpResponse(self.body, content_type=self.content_type)
+		else:
+			response = HttpResponse(self.encoded_bodies[encoding], content_type=self.content_type)
+			response['Content-Encoding'] = encoding
+		if self.encoded_bodies:
+			response['Vary'] = 'Accept-Encoding'
+		response['ETag'] = etag
+		response['Cache-Control'] = 'public, max-age={}'.format(self.max_age)
+		return response
+
+	def get_encoding(self, request):
+		if request is None or not self.encoded_bodies:
+			return None
+		accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+		accepted = [item.split(';')[0].strip() for item in accept_encoding.split(',')]
+		for encoding in ('br', 'gzip'):
+			if encoding in self.encoded_bodies and encoding in accepted:
+				return encoding
+		return None
+
+
+
+class JSONFileAsset(object):
+	"""
+	JSON file (e.g., swagger.json) parsed and prepared once,
+	and prepared again only when the file's mtime changes.
+	"""
+	def __init__(self, path, validate=None):
+		self.path = path
+		self.validate = validate
+		self.mtime = None
+		self.prepared = None
+		self.lock = threading.Lock()
+
+	def response(self, request=None):
+		return self.get_prepared().response(request)
+
+	def get_prepared(self):
+		mtime = os.stat(self.path).st_mtime
+		if self.prepared is not None and mtime == self.mtime:
+			return self.prepared
+		with self.lock:
+			if self.prepared is None or mtime != self.mtime:
+				try:
+					self.prepared = self.load()
+				except ValueError as e:
+					if self.prepared is None:
+						raise
+					logging.warning("Invalid JSON in {}, keeping previous version: {}".format(self.path, e))
+				self.mtime = mtime
+		return self.prepared
+
+	def load(self):
+		with open(self.path, 'r') as json_file:
+			json_obj = json.load(json_file)
+		if self.validate is not None:
+			self.validate(json_obj)
+		return PreparedResponse(cts_json.dumps(json_obj), compress=True)
+
+
+
+def validate_swagger(swagger_obj):
+	"""
+	Minimal check that a parsed swagger spec has its paths.
+	"""
+	if not isinstance(swagger_obj, dict) or not isinstance(swagger_obj.get('paths'), dict):
+		raise ValueError("swagger spec is missing 'paths'")
+
+
+
+def etag_matches(request, etag):
+	"""
+	Checks a request's If-None-Match header against etag.
+	"""
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if not if_none_match:
+		return False
+	if if_none_match.strip() == '*':
+		return True
+	for request_etag in if_none_match.split(','):
+		request_etag = request_etag.strip()
+		if request_etag.startswith('W/'):
+			request_etag = request_etag[2:]
+		if request_etag == etag:
+			return True
+	return False
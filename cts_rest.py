@@ -8,9 +8,16 @@ and reaction pathways.
 import logging
 import json
 import datetime
+import os
+import collections
+import copy
+import importlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pytz
 
-from django.http import HttpResponse, HttpRequest
+from django.http import HttpResponse, HttpRequest, StreamingHttpResponse
 from django.template.loader import render_to_string
 
 from ..cts_calcs.calculator_chemaxon import JchemCalc
@@ -27,11 +34,247 @@ from ..cts_calcs.calculator import Calculator
 from ..cts_calcs.smilesfilter import SMILESFilter
 from ..cts_calcs.chemical_information import ChemInfo
 from ..cts_calcs.mongodb_handler import MongoDBHandler
+from .cts_cache import create_cache, MemoTable, MemoryCacheBackend, ResultCache, NullCache
+from .cts_db import create_pool
+from .cts_opera import OperaBulkResolver
+from .cts_responses import PreparedResponse
+from .cts_metabolizer import ProgenyTreeCache, ConcurrentTreeBuilder
+from .cts_concurrency import SingleFlight, CalcAdmission, AdaptiveLimiter, CircuitBreaker, CalcUnavailableError
+from .cts_metrics import registry as metrics_registry, track_request, time_stage
+from .cts_chem_info import ChemInfoCache
+from .cts_jobs import JobManager, JobQueueFullError
+from .cts_registry import CalcHandler, CalcRegistry
+from . import cts_json
+from . import cts_context
 
 
 
-db_handler = MongoDBHandler()
+db_pool = create_pool(MongoDBHandler)  # shared mongodb connection
 chem_info_obj = ChemInfo()
+pchem_cache = create_cache('pchem')
+speciation_cache = create_cache('speciation')
+ph_grid_max_points = 1401  # 0-14 by 0.01
+pchem_flight = SingleFlight(os.environ.get('CTS_SINGLE_FLIGHT_LOCK_DIR'), name='p-chem')
+metabolizer_tree_workers = int(os.environ.get('CTS_METABOLIZER_TREE_WORKERS', 0))  # 0 builds trees in one request
+progeny_tree_cache = ProgenyTreeCache(
+	create_cache('metabolizer', default_max_entries=1000),
+	ConcurrentTreeBuilder(ThreadPoolExecutor(max_workers=metabolizer_tree_workers)) if metabolizer_tree_workers > 0 else None
+)
+smiles_memo = MemoTable(int(os.environ.get('CTS_SMILES_MEMO_MAX_ENTRIES', 50000)), 'SMILES filter')
+smiles_filter_local = threading.local()  # SMILESFilter instance per thread
+prepared_responses = {}  # metadata responses, built once per process
+prepared_inputs_responses = MemoryCacheBackend(max_entries=1000)
+metadata_cache_ttl = 86400
+ph_dependent_props = ['kow_wph']
+
+# Batch p-chem runs (see CTS_REST.runBatch):
+batch_max_workers = int(os.environ.get('CTS_BATCH_WORKERS', 16))
+batch_max_cells = int(os.environ.get('CTS_BATCH_MAX_CELLS', 10000))
+batch_default_calc_limit = 4
+batch_calc_limits = {
+	'chemaxon': 8,
+	'epi': 4,
+	'testws': 4,
+	'sparc': 2,
+	'measured': 4,
+	'opera': 4,
+	'biotrans': 2,
+	'envipath': 2,
+}
+for _calc_limit in os.environ.get('CTS_BATCH_CALC_LIMITS', '').split(','):
+	# e.g., CTS_BATCH_CALC_LIMITS="sparc:4,epi:8"
+	if ':' in _calc_limit:
+		_calc, _limit = _calc_limit.split(':')
+		batch_calc_limits[_calc.strip()] = int(_limit)
+batch_executor = ThreadPoolExecutor(max_workers=batch_max_workers)
+opera_resolver = OperaBulkResolver(db_pool, chem_info_obj, OperaCalc, ThreadPoolExecutor(max_workers=8))
+
+# P-chem table runs, every calc for one chemical's props (see CTS_REST.runPchemTable):
+pchem_table_workers = int(os.environ.get('CTS_PCHEM_TABLE_WORKERS', 8))  # per calc
+pchem_table_executors = {}  # calc: ThreadPoolExecutor, see getPchemTableExecutor
+pchem_table_executors_lock = threading.Lock()
+pchem_table_timeout = float(os.environ.get('CTS_PCHEM_TABLE_TIMEOUT', 30))  # seconds per cell
+pchem_table_timeouts = {}  # calc: seconds per cell, overrides pchem_table_timeout
+for _calc_timeout in os.environ.get('CTS_PCHEM_TABLE_TIMEOUTS', '').split(','):
+	# e.g., CTS_PCHEM_TABLE_TIMEOUTS="sparc:60,testws:45"
+	if ':' in _calc_timeout:
+		_calc, _timeout = _calc_timeout.split(':')
+		pchem_table_timeouts[_calc.strip()] = float(_timeout)
+
+# Admission control for calculator server requests (see requestCalculator):
+calc_admission_enabled = os.environ.get('CTS_CALC_ADMISSION', 'True') == 'True'
+calc_queue_timeout = float(os.environ.get('CTS_CALC_QUEUE_TIMEOUT', 30))  # seconds
+circuit_failure_threshold = int(os.environ.get('CTS_CIRCUIT_FAILURE_THRESHOLD', 5))
+circuit_reset_timeout = float(os.environ.get('CTS_CIRCUIT_RESET_TIMEOUT', 30))  # seconds
+calc_concurrency_limits = {  # max concurrent requests per calc server
+	'chemaxon': 32,
+	'epi': 16,
+	'testws': 8,
+	'sparc': 4,
+	'measured': 16,
+	'opera': 8,
+	'biotrans': 8,
+	'envipath': 8,
+	'metabolizer': 16,
+}
+for _calc_limit in os.environ.get('CTS_CALC_CONCURRENCY_LIMITS', '').split(','):
+	# e.g., CTS_CALC_CONCURRENCY_LIMITS="sparc:8,testws:4"
+	if ':' in _calc_limit:
+		_calc, _limit = _calc_limit.split(':')
+		calc_concurrency_limits[_calc.strip()] = int(_limit)
+calc_admission = {}  # calc: CalcAdmission, see getCalcAdmission
+calc_admission_lock = threading.Lock()
+
+# /molecule chem info: in-process cache, then MongoDB, then the calc server:
+chem_info_cache = ChemInfoCache(
+	ResultCache(MemoryCacheBackend(int(os.environ.get('CTS_CHEM_INFO_MAX_ENTRIES', 50000))), metadata_cache_ttl, 'chem info'),
+	ResultCache(MemoryCacheBackend(int(os.environ.get('CTS_CHEM_INFO_STRUCTURE_MAX_ENTRIES', 1000))), metadata_cache_ttl, 'structure data'),
+	db_pool if os.environ.get('CTS_CHEM_INFO_DB', 'True') == 'True' else None,
+	lambda request_post: requestChemInfo(request_post),
+	SingleFlight(name='chem info'),
+	ThreadPoolExecutor(max_workers=2)
+)
+
+# Background jobs for long run and batch requests (see submitCalcJob):
+job_ttl = int(os.environ.get('CTS_JOB_TTL', 86400))  # seconds jobs and their results are kept
+job_store = create_cache('jobs')
+if isinstance(job_store, NullCache):
+	job_store = ResultCache(MemoryCacheBackend(), job_ttl, 'jobs')  # jobs need a store, even with caching off
+job_manager = JobManager(
+	job_store,
+	ThreadPoolExecutor(max_workers=int(os.environ.get('CTS_JOB_WORKERS', 4)), thread_name_prefix='cts-job'),
+	ttl=job_ttl,
+	stale_timeout=int(os.environ.get('CTS_JOB_STALE_TIMEOUT', 3600)),
+	max_queued=int(os.environ.get('CTS_JOB_MAX_QUEUED', 1000))
+)
+
+# CTS calculators by name, see registerCalcs:
+calc_registry = CalcRegistry(lambda *args, **kwargs: requestCalculator(*args, **kwargs))
+calc_modules = [name.strip() for name in os.environ.get('CTS_CALC_MODULES', '').split(',') if name.strip()]
+
+# Bulk /molecule (see streamChemicalEditorData):
+chem_info_bulk_max = int(os.environ.get('CTS_CHEM_INFO_BULK_MAX', 50000))  # chemicals per request
+chem_info_bulk_concurrency = int(os.environ.get('CTS_CHEM_INFO_BULK_CONCURRENCY', 16))  # lookups in flight per request
+chem_info_bulk_executor = ThreadPoolExecutor(
+	max_workers=int(os.environ.get('CTS_CHEM_INFO_BULK_WORKERS', 32)),
+	thread_name_prefix='cts-chem-info'
+)
+
+metrics_registry.add_stats('cts_pchem_cache', pchem_cache.stats)
+metrics_registry.add_stats('cts_speciation_cache', speciation_cache.stats)
+metrics_registry.add_stats('cts_pchem_flight', pchem_flight.stats)
+metrics_registry.add_stats('cts_progeny_tree_cache', progeny_tree_cache.stats)
+metrics_registry.add_stats('cts_smiles_memo', smiles_memo.stats)
+metrics_registry.add_stats('cts_chem_info', chem_info_cache.stats)
+metrics_registry.add_stats('cts_jobs', job_manager.stats)
+
+
+
+class CalcRequestError(Exception):
+	"""
+	Raised when a calculator returns an invalid response.
+	response_obj is the error object sent back to the client.
+	"""
+	def __init__(self, response_obj):
+		super().__init__(response_obj.get('error'))
+		self.response_obj = response_obj
+
+
+
+class AllPropsCalcHandler(CalcHandler):
+	"""
+	Calculators that return every prop in one request (e.g., EPI Suite,
+	measured). Each prop's data is picked out with pick_prop (e.g.,
+	pickEpiProp, which also maps EPI methods to pchem table names).
+	"""
+	def __init__(self, name, calc_class, rest_class, pick_prop):
+		super(AllPropsCalcHandler, self).__init__(name, calc_class, rest_class)
+		self.pick_prop = pick_prop
+
+	def request(self, request_dict):
+		"""
+		Gets a calculator response with every prop from one request per
+		chemical. Concurrent requests for other props of the chemical share
+		the request, and each prop's data is added to pchem_cache for later
+		prop requests.
+		"""
+		calc_obj = self.get_calc()
+		all_props_key = pchem_cache.make_key(request_dict.get('chemical'), self.name, 'all props', request_dict.get('method'))
+
+		def request_all_props():
+			all_props_data = requestCalculator(self.name, calc_obj.data_request_handler, request_dict, prop='all props')
+			all_props_data = withoutRequestEcho(all_props_data, request_dict)  # shared with other props' requests
+			if all_props_data.get('valid'):
+				for prop in calc_obj.propMap:
+					try:
+						prop_data = self.pick_prop(copy.deepcopy(all_props_data), prop, calc_obj)
+					except (KeyError, TypeError) as e:
+						logging.warning("{} data missing for {}: {}".format(self.name, prop, e))
+						continue
+					pchem_cache.set(getPchemCacheKey(self.name, dict(request_dict, prop=prop)), prop_data)
+			return all_props_data
+
+		return withRequestEcho(copy.deepcopy(pchem_flight.do(all_props_key, request_all_props)), request_dict)
+
+	def post_request(self, pchem_data, request_dict):
+		if not pchem_data.get('valid'):
+			logging.warning("{} request error: {}".format(self.name, pchem_data))
+			_response_obj = {'error': pchem_data.get('data')}
+			_response_obj.update(request_dict)
+			raise CalcRequestError(_response_obj)
+		return self.pick_prop(pchem_data, request_dict['prop'], self.get_calc())
+
+
+
+class OperaCalcHandler(CalcHandler):
+	"""
+	OPERA p-chem data from the DB if it's available,
+	otherwise from the OPERA model.
+	"""
+	def request(self, request_dict):
+		calc, prop = self.name, request_dict.get('prop')
+		opera_calc = self.get_calc()
+
+		# opera p-chem db check:
+		########################################################
+		if db_pool.get_handler() is None:
+			logging.info("Running OPERA model for p-chem data.")
+			if not isinstance(request_dict.get('chemical'), list):
+				request_dict['chemical'] = [request_dict['chemical']]
+			# Makes CTS oriented request to OPERA:
+			return requestCalculator(calc, opera_calc.data_request_handler, request_dict, prop=prop)
+
+		pchem_data = {}
+		try:
+			with time_stage('dsstox', calc, prop):
+				dsstox_result = chem_info_obj.get_cheminfo(request_dict, only_dsstox=True)
+			with time_stage('mongo', calc, prop):
+				dtxcid_result = db_pool.find_dtxcid_document({'DTXSID': dsstox_result.get('dsstoxSubstanceId')})
+				db_results = None
+				if dtxcid_result:
+					if request_dict.get('prop') == 'kow_wph':
+						db_results = db_pool.find_pchem_document({
+							'dsstoxSubstanceId': dtxcid_result.get('DTXCID'),
+							'prop': request_dict.get('prop'),
+							'ph': float(request_dict.get('ph', 7.4))
+						})
+					else:
+						db_results = db_pool.find_pchem_document({
+							'dsstoxSubstanceId': dtxcid_result.get('DTXCID'),  # TODO: change key to DTXCID
+							'prop': request_dict.get('prop')
+						})
+			if db_results and dsstox_result.get('dsstoxSubstanceId') != "N/A":
+				# Add response keys (like results below), then push with redis:
+				logging.info("Getting p-chem data from DB.")
+				del db_results['_id']
+				pchem_data = {'status': True, 'request_post': request_dict, 'data': db_results}
+				pchem_data['data'].update(request_dict)
+				pchem_data['data'] = opera_calc.convert_units_for_cts(request_dict['prop'], pchem_data['data'])
+		except Exception as e:
+			logging.warning("Error requesting opera data: {}".format(e))
+			pchem_data = {'status': False, 'request_post': request_dict, 'data': "Cannot reach OPERA"}
+		########################################################
+		return pchem_data
 
 
 
@@ -113,56 +356,46 @@ class CTS_REST(object):
 
 	@classmethod
 	def getCalcObject(self, calc):
-		if calc == 'cts':
-			return CTS_REST()
-		elif calc == 'chemaxon':
-			return Chemaxon_CTS_REST()
-		elif calc == 'epi':
-			return EPI_CTS_REST()
-		elif calc == 'test':
-			return TEST_CTS_REST()
-		elif calc == 'testws':
-			return TEST_CTS_REST()
-		elif calc == 'sparc':
-			return SPARC_CTS_REST()
-		elif calc == 'measured':
-			return Measured_CTS_REST()
-		elif calc == 'metabolizer':
-			return Metabolizer_CTS_REST()
-		elif calc == 'opera':
-			return OperaCalc()
-		elif calc == 'biotrans':
-			return BiotransCalc()
-		elif calc == 'envipath':
-			return EnvipathCalc()
-		else:
+		"""
+		The calc's REST metadata object, built once
+		per process (don't modify it), or None.
+		"""
+		handler = calc_registry.get(calc)
+		if handler is None:
 			return None
+		return handler.get_rest_obj()
 
 	def getCalcLinks(self, calc):
 		if calc in self.calcs:
-			_links = self.calc_links
-			for item in _links:
-				if 'href' in item:
-					item['href'] = item['href'].format(calc)  # insert calc name into href
-			return _links
+			# insert calc name into href, without changing the calc_links template:
+			return [dict(item, href=item['href'].format(calc)) if 'href' in item else dict(item) for item in self.calc_links]
 		else:
 			return None
 
-	def getCTSREST(self):
-		_response = self.meta_info
+	def getCTSREST(self, request=None):
+		return getCTSRESTResponse(request)
+
+	def getCalcEndpoints(self, calc, request=None):
+		return getCalcEndpointsResponse(calc, request)
+
+	def getCalcInputs(self, chemical, calc, prop=None, request=None):
+		return getCalcInputsResponse(chemical, calc, prop, request)
+
+	def buildCTSREST(self):
+		_response = dict(self.meta_info)
 		_response['links'] = self.links
-		return HttpResponse(json.dumps(_response), content_type='application/json')
+		return _response
 
-	def getCalcEndpoints(self, calc):
+	def buildCalcEndpoints(self, calc):
 		_response = {}
 		calc_obj = self.getCalcObject(calc)
 		_response.update({
 			'metaInfo': calc_obj.meta_info,
 			'links': self.getCalcLinks(calc)
 		})
-		return HttpResponse(json.dumps(_response), content_type="application/json")
+		return _response
 
-	def getCalcInputs(self, chemical, calc, prop=None):
+	def buildCalcInputs(self, chemical, calc, prop=None):
 		_response = {}
 		calc_obj = self.getCalcObject(calc)
 		
@@ -181,185 +414,477 @@ class CTS_REST(object):
 			_response.update({
 				'inputs': calc_obj.inputs
 			})
-		return HttpResponse(json.dumps(_response), content_type="application/json")
+		return _response
 
-	def runCalc(self, calc, request_dict):
+	def runCalc(self, calc, request_dict, stream_format=None):
 
-		_response = {}
-		calc_obj = self.getCalcObject(calc)
-		_response = calc_obj.meta_info
-
-		if calc == 'metabolizer':
-			structure = request_dict.get('structure')
-			gen_limit = request_dict.get('generationLimit')
-			trans_libs = request_dict.get('transformationLibraries', [])
-
-			# TODO: Add transformationLibraries key:val logic
-			metabolizer_request = {
-				'structure': structure,
-				'generationLimit': gen_limit,
-				'populationLimit': 0,
-				'likelyLimit': 0.1,
-				# 'transformationLibraries': trans_libs,
-				'excludeCondition': ""  # 'generateImages': False
-			}
+		if stream_format:
+			return self.streamCalc(calc, request_dict, stream_format)
+
+		prop = request_dict.get('prop')
+		with track_request('runCalc', calc, prop) as tracker:
+			if calc == 'speciation':
+				return getChemicalSpeciationData(request_dict)  # no calc object/metaInfo
+
+			_response = dict(getMetaInfoJSON(calc))  # pre-encoded metaInfo
+
+			if calc == 'metabolizer':
+				try:
+					_response.update({'data': self.getMetabolizerData(request_dict, encoded=True)})
+				except CalcRequestError as e:
+					tracker.failed()
+					return HttpResponse(cts_json.dumps(e.response_obj), content_type="application/json")
+				except CalcUnavailableError as e:
+					tracker.failed()
+					return getCalcUnavailableResponse(calc, e)
+
+			else:
+				with time_stage('filter', calc, prop):
+					request_dict = self.filterRequestSmiles(request_dict)
+				try:
+					pchem_data = self.getPchemData(calc, request_dict)
+				except CalcRequestError as e:
+					tracker.failed()
+					return HttpResponse(cts_json.dumps(e.response_obj))
+				except CalcUnavailableError as e:
+					tracker.failed()
+					return getCalcUnavailableResponse(calc, e)
+				if not isCacheablePchemData(pchem_data):
+					tracker.failed()
+				_response.update({'data': pchem_data})
+
+			with time_stage('json', calc, prop):
+				json_data = cts_json.dumps_envelope(_response)
+			return HttpResponse(json_data, content_type="application/json")
+
+	def getMetabolizerData(self, request_dict, encoded=False):
+		"""
+		Gets transformation products from the metabolizer and
+		returns the progeny tree (as cts_json.RawJSON with encoded).
+		Raises CalcRequestError if the generation limit is too high.
+		"""
+		tree_key, structure, gen_limit, build_tree, population_limit, likely_limit = self.getMetabolizerTreeRequest(request_dict)
+		return progeny_tree_cache.get_tree(tree_key, structure, gen_limit, build_tree, population_limit, likely_limit, encoded)
+
+	def iterMetabolizerData(self, request_dict):
+		"""
+		Streaming version of getMetabolizerData, yields (tree, generation)
+		as the progeny tree's generations are done (see
+		ProgenyTreeCache.iter_tree).
+		"""
+		tree_key, structure, gen_limit, build_tree, population_limit, likely_limit = self.getMetabolizerTreeRequest(request_dict)
+		return progeny_tree_cache.iter_tree(tree_key, structure, gen_limit, build_tree, population_limit, likely_limit)
 
+	def getMetabolizerTreeRequest(self, request_dict):
+		"""
+		Returns the progeny tree's cache key, structure, generation
+		limit, build_tree(structure, gen_limit) function, and population
+		and likely limits for a metabolizer request.
+		Raises CalcRequestError if the generation limit is too high.
+		"""
+		structure = request_dict.get('structure')
+		gen_limit = request_dict.get('generationLimit')
+		trans_libs = request_dict.get('transformationLibraries', [])
 
-			# TODO: Move to calculator_metabolizer?
-			if gen_limit > 4:
-				_response_obj = dict(request_dict)
-				_response_obj['data'] = "Must request generation limit <= 4 generations."
-				return HttpResponse(json.dumps(_response_obj), content_type="application/json")
+		# TODO: Add transformationLibraries key:val logic
+		metabolizer_request = {
+			'structure': structure,
+			'generationLimit': gen_limit,
+			'populationLimit': 0,
+			'likelyLimit': 0.1,
+			# 'transformationLibraries': trans_libs,
+			'excludeCondition': ""  # 'generateImages': False
+		}
+
+
+		# TODO: Move to calculator_metabolizer?
+		if gen_limit > 4:
+			_response_obj = dict(request_dict)
+			_response_obj['data'] = "Must request generation limit <= 4 generations."
+			raise CalcRequestError(_response_obj)
 
 
-			# metabolizerList = ["hydrolysis", "abiotic_reduction", "human_biotransformation"]
-			# NOTE: Only adding 'transformationLibraries' key:val if hydrolysis and/or reduction selected, but not mammalian metabolism
-			if len(trans_libs) > 0 and not 'human_biotransformation' in trans_libs:
-				metabolizer_request.update({'transformationLibraries': trans_libs})
+		# metabolizerList = ["hydrolysis", "abiotic_reduction", "human_biotransformation"]
+		# NOTE: Only adding 'transformationLibraries' key:val if hydrolysis and/or reduction selected, but not mammalian metabolism
+		if len(trans_libs) > 0 and not 'human_biotransformation' in trans_libs:
+			metabolizer_request.update({'transformationLibraries': trans_libs})
 
+		unranked = False
+		if 'photolysis' in trans_libs:
+			unranked = True
+
+		def build_tree(tree_structure, tree_gen_limit):
+			tree_request = dict(metabolizer_request, structure=tree_structure, generationLimit=tree_gen_limit)
 			try:
-				response = MetabolizerCalc().getTransProducts(metabolizer_request)
+				response = requestCalculator('metabolizer', calc_registry.get('metabolizer').get_calc().getTransProducts, tree_request)
 			except Exception as e:
 				logging.warning("error making data request: {}".format(e))
 				raise
+			return MetabolizerCalc().recursive(response, int(tree_gen_limit), unranked)  # tree JSON, new instance as it numbers the tree's nodes
 
-			unranked = False
-			if 'photolysis' in trans_libs:
-				unranked = True
+		tree_key = getProgenyTreeCacheKey(metabolizer_request, unranked)
+		return (
+			tree_key, structure, int(gen_limit), build_tree,
+			metabolizer_request['populationLimit'], metabolizer_request['likelyLimit']
+		)
 
-			_progeny_tree = MetabolizerCalc().recursive(response, int(gen_limit), unranked)
-			_response.update({'data': json.loads(_progeny_tree)})
+	def streamCalc(self, calc, request_dict, stream_format):
+		"""
+		Streaming version of runCalc. The metabolizer tree is sent
+		one generation per record, as soon as each generation is done
+		(see iterMetabolizerGenerations), p-chem and speciation data are sent
+		as a single record. The request is tracked (see track_request)
+		until the stream ends.
+		"""
+		prop = request_dict.get('prop')
 
-		elif calc == 'speciation':
-			return getChemicalSpeciationData(request_dict)
+		def records():
+			with track_request('runCalc', calc, prop) as tracker:
+				if calc != 'speciation':  # no calc object/metaInfo
+					calc_obj = self.getCalcObject(calc)
+					if calc_obj is None:
+						tracker.failed()
+						yield 'error', {'error': "calc not recognized", 'calc': calc}
+						return
+					yield 'metaInfo', withTimestamp(calc_obj.meta_info)
+				try:
+					if calc == 'speciation':
+						yield 'data', {'status': True, 'data': getSpeciationResults(request_dict)}
+					elif calc == 'metabolizer':
+						for generation in iterMetabolizerGenerations(self.iterMetabolizerData(request_dict)):
+							yield 'generation', generation
+					else:
+						_request_dict = self.filterRequestSmiles(request_dict)
+						pchem_data = self.getPchemData(calc, _request_dict)
+						if not isCacheablePchemData(pchem_data):
+							tracker.failed()
+						yield 'data', {'data': pchem_data}
+				except CalcRequestError as e:
+					tracker.failed()
+					yield 'error', e.response_obj
+				except CalcUnavailableError as e:
+					tracker.failed()
+					yield 'error', {'error': "{}, try again later".format(e), 'retryAfter': e.retry_after}
+				except Exception as e:
+					logging.warning("exception in cts_rest.py streamCalc: {}".format(e))
+					tracker.failed()
+					yield 'error', {'error': "Error requesting data from {}".format(calc)}
+				yield 'done', {}
 
-		else:
+		return streamResponse(records(), stream_format)
+
+	def filterRequestSmiles(self, request_dict):
+		"""
+		Filters the request's chemical with SMILESFilter, keeping
+		the original SMILES as 'orig_smiles'.
+		"""
+		try:
+			_orig_smiles = request_dict.get('chemical')
+			_filtered_smiles = filterSMILES(_orig_smiles)
+			request_dict.update({
+				'orig_smiles': _orig_smiles,
+				'chemical': _filtered_smiles,
+			})
+		except AttributeError as ae:
+			# POST type is django QueryDict (most likely)
+			request_dict = dict(request_dict)  # convert QueryDict to dict
+			for key, val in request_dict.items():
+				request_dict.update({key: val[0]})  # vals of QueryDict are lists of 1 item
+
+			request_dict.update({
+				'orig_smiles': _orig_smiles,
+				'chemical': _filtered_smiles,
+			})
+		except Exception as e:
+			logging.warning("exception in cts_rest.py runCalc: {}".format(e))
+			logging.warning("skipping SMILES filter..")
+		return request_dict
 
+	def getPchemData(self, calc, request_dict):
+		"""
+		Gets p-chem data for a single chemical, calc, and prop,
+		from pchem_cache if it's there, otherwise from the calculator
+		(through pchem_flight).
+		Expects request_dict['chemical'] to be filtered already
+		(see filterRequestSmiles).
+		"""
+		cache_key = getPchemCacheKey(calc, request_dict)
+		pchem_data = pchem_cache.get(cache_key)
+		if pchem_data is not None:
+			return withRequestEcho(pchem_data, request_dict)
+
+		def request_pchem_data():
+			pchem_data = withoutRequestEcho(self.requestPchemData(calc, request_dict), request_dict)
+			if isCacheablePchemData(pchem_data):
+				pchem_cache.set(cache_key, pchem_data)
+			return pchem_data
+
+		# concurrent requests for the same data share one calculator request:
+		pchem_data = pchem_flight.do(cache_key, request_pchem_data, lambda: pchem_cache.get(cache_key))
+		return withRequestEcho(pchem_data, request_dict)
+
+	def requestPchemData(self, calc, request_dict):
+		"""
+		Makes the p-chem data request for a single chemical,
+		calc, and prop with the calc's handler. Raises
+		CalcRequestError if the calculator response is invalid,
+		or calc isn't a p-chem calc.
+		"""
+		if not isPchemCalc(calc):
+			raise CalcRequestError({'error': "{} is not a p-chem calc".format(calc), 'calc': calc, 'prop': request_dict.get('prop')})
+		return calc_registry.get(calc).run(request_dict)
+
+	def runBatch(self, request_dict, stream_format=None, progress=None):
+		"""
+		Runs p-chem data requests for every chemical x calc x prop
+		in request_dict and returns the assembled table. Inputs are
+		'chemicals', 'calcs', and 'props' lists, any other keys (e.g., 'ph')
+		are passed along to each calc request. With stream_format,
+		cells are streamed back as they complete. progress(done, total)
+		is called as cells complete (e.g., for batch jobs).
+		"""
+		if stream_format:
+			return self.streamBatch(request_dict, stream_format)
+
+		try:
+			cells = self.getBatchCells(request_dict)
+		except ValueError as e:
+			return HttpResponse(cts_json.dumps({'error': "{}".format(e)}), content_type="application/json")
+
+		table = [None] * len(cells)
+		for done, (index, result) in enumerate(self.iterBatchResults(cells), 1):
+			table[index] = result
+			if progress is not None:
+				progress(done, len(cells))
+
+		_response = withTimestamp(self.meta_info)
+		_response.update({'data': table})
+		return HttpResponse(cts_json.dumps(_response), content_type="application/json")
+
+	def streamBatch(self, request_dict, stream_format):
+		"""
+		Streaming version of runBatch, each record is a completed
+		cell with its 'index' in the chemical x calc x prop table.
+		"""
+		def records():
+			yield 'metaInfo', withTimestamp(self.meta_info)
 			try:
-				_orig_smiles = request_dict.get('chemical')
-				_filtered_smiles = SMILESFilter().filterSMILES(_orig_smiles)
-				request_dict.update({
-					'orig_smiles': _orig_smiles,
-					'chemical': _filtered_smiles,
-				})
-			except AttributeError as ae:
-				# POST type is django QueryDict (most likely)
-				request_dict = dict(request_dict)  # convert QueryDict to dict
-				for key, val in request_dict.items():
-					request_dict.update({key: val[0]})  # vals of QueryDict are lists of 1 item
-
-				request_dict.update({
-					'orig_smiles': _orig_smiles,
-					'chemical': _filtered_smiles,
-				})
-			except Exception as e:
-				logging.warning("exception in cts_rest.py runCalc: {}".format(e))
-				logging.warning("skipping SMILES filter..")
-
-			pchem_data = {}
-			if calc == 'chemaxon':
-				pchem_data = JchemCalc().data_request_handler(request_dict)
-			elif calc == 'epi':
-				_epi_calc = EpiCalc()
-				pchem_data = _epi_calc.data_request_handler(request_dict)
-				if not pchem_data.get('valid'):
-					logging.warning("{} request error: {}".format(calc, pchem_data))
-					_response_obj = {'error': pchem_data.get('data')}
-					_response_obj.update(request_dict)
-					return HttpResponse(json.dumps(_response_obj))
-				# with updated epi, have to pick out desired prop:
-				_methods_list = []
-				for data_obj in pchem_data.get('data'):
-					epi_prop_name = _epi_calc.propMap[request_dict['prop']]['result_key']
-					if data_obj['prop'] == epi_prop_name:
-						if data_obj.get('method'):
-							_epi_methods = _epi_calc.propMap.get(request_dict['prop']).get('methods')
-							data_obj['method'] = _epi_methods.get(data_obj['method'])  # use pchem table name for method
-							_methods_list.append(data_obj)
-						else:
-							pchem_data['data'] = data_obj['data'] # only want request prop
-						pchem_data['prop'] = request_dict['prop']  # use cts prop name
-				if len(_methods_list) > 0:
-					# epi water solubility has two data objects..
-					pchem_data['data'] = _methods_list
-
-			elif calc == 'testws':
-				pchem_data = TestWSCalc().data_request_handler(request_dict)
-
-			elif calc == 'sparc':
-				pchem_data = SparcCalc().data_request_handler(request_dict)
-				
-			elif calc == 'measured':
-				pchem_data = MeasuredCalc().data_request_handler(request_dict)
-				if not pchem_data.get('valid'):
-					logging.warning("{} request error: {}".format(calc, pchem_data))
-					_response_obj = {'error': pchem_data.get('data')}
-					_response_obj.update(request_dict)
-					return HttpResponse(json.dumps(_response_obj))
-				# with updated measured, have to pick out desired prop:
-				for data_obj in pchem_data.get('data'):
-					measured_prop_name = MeasuredCalc().propMap[request_dict['prop']]['result_key']
-					if data_obj['prop'] == measured_prop_name:
-						pchem_data['data'] = data_obj['data'] # only want request prop
-						pchem_data['prop'] = request_dict['prop']  # use cts prop name
-
-			elif calc == 'opera':
-
-				opera_calc = OperaCalc()
-
-				# opera p-chem db check:
-				########################################################
-				db_handler.connect_to_db()
-				if not db_handler.is_connected:
-					logging.info("Running OPERA model for p-chem data.")
-					if not isinstance(request_dict.get('chemical'), list):
-						request_dict['chemical'] = [request_dict['chemical']]
-					# Makes CTS oriented request to OPERA:
-					pchem_data = opera_calc.data_request_handler(request_dict)
+				cells = self.getBatchCells(request_dict)
+			except ValueError as e:
+				yield 'error', {'error': "{}".format(e)}
+				return
+			for index, result in self.iterBatchResults(cells):
+				result['index'] = index
+				yield 'cell', result
+			yield 'done', {'cells': len(cells)}
+
+		return streamResponse(records(), stream_format)
+
+	def getBatchCells(self, request_dict):
+		"""
+		Builds a request dict per chemical x calc x prop cell,
+		filtering each chemical's SMILES once.
+		"""
+		chemicals = request_dict.get('chemicals')
+		calcs = request_dict.get('calcs')
+		props = request_dict.get('props')
+
+		for key, val in (('chemicals', chemicals), ('calcs', calcs), ('props', props)):
+			if not isinstance(val, list) or len(val) < 1:
+				raise ValueError("'{}' must be a list with at least one item".format(key))
+
+		unknown_calcs = [calc for calc in calcs if not isPchemCalc(calc)]
+		if unknown_calcs:
+			raise ValueError("Not p-chem calcs: {} (calcs are {})".format(
+				", ".join("{}".format(calc) for calc in unknown_calcs), ", ".join(calc_registry.names(pchem=True))))
+
+		num_cells = len(chemicals) * len(calcs) * len(props)
+		if num_cells > batch_max_cells:
+			raise ValueError("Batch has {} cells, max is {}".format(num_cells, batch_max_cells))
+
+		shared_inputs = {key: val for key, val in request_dict.items() if not key in ('chemicals', 'calcs', 'props')}
+
+		filtered_chemicals = list(batch_executor.map(
+			lambda chemical: self.filterRequestSmiles({'chemical': chemical}),
+			chemicals
+		))
+
+		cells = []
+		for chemical_dict in filtered_chemicals:
+			for calc in calcs:
+				for prop in props:
+					cell = dict(shared_inputs)
+					cell.update(chemical_dict)
+					cell.update({'calc': calc, 'prop': prop})
+					cells.append(cell)
+		return cells
+
+	def iterBatchResults(self, cells):
+		"""
+		Yields (index, result) for each batch cell as it completes,
+		keeping no more than the calc's batch_calc_limits in flight.
+		OPERA cells are resolved together (see runOperaCells).
+		"""
+		queues = collections.OrderedDict()
+		opera_cells = []
+		for index, cell in enumerate(cells):
+			if cell['calc'] == 'opera':
+				opera_cells.append((index, cell))
+			else:
+				queues.setdefault(cell['calc'], collections.deque()).append((index, cell))
+		running = dict.fromkeys(queues, 0)
+		in_flight = {}  # future: (index, calc)
+
+		def submit_ready():
+			for calc, queue in queues.items():
+				limit = batch_calc_limits.get(calc, batch_default_calc_limit)
+				while queue and running[calc] < limit:
+					index, cell = queue.popleft()
+					in_flight[batch_executor.submit(cts_context.run_in_context(self.runBatchCell), cell)] = (index, calc)
+					running[calc] += 1
+
+		if opera_cells:
+			in_flight[batch_executor.submit(cts_context.run_in_context(self.runOperaCells), opera_cells)] = (None, 'opera')
+		submit_ready()
+		while in_flight:
+			done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+			for future in done:
+				index, calc = in_flight.pop(future)
+				if index is None:
+					for opera_result in future.result():
+						yield opera_result
+					continue
+				running[calc] -= 1
+				yield index, future.result()
+			submit_ready()
+
+	def runOperaCells(self, indexed_cells):
+		"""
+		Gets OPERA p-chem data for (index, cell) batch cells: cached
+		cells come from pchem_cache, the rest are resolved in bulk
+		by opera_resolver. Returns a list of (index, result).
+		"""
+		results, misses = [], []
+		for index, cell in indexed_cells:
+			pchem_data = pchem_cache.get(getPchemCacheKey('opera', cell))
+			if pchem_data is not None:
+				results.append((index, batchCellResult(cell, withRequestEcho(pchem_data, cell))))
+			else:
+				misses.append((index, cell))
+		if not misses:
+			return results
+
+		try:
+			opera_results = requestCalculator('opera', opera_resolver.resolve, [cell for index, cell in misses], prop='batch')
+		except CalcUnavailableError as e:
+			error = "{}, try again later".format(e)
+			return results + [(index, batchCellResult(cell, error=error)) for index, cell in misses]
+		except Exception as e:
+			logging.warning("exception in cts_rest.py runOperaCells: {}".format(e))
+			error = "Error requesting data from opera"
+			return results + [(index, batchCellResult(cell, error=error)) for index, cell in misses]
+
+		for (index, cell), pchem_data in zip(misses, opera_results):
+			if isCacheablePchemData(pchem_data):
+				pchem_cache.set(getPchemCacheKey('opera', cell), withoutRequestEcho(pchem_data, cell))
+			results.append((index, batchCellResult(cell, pchem_data)))
+		return results
+
+	def runPchemTable(self, request_dict):
+		"""
+		Runs every calc with each of request_dict's 'props' in its
+		availableProps (see getPropCalcs) for one 'chemical', all at once.
+		Returns the cells that finished by their deadline (see
+		getPchemTableTimeout) and timeout markers for the rest. Cells
+		still waiting for a worker by then are cancelled, running ones
+		finish and are cached for later requests. Each calc's cells run
+		on its own workers (see getPchemTableExecutor). Optional
+		'calcs' limits the calcs, and other keys (e.g., 'ph') are
+		passed along to each calc request.
+		"""
+		with track_request('runPchemTable') as tracker:
+			try:
+				cells = self.getPchemTableCells(request_dict)
+			except ValueError as e:
+				tracker.failed()
+				return HttpResponse(cts_json.dumps({'error': "{}".format(e)}), content_type="application/json")
+
+			start = time.monotonic()
+			table = [None] * len(cells)
+			deadlines = {}  # future: (index, deadline)
+			for index, cell in enumerate(cells):
+				if cell['calc'] is None:
+					table[index] = batchCellResult(cell, error="No calculator has this prop")
+					continue
+				timeout = getPchemTableTimeout(cell['calc'], request_dict.get('timeout'))
+				future = getPchemTableExecutor(cell['calc']).submit(cts_context.run_in_context(self.runBatchCell), cell)
+				deadlines[future] = (index, start + timeout)
+
+			timed_out = 0
+			while deadlines:
+				done, _ = wait(deadlines, timeout=min(deadline for _, deadline in deadlines.values()) - time.monotonic(), return_when=FIRST_COMPLETED)
+				for future in done:
+					index, _ = deadlines.pop(future)
+					table[index] = future.result()
+				now = time.monotonic()
+				for future, (index, deadline) in list(deadlines.items()):
+					if deadline <= now:
+						del deadlines[future]
+						future.cancel()  # unless it's running
+						table[index] = dict(batchCellResult(cells[index], error="Timed out after {:g}s".format(deadline - start)), timeout=True)
+						timed_out += 1
+
+			_response = withTimestamp(self.meta_info)
+			_response.update({'chemical': request_dict.get('chemical'), 'timedOut': timed_out, 'data': table})
+			return HttpResponse(cts_json.dumps(_response), content_type="application/json")
+
+	def getPchemTableCells(self, request_dict):
+		"""
+		Builds a request dict per prop x applicable calc (x method, for
+		calcs with methods for the prop, unless a 'method' is requested).
+		Props no calc has get a cell with no calc.
+		"""
+		chemical = request_dict.get('chemical')
+		props = request_dict.get('props')
+		calcs = request_dict.get('calcs')
+		if not isinstance(chemical, str) or not chemical:
+			raise ValueError("'chemical' is required")
+		if not isinstance(props, list) or len(props) < 1:
+			raise ValueError("'props' must be a list with at least one item")
+		if calcs is not None and not isinstance(calcs, list):
+			raise ValueError("'calcs' must be a list")
+
+		shared_inputs = {key: val for key, val in request_dict.items() if not key in ('chemical', 'props', 'calcs', 'timeout')}
+		shared_inputs.update(self.filterRequestSmiles({'chemical': chemical}))
+
+		prop_calcs = getPropCalcs()
+		cells = []
+		for prop in props:
+			prop_cells = []
+			for calc, methods in prop_calcs.get(prop, []):
+				if calcs and not calc in calcs:
+					continue
+				if methods and not 'method' in shared_inputs:
+					prop_cells.extend(dict(shared_inputs, calc=calc, prop=prop, method=method) for method in methods)
 				else:
-					try:
-						dsstox_result = chem_info_obj.get_cheminfo(request_dict, only_dsstox=True)
-						dtxcid_result = db_handler.find_dtxcid_document({'DTXSID': dsstox_result.get('dsstoxSubstanceId')})
-						db_results = None
-						if dtxcid_result:
-							if request_dict.get('prop') == 'kow_wph':
-								db_results = db_handler.find_pchem_document({
-									'dsstoxSubstanceId': dtxcid_result.get('DTXCID'),
-									'prop': request_dict.get('prop'),
-									'ph': float(request_dict.get('ph', 7.4))
-								})
-							else:
-								db_results = db_handler.find_pchem_document({
-									'dsstoxSubstanceId': dtxcid_result.get('DTXCID'),  # TODO: change key to DTXCID
-									'prop': request_dict.get('prop')
-								})
-						pchem_data = {}
-						if db_results and dsstox_result.get('dsstoxSubstanceId') != "N/A":
-							# Add response keys (like results below), then push with redis:
-							logging.info("Getting p-chem data from DB.")
-							del db_results['_id']
-							pchem_data = {'status': True, 'request_post': request_dict, 'data': db_results}
-							pchem_data['data'].update(request_dict)
-							pchem_data['data'] = opera_calc.convert_units_for_cts(request_dict['prop'], pchem_data['data'])
-					except Exception as e:
-						logging.warning("Error requesting opera data: {}".format(e))
-						db_handler.mongodb_conn.close()
-						pchem_data = {'status': False, 'request_post': request_dict, 'data': "Cannot reach OPERA"}
-				db_handler.mongodb_conn.close()  # closes mongodb connection
-				########################################################
-			
-			elif calc == 'biotrans':
-				biotrans_calc = BiotransCalc()
-				pchem_data = biotrans_calc.data_request_handler(request_dict)
-
-			elif calc == 'envipath':
-				envipath_calc = EnvipathCalc()
-				pchem_data = envipath_calc.data_request_handler(request_dict)
-
-			_response.update({'data': pchem_data})
-
-
-		return HttpResponse(json.dumps(_response), content_type="application/json")
+					prop_cells.append(dict(shared_inputs, calc=calc, prop=prop))
+			cells.extend(prop_cells or [dict(shared_inputs, calc=None, prop=prop)])
+		return cells
+
+	def runBatchCell(self, cell):
+		"""
+		Runs a single batch cell, errors are returned in the
+		cell rather than failing the whole batch.
+		"""
+		try:
+			return batchCellResult(cell, self.getPchemData(cell['calc'], cell))
+		except CalcRequestError as e:
+			return batchCellResult(cell, error=e.response_obj.get('error'))
+		except CalcUnavailableError as e:
+			return batchCellResult(cell, error="{}, try again later".format(e))
+		except Exception as e:
+			logging.warning("exception in cts_rest.py runBatchCell: {}".format(e))
+			return batchCellResult(cell, error="Error requesting data from {}".format(cell['calc']))
 
 
 
@@ -663,6 +1188,29 @@ class Metabolizer_CTS_REST(CTS_REST):
 		
 
 
+def registerCalcs():
+	"""
+	Registers the CTS calculators, then imports CTS_CALC_MODULES
+	(comma-separated module names), which can register more calcs
+	with calc_registry.register(CalcHandler(...)).
+	"""
+	calc_registry.register(CalcHandler('cts', rest_class=CTS_REST, pchem=False))
+	calc_registry.register(CalcHandler('chemaxon', JchemCalc, Chemaxon_CTS_REST))
+	calc_registry.register(AllPropsCalcHandler('epi', EpiCalc, EPI_CTS_REST, pickEpiProp))
+	calc_registry.register(CalcHandler('testws', TestWSCalc, TEST_CTS_REST), aliases=('test',))
+	calc_registry.register(CalcHandler('sparc', SparcCalc, SPARC_CTS_REST))
+	calc_registry.register(AllPropsCalcHandler('measured', MeasuredCalc, Measured_CTS_REST, pickMeasuredProp))
+	calc_registry.register(CalcHandler('metabolizer', MetabolizerCalc, Metabolizer_CTS_REST, pchem=False))
+	calc_registry.register(OperaCalcHandler('opera', OperaCalc))
+	calc_registry.register(CalcHandler('biotrans', BiotransCalc))
+	calc_registry.register(CalcHandler('envipath', EnvipathCalc))
+	for module_name in calc_modules:
+		try:
+			importlib.import_module(module_name)
+		except Exception as e:
+			logging.warning("Error importing calc module {}: {}".format(module_name, e))
+
+
 def getChemicalEditorData(request_post):
 	"""
 	Makes call to Calculator for chemaxon
@@ -675,36 +1223,100 @@ def getChemicalEditorData(request_post):
 	so large, a bool, "structureData", is used to determine
 	whether or not to grab it. It's only needed in chem edit tab.
 	"""
-	try:
-		# # chem_info database routine:
-		# ########################################################################
-		# dsstox_result = chem_info_obj.get_cheminfo(request_post, only_dsstox=True)
-		# db_results = db_handler.find_chem_info_document({'dsstoxSubstanceId': dsstox_result.get('dsstoxSubstanceId')})
-		# if db_results:
-		# 	# Add response keys (like results below), then push with redis:
-		# 	logging.info("Getting chem info from DB.")
-		# 	del db_results['_id']
-		# 	results = {'status': True, 'request_post': request_post, 'data': db_results}
-		# else:
-		# 	logging.info("Making request for chem info.")
-		# 	results = chem_info_obj.get_cheminfo(request_post)  # get recults from calc server
-		# 	db_handler.insert_chem_info_data(results['data'])
-		# ########################################################################
-		results = chem_info_obj.get_cheminfo(request_post)  # get recults from calc server
-		json_data = json.dumps(results)
-		return HttpResponse(json_data, content_type='application/json')
-	except KeyError as error:
-		logging.warning(error)
-		wrapped_post = {
-			'status': False, 
-			'error': 'Error validating chemical',
-			'chemical': request_post.get('chemical')
-		}
-		return HttpResponse(json.dumps(wrapped_post), content_type='application/json')
-	except Exception as error:
-		logging.warning(error)
-		wrapped_post = {'status': False, 'error': "Cannot validate chemical"}
-		return HttpResponse(json.dumps(wrapped_post), content_type='application/json')
+	with track_request('getChemicalEditorData') as tracker:
+		try:
+			results = chem_info_cache.get_cheminfo(request_post)  # cache, DB, then calc server
+			with time_stage('json', 'chem_info'):
+				json_data = cts_json.dumps(results)
+			return HttpResponse(json_data, content_type='application/json')
+		except KeyError as error:
+			logging.warning(error)
+			tracker.failed()
+			wrapped_post = {
+				'status': False, 
+				'error': 'Error validating chemical',
+				'chemical': request_post.get('chemical')
+			}
+			return HttpResponse(cts_json.dumps(wrapped_post), content_type='application/json')
+		except Exception as error:
+			logging.warning(error)
+			tracker.failed()
+			wrapped_post = {'status': False, 'error': "Cannot validate chemical"}
+			return HttpResponse(cts_json.dumps(wrapped_post), content_type='application/json')
+
+
+def streamChemicalEditorData(request_post, stream_format='ndjson'):
+	"""
+	Bulk /molecule: chem info for each of request_post's 'chemicals'
+	(SMILES, CAS numbers, names, etc.), streamed back in input order.
+	Duplicates are looked up once, with no more than
+	chem_info_bulk_concurrency lookups in flight. Other inputs
+	(e.g., 'get_structure_data') apply to every chemical.
+	"""
+	chemicals = request_post.get('chemicals')
+	if not isinstance(chemicals, list) or len(chemicals) < 1:
+		return HttpResponse(cts_json.dumps({'error': "'chemicals' must be a list with at least one item"}), content_type='application/json')
+	if len(chemicals) > chem_info_bulk_max:
+		return HttpResponse(cts_json.dumps({'error': "Request has {} chemicals, max is {}".format(len(chemicals), chem_info_bulk_max)}), content_type='application/json')
+
+	shared_inputs = {key: val for key, val in request_post.items() if not key in ('chemicals', 'stream')}
+	keys = [MemoTable.normalize(chemical) if isinstance(chemical, str) else cts_json.dumps_str(chemical) for chemical in chemicals]
+	first_index, last_index = {}, {}  # key: index in chemicals
+	for index, key in enumerate(keys):
+		first_index.setdefault(key, index)
+		last_index[key] = index
+	unique_keys = list(first_index)  # in input order
+	positions = {key: position for position, key in enumerate(unique_keys)}
+
+	def records():
+		futures = {}  # key: future of its chem info
+		submitted = 0
+		try:
+			for index, chemical in enumerate(chemicals):
+				key = keys[index]
+				# keep up to chem_info_bulk_concurrency lookups ahead of this chemical:
+				while submitted < len(unique_keys) and submitted < positions[key] + chem_info_bulk_concurrency:
+					next_key = unique_keys[submitted]
+					next_request = dict(shared_inputs, chemical=chemicals[first_index[next_key]])
+					futures[next_key] = chem_info_bulk_executor.submit(cts_context.run_in_context(getBulkChemInfo), next_request)
+					submitted += 1
+				result = futures[key].result()
+				if last_index[key] == index:
+					del futures[key]
+				yield 'molecule', dict(result, index=index, chemical=chemical)
+			yield 'done', {'count': len(chemicals), 'unique': len(unique_keys)}
+		finally:
+			for future in futures.values():
+				future.cancel()  # e.g., client disconnected
+
+	return streamResponse(records(), stream_format)
+
+
+def getBulkChemInfo(request_post):
+	"""
+	Chem info for a chemical in a bulk /molecule request,
+	with errors in the result rather than raised.
+	"""
+	with track_request('getChemicalEditorDataBulk') as tracker:
+		try:
+			results = chem_info_cache.get_cheminfo(request_post)
+		except Exception as e:
+			logging.warning("exception in cts_rest.py getBulkChemInfo: {}".format(e))
+			tracker.failed()
+			return {'status': False, 'error': "Cannot validate chemical"}
+		if not isinstance(results, dict):
+			tracker.failed()
+			return {'status': False, 'error': "Cannot validate chemical"}
+		return {key: val for key, val in results.items() if key != 'request_post'}
+
+
+def requestChemInfo(request_post):
+	"""
+	Gets chem info from the calc server (see chem_info_cache).
+	"""
+	logging.info("Making request for chem info.")
+	with time_stage('calculator', 'chem_info'):
+		return chem_info_obj.get_cheminfo(request_post)
 
 
 def getChemicalSpeciationData(request_dict):
@@ -715,25 +1327,641 @@ def getChemicalSpeciationData(request_dict):
 	:param request - chemspec_model
 	:return: chemical speciation data response json
 	"""
+	with track_request('getChemicalSpeciationData', 'speciation') as tracker:
+		try:
+			wrapped_post = {
+				'status': True,  # 'metadata': '',
+				'data': getSpeciationResults(request_dict)
+			}
+			with time_stage('json', 'speciation'):
+				json_data = cts_json.dumps(wrapped_post)
+			return HttpResponse(json_data, content_type='application/json')
+		except CalcRequestError as error:
+			tracker.failed()
+			return HttpResponse(cts_json.dumps(error.response_obj), content_type='application/json')
+		except CalcUnavailableError as error:
+			tracker.failed()
+			return getCalcUnavailableResponse('speciation', error)
+		except Exception as error:
+			logging.warning("Error in cts_rest, getChemicalSpecation(): {}".format(error))
+			tracker.failed()
+			return HttpResponse("Error getting speciation data")
+
+
+def getSpeciationResults(request_dict):
+	"""
+	Filters request_dict's chemical, then gets its speciation
+	results, over a pH grid if it has a "pH_grid".
+	"""
+	with time_stage('filter', 'speciation'):
+		filtered_smiles = filterSMILES(request_dict.get('chemical'))
+	request_dict['chemical'] = filtered_smiles
+	# Calls chemaxon calculator to get speciation results:
+	if request_dict.get('pH_grid'):
+		return getSpeciationGridData(request_dict)
+	return getSpeciationData(request_dict)
+
+
+def getSpeciationData(request_dict):
+	"""
+	Gets chemaxon speciation results for a filtered chemical, from
+	speciation_cache if they're there, otherwise from chemaxon
+	(through pchem_flight).
+	"""
+	cache_key = getSpeciationCacheKey(request_dict)
+	speciation_results = speciation_cache.get(cache_key)
+	if speciation_results is not None:
+		return withRequestEcho(speciation_results, request_dict)
+
+	def request_speciation_data():
+		speciation_results = requestCalculator('speciation', calc_registry.get('chemaxon').get_calc().data_request_handler, request_dict, backend='chemaxon')
+		speciation_results = withoutRequestEcho(speciation_results, request_dict)
+		if isCacheablePchemData(speciation_results) and not 'error' in speciation_results:
+			speciation_cache.set(cache_key, speciation_results)
+		return speciation_results
+
+	speciation_results = pchem_flight.do(cache_key, request_speciation_data, lambda: speciation_cache.get(cache_key))
+	return withRequestEcho(speciation_results, request_dict)
+
+
+def getSpeciationGridData(request_dict):
+	"""
+	Gets the microspecies distribution at every pH of a grid, e.g.,
+	"pH_grid": {"lower": 0, "upper": 14, "increment": 0.1}, from one
+	chemaxon pKa calculation over the grid's pH range. The results get
+	"pH_grid" (the pH values) and "distribution" ([{'pH': pH,
+	'microspecies': {microspecies: percent}}]) keys.
+	"""
+	ph_grid = getPHGrid(request_dict)
+	grid_request = dict(request_dict)
+	del grid_request['pH_grid']
+	grid_request.update({
+		'pKa_pH_lower': ph_grid[0],
+		'pKa_pH_upper': ph_grid[-1],
+		'pKa_pH_increment': round(ph_grid[1] - ph_grid[0], 4) if len(ph_grid) > 1 else 1.0,
+	})
+	speciation_results = getSpeciationData(grid_request)
+	if not isinstance(speciation_results, dict):
+		return speciation_results
+	speciation_results = dict(speciation_results, pH_grid=ph_grid)
 	try:
-		filtered_smiles = SMILESFilter().filterSMILES(request_dict.get('chemical'))
-		request_dict['chemical'] = filtered_smiles
-		# Calls chemaxon calculator to get speciation results:
-		chemaxon_calc = JchemCalc()
-		speciation_results = chemaxon_calc.data_request_handler(request_dict)
-		wrapped_post = {
-			'status': True,  # 'metadata': '',
-			'data': speciation_results
+		micro_dist_data = speciation_results['data']['pka']['microDistData']
+		speciation_results['distribution'] = splitMicrospeciesDistribution(micro_dist_data, ph_grid)
+	except (KeyError, TypeError) as e:
+		logging.warning("No microspecies distribution in speciation results: {}".format(e))
+		speciation_results['distribution'] = None
+	return speciation_results
+
+
+def getPHGrid(request_dict):
+	"""
+	Returns the list of pH values for a request's "pH_grid"
+	({"lower", "upper", "increment"}, or true for 0-14 by 0.1).
+	Raises CalcRequestError for an invalid grid.
+	"""
+	ph_grid = request_dict.get('pH_grid')
+	if not isinstance(ph_grid, dict):
+		ph_grid = {}
+	try:
+		lower = float(ph_grid.get('lower', 0))
+		upper = float(ph_grid.get('upper', 14))
+		increment = float(ph_grid.get('increment', 0.1))
+	except (TypeError, ValueError):
+		lower, upper, increment = 0, -1, 0
+	num_points = int(round((upper - lower) / increment)) + 1 if increment > 0 else 0
+	if not (0 <= lower <= upper <= 14) or num_points < 1 or num_points > ph_grid_max_points:
+		_response_obj = {
+			'error': "pH_grid needs 0 <= lower <= upper <= 14 and increment > 0, with up to {} pH values".format(ph_grid_max_points),
+			'chemical': request_dict.get('chemical'),
+			'pH_grid': request_dict.get('pH_grid'),
 		}
-		json_data = json.dumps(wrapped_post)
-		return HttpResponse(json_data, content_type='application/json')
-	except Exception as error:
-		logging.warning("Error in cts_rest, getChemicalSpecation(): {}".format(error))
-		return HttpResponse("Error getting speciation data")
+		raise CalcRequestError(_response_obj)
+	return [round(lower + index * increment, 4) for index in range(num_points)]
+
+
+def splitMicrospeciesDistribution(micro_dist_data, ph_grid):
+	"""
+	Turns chemaxon's microspecies distribution ({microspecies:
+	[[pH, percent], ...]}) into one entry per pH in ph_grid.
+	"""
+	distribution = collections.OrderedDict((ph, {}) for ph in ph_grid)
+	for microspecies, points in micro_dist_data.items():
+		for ph, percent in points:
+			ph = round(float(ph), 4)
+			if ph in distribution:
+				distribution[ph][microspecies] = percent
+	return [{'pH': ph, 'microspecies': microspecies} for ph, microspecies in distribution.items()]
+
+
+def submitCalcJob(calc, request_dict):
+	"""
+	Submits a runCalc job (e.g., for a deep metabolizer tree) and returns
+	its status. When it's done, the job's result is the runCalc response.
+	"""
+	if calc_registry.get(calc) is None and calc != 'speciation':
+		return HttpResponse(cts_json.dumps({'error': "calc not recognized"}), content_type='application/json')
+	if hasattr(request_dict, 'dict'):
+		request_dict = request_dict.dict()  # QueryDict
+
+	def run_job(progress):
+		response = getSharedCTSREST().runCalc(calc, dict(request_dict))
+		return response.content, response.status_code
+
+	return submitJob('run', {'calc': calc, 'request': request_dict}, run_job)
+
+
+def submitBatchJob(request_dict):
+	"""
+	Submits a runBatch job, with progress in cells done.
+	"""
+	def run_job(progress):
+		response = getSharedCTSREST().runBatch(request_dict, progress=progress)
+		return response.content, response.status_code
+
+	return submitJob('batch', {'request': request_dict}, run_job)
+
+
+def submitJob(kind, params, run_job):
+	try:
+		job = job_manager.submit(kind, params, run_job)
+	except JobQueueFullError as e:
+		response = HttpResponse(cts_json.dumps({'error': "{}, try again later".format(e)}), content_type='application/json', status=503)
+		response['Retry-After'] = str(e.retry_after)
+		return response
+	return getJobStatusResponse(job)
+
+
+def getJobResponse(job_id):
+	"""
+	The job's status and progress (202 while it's queued or running).
+	"""
+	job = job_manager.get_job(job_id)
+	if job is None:
+		return getJobNotFoundResponse(job_id)
+	return getJobStatusResponse(job)
+
+
+def getJobResultResponse(job_id):
+	"""
+	The done job's response, or its status if it's not done
+	(202 while it's queued or running, with an 'error' if it failed).
+	"""
+	job = job_manager.get_job(job_id)
+	if job is None:
+		return getJobNotFoundResponse(job_id)
+	if job['status'] != 'done':
+		return getJobStatusResponse(job)
+	result = job_manager.get_result(job_id)
+	if result is None:
+		return getJobNotFoundResponse(job_id)
+	return HttpResponse(result, content_type='application/json')
+
+
+def getJobStatusResponse(job):
+	status = 202 if job['status'] in ('queued', 'running') else 200
+	return HttpResponse(cts_json.dumps(job), content_type='application/json', status=status)
+
+
+def getJobNotFoundResponse(job_id):
+	return HttpResponse(
+		cts_json.dumps({'error': "job not found, or expired", 'jobId': job_id}),
+		content_type='application/json',
+		status=404
+	)
+
+
+def getSharedCTSREST():
+	"""
+	CTS_REST instance built once per process, for reading
+	its endpoint lists and metadata (don't modify it).
+	"""
+	return calc_registry.get('cts').get_rest_obj()
+
+
+def getMetaInfoJSON(calc):
+	"""
+	The calc's meta_info, with pre-encoded (cts_json.RawJSON) values
+	to splice into responses with cts_json.dumps_envelope, and a new
+	metaInfo timestamp.
+	"""
+	return calc_registry.get(calc).get_meta_info_json(gen_jid())
+
+
+def withTimestamp(meta_info):
+	"""
+	Copy of a (shared) meta_info with a new metaInfo timestamp
+	for a response.
+	"""
+	if not isinstance(meta_info.get('metaInfo'), dict):
+		return dict(meta_info)
+	return dict(meta_info, metaInfo=dict(meta_info['metaInfo'], timestamp=gen_jid()))
+
+
+def getPreparedResponse(key, build_response):
+	"""
+	Gets the PreparedResponse for key, building and
+	serializing it with build_response() on first use.
+	"""
+	prepared = prepared_responses.get(key)
+	if prepared is None:
+		prepared = prepareMetadataResponse(build_response())
+		prepared_responses[key] = prepared
+	return prepared
+
+
+def prepareMetadataResponse(response_obj):
+	"""
+	PreparedResponse for endpoint metadata. Its ETag leaves out the
+	metaInfo timestamps (set when a process builds its REST objects),
+	so every process and restart has the same ETag for the same content.
+	"""
+	return PreparedResponse(cts_json.dumps(response_obj), etag_body=cts_json.dumps(withoutTimestamps(response_obj)))
+
+
+def withoutTimestamps(response_obj):
+	"""
+	Copy of response_obj without 'timestamp' keys, in nested dicts too.
+	"""
+	if not isinstance(response_obj, dict):
+		return response_obj
+	return {key: withoutTimestamps(val) for key, val in response_obj.items() if key != 'timestamp'}
+
+
+def getCTSRESTResponse(request=None):
+	return getPreparedResponse(('cts',), lambda: getSharedCTSREST().buildCTSREST()).response(request)
+
+
+def getCalcEndpointsResponse(calc, request=None):
+	return getPreparedResponse(('endpoints', calc), lambda: getSharedCTSREST().buildCalcEndpoints(calc)).response(request)
+
+
+def getCalcInputsResponse(chemical, calc, prop=None, request=None):
+	"""
+	Inputs responses depend on the requested chemical and prop,
+	so they're kept in a bounded LRU instead of prepared_responses.
+	"""
+	key = json.dumps([calc, chemical, prop])
+	prepared = prepared_inputs_responses.get(key)
+	if prepared is None:
+		_response = getSharedCTSREST().buildCalcInputs(chemical, calc, prop)
+		prepared = prepareMetadataResponse(_response)
+		prepared_inputs_responses.set(key, prepared, metadata_cache_ttl)
+	return prepared.response(request)
+
+
+def filterSMILES(smiles):
+	"""
+	SMILESFilter().filterSMILES, memoized in smiles_memo.
+	"""
+	filtered_smiles = smiles_memo.get(smiles) if isinstance(smiles, str) else None
+	if filtered_smiles is not None:
+		return filtered_smiles
+	if not hasattr(smiles_filter_local, 'smiles_filter'):
+		smiles_filter_local.smiles_filter = SMILESFilter()
+	filtered_smiles = smiles_filter_local.smiles_filter.filterSMILES(smiles)
+	if isinstance(smiles, str) and isinstance(filtered_smiles, str) and filtered_smiles:
+		smiles_memo.set(smiles, filtered_smiles)
+	return filtered_smiles
+
+
+def requestCalculator(calc, func, *args, prop=None, backend=None):
+	"""
+	Makes a calculator server request, func(*args), through the
+	backend's admission control (backend defaults to calc). Raises
+	CalcUnavailableError if the backend is down or too busy.
+	"""
+	admission = getCalcAdmission(calc_registry.get_name(backend or calc))
+	with time_stage('calculator', calc, prop):
+		if admission is None:
+			return func(*args)
+		return admission.call(func, *args)
+
+
+def getCalcAdmission(calc):
+	"""
+	Returns the calc server's CalcAdmission, created on first use,
+	or None for calcs without a concurrency limit.
+	"""
+	if not calc_admission_enabled or not calc in calc_concurrency_limits:
+		return None
+	admission = calc_admission.get(calc)
+	if admission is None:
+		with calc_admission_lock:
+			admission = calc_admission.get(calc)
+			if admission is None:
+				max_limit = calc_concurrency_limits[calc]
+				admission = CalcAdmission(
+					AdaptiveLimiter(max(1, max_limit // 2), 1, max_limit, name=calc),
+					CircuitBreaker(circuit_failure_threshold, circuit_reset_timeout, name=calc),
+					calc_queue_timeout,
+					is_failure=isCalcServerFailure
+				)
+				calc_admission[calc] = admission
+				metrics_registry.add_stats('cts_calc_admission_{}'.format(calc), admission.stats)
+	return admission
+
+
+def isCalcServerFailure(calc_response):
+	"""
+	Calculator responses with status False (e.g., "Cannot reach OPERA")
+	count as calc server failures, invalid chemicals don't.
+	"""
+	return isinstance(calc_response, dict) and calc_response.get('status') is False
+
+
+def getCalcUnavailableResponse(calc, error):
+	response = HttpResponse(
+		cts_json.dumps({'error': "{}, try again later".format(error), 'calc': calc}),
+		content_type='application/json',
+		status=503
+	)
+	response['Retry-After'] = str(error.retry_after)
+	return response
+
+
+def pickEpiProp(pchem_data, prop, epi_calc):
+	"""
+	Picks prop's data out of an EPI Suite response with every prop,
+	using pchem table names for the prop and its methods.
+	"""
+	_methods_list = []
+	for data_obj in pchem_data.get('data'):
+		epi_prop_name = epi_calc.propMap[prop]['result_key']
+		if data_obj['prop'] == epi_prop_name:
+			if data_obj.get('method'):
+				_epi_methods = epi_calc.propMap.get(prop).get('methods')
+				data_obj['method'] = _epi_methods.get(data_obj['method'])  # use pchem table name for method
+				_methods_list.append(data_obj)
+			else:
+				pchem_data['data'] = data_obj['data'] # only want request prop
+			pchem_data['prop'] = prop  # use cts prop name
+	if len(_methods_list) > 0:
+		# epi water solubility has two data objects..
+		pchem_data['data'] = _methods_list
+	return pchem_data
+
+
+def pickMeasuredProp(pchem_data, prop, measured_calc):
+	"""
+	Picks prop's data out of a measured response with every prop.
+	"""
+	for data_obj in pchem_data.get('data'):
+		measured_prop_name = measured_calc.propMap[prop]['result_key']
+		if data_obj['prop'] == measured_prop_name:
+			pchem_data['data'] = data_obj['data'] # only want request prop
+			pchem_data['prop'] = prop  # use cts prop name
+	return pchem_data
+
+
+def isPchemCalc(calc):
+	"""
+	Whether calc is a registered p-chem calc (or an alias of one).
+	"""
+	handler = calc_registry.get(calc) if isinstance(calc, str) else None
+	return handler is not None and handler.pchem
+
+
+def getPropCalcs():
+	"""
+	Returns {prop: [(calc, methods or None)]} from the availableProps
+	in each p-chem calc's metaInfo (e.g., Chemaxon_CTS_REST's).
+	"""
+	prop_calcs = collections.OrderedDict()
+	for calc in calc_registry.names(pchem=True):
+		meta_info = calc_registry.get(calc).get_rest_obj().meta_info.get('metaInfo', {})
+		for available_prop in meta_info.get('availableProps', []):
+			prop_calcs.setdefault(available_prop['prop'], []).append((calc, available_prop.get('methods')))
+	return prop_calcs
+
+
+def getPchemTableExecutor(calc):
+	"""
+	The calc's p-chem table workers, created on first use: up to
+	pchem_table_workers, or the calc's concurrency limit if it's lower.
+	A slow calc only fills its own workers, not other calcs'.
+	"""
+	calc = calc_registry.get_name(calc)
+	executor = pchem_table_executors.get(calc)
+	if executor is None:
+		with pchem_table_executors_lock:
+			executor = pchem_table_executors.get(calc)
+			if executor is None:
+				executor = pchem_table_executors[calc] = ThreadPoolExecutor(
+					max_workers=max(1, min(pchem_table_workers, calc_concurrency_limits.get(calc, pchem_table_workers))),
+					thread_name_prefix='cts-pchem-table-{}'.format(calc)
+				)
+	return executor
+
+
+def getPchemTableTimeout(calc, requested_timeout=None):
+	"""
+	Seconds a p-chem table cell for calc has, from pchem_table_timeouts
+	or pchem_table_timeout. A request's 'timeout' can only shorten it.
+	"""
+	timeout = pchem_table_timeouts.get(calc_registry.get_name(calc), pchem_table_timeout)
+	try:
+		if requested_timeout is not None:
+			timeout = min(timeout, max(float(requested_timeout), 0))
+	except (TypeError, ValueError):
+		pass
+	return timeout
+
+
+def batchCellResult(cell, pchem_data=None, error=None):
+	"""
+	Batch table item for a cell's p-chem data or error.
+	"""
+	result = {
+		'chemical': cell.get('chemical'),
+		'orig_smiles': cell.get('orig_smiles'),
+		'calc': cell['calc'],
+		'prop': cell['prop'],
+	}
+	if cell.get('method'):
+		result['method'] = cell['method']
+	if error is not None:
+		result['error'] = error
+	else:
+		result['data'] = pchem_data
+	return result
+
+
+def getProgenyTreeCacheKey(metabolizer_request, unranked):
+	"""
+	Cache key for metabolizer progeny trees, from the parent structure,
+	transformation libraries, and metabolizer settings. The structure
+	is the one the tree is built from, not the filtered SMILES, as the
+	tree's root has it (e.g., its 'smiles' and 'name').
+	"""
+	return progeny_tree_cache.cache.make_key(
+		metabolizer_request['structure'],
+		sorted(metabolizer_request.get('transformationLibraries', [])),
+		unranked,
+		metabolizer_request.get('populationLimit'),
+		metabolizer_request.get('likelyLimit'),
+		metabolizer_request.get('excludeCondition')
+	)
+
+
+def getPchemCacheKey(calc, request_dict):
+	"""
+	Cache key for p-chem data, from the filtered SMILES, calc, prop,
+	method, and pH (only for pH-dependent props). Aliases share
+	their calc's keys.
+	"""
+	calc = calc_registry.get_name(calc)
+	prop = request_dict.get('prop')
+	ph = None
+	if prop in ph_dependent_props:
+		ph = float(request_dict.get('ph', 7.4))
+	return pchem_cache.make_key(request_dict.get('chemical'), calc, prop, ph, request_dict.get('method'))
+
+
+def getSpeciationCacheKey(request_dict):
+	"""
+	Speciation results are cached by filtered SMILES and every
+	speciation input (pKa, isoelectric point, tautomer, etc.).
+	"""
+	speciation_inputs = {}
+	for key, val in request_dict.items():
+		if key in ('chemical', 'orig_smiles', 'stream'):
+			continue
+		try:
+			val = float(val)  # "7.4" and 7.4 share an entry
+		except (TypeError, ValueError):
+			pass
+		speciation_inputs[key] = val
+	return speciation_cache.make_key(request_dict.get('chemical'), 'speciation', speciation_inputs)
+
+
+def isCacheablePchemData(pchem_data):
+	"""
+	Only successful calculator results are cached.
+	"""
+	if not isinstance(pchem_data, dict) or not pchem_data:
+		return False
+	return pchem_data.get('valid') is not False and pchem_data.get('status') is not False
+
+
+def withoutRequestEcho(pchem_data, request_dict):
+	"""
+	Copy of calculator results for caching and sharing between requests,
+	without the fields echoed from request_dict ('request_post', and
+	request keys like 'orig_smiles' in the results or their 'data').
+	Echoed fields are kept in place as None, and listed in 'requestEcho'
+	for withRequestEcho.
+	"""
+	if not isinstance(pchem_data, dict) or 'requestEcho' in pchem_data:
+		return pchem_data
+	cached = dict(pchem_data)
+	request_echo = {'fields': [], 'dataFields': [], 'requestPost': 'request_post' in cached}
+	if request_echo['requestPost']:
+		cached['request_post'] = None
+	for key, val in request_dict.items():
+		if key in cached and cached[key] == val:
+			cached[key] = None
+			request_echo['fields'].append(key)
+	if isinstance(cached.get('data'), dict):
+		cached['data'] = dict(cached['data'])
+		for key, val in request_dict.items():
+			if key in cached['data'] and cached['data'][key] == val:
+				cached['data'][key] = None
+				request_echo['dataFields'].append(key)
+	cached['requestEcho'] = request_echo
+	return cached
+
+
+def withRequestEcho(cached, request_dict):
+	"""
+	Copy of results from withoutRequestEcho, with the echoed
+	fields filled in from request_dict (the current request).
+	"""
+	if not isinstance(cached, dict) or not 'requestEcho' in cached:
+		return cached  # e.g., cache entries from before requestEcho
+	pchem_data = dict(cached)
+	request_echo = pchem_data.pop('requestEcho')
+	fillRequestEcho(pchem_data, request_echo.get('fields', []), request_dict)
+	if request_echo.get('dataFields') and isinstance(pchem_data.get('data'), dict):
+		pchem_data['data'] = dict(pchem_data['data'])
+		fillRequestEcho(pchem_data['data'], request_echo['dataFields'], request_dict)
+	if request_echo.get('requestPost'):
+		pchem_data['request_post'] = dict(request_dict)
+	return pchem_data
+
+
+def fillRequestEcho(obj, fields, request_dict):
+	for key in fields:
+		if key in request_dict:
+			obj[key] = request_dict[key]
+		else:
+			obj.pop(key, None)
+
+
+def iterMetabolizerGenerations(tree_updates):
+	"""
+	Yields the metabolizer progeny tree one generation at a time, as
+	tree_updates ((tree, generation) pairs, see ProgenyTreeCache.iter_tree)
+	finish them. Each node is sent without its children, and with its
+	'parent' id. Ids are given in generation order, as the tree's own
+	(depth-first) ids aren't known until it's complete.
+	"""
+	generation, previous, next_id = 0, None, None
+	for progeny_tree, done_generation in tree_updates:
+		while generation <= done_generation:
+			if previous is None:
+				next_id = progeny_tree.get('id', 1)
+				level = [(None, progeny_tree)]
+			else:
+				level = [(parent_id, child) for parent_id, node in previous for child in node.get('children', [])]
+			if not level:
+				break  # no more products, the rest of tree_updates just caches the tree
+			nodes, previous = [], []
+			for parent_id, node in level:
+				node_obj = {key: val for key, val in node.items() if key != 'children'}
+				node_obj.update({'id': next_id, 'parent': parent_id})
+				nodes.append(node_obj)
+				previous.append((next_id, node))
+				next_id += 1
+			yield {'generation': generation, 'nodes': nodes}
+			generation += 1
+
+
+def streamResponse(records, stream_format):
+	"""
+	Wraps (event, obj) records in a StreamingHttpResponse, either
+	as NDJSON lines or as server-sent events.
+	"""
+	if stream_format == 'sse':
+		lines = ("event: {}\ndata: {}\n\n".format(event, cts_json.dumps_str(obj)) for event, obj in records)
+		response = StreamingHttpResponse(lines, content_type='text/event-stream')
+	else:
+		lines = (cts_json.dumps_str(dict(obj, event=event)) + "\n" for event, obj in records)
+		response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+	response['Cache-Control'] = 'no-cache'
+	response['X-Accel-Buffering'] = 'no'  # keeps nginx from buffering the stream
+	return response
+
+
+def loadSMILESMemo():
+	"""
+	Warms smiles_memo at startup from CTS_SMILES_MEMO_FILE, if set.
+	"""
+	memo_path = os.environ.get('CTS_SMILES_MEMO_FILE')
+	if not memo_path:
+		return
+	try:
+		smiles_memo.load(memo_path)
+	except (OSError, ValueError) as e:
+		logging.warning("Could not load SMILES memo file {}: {}".format(memo_path, e))
 
 
 def gen_jid():
 	ts = datetime.datetime.now(pytz.UTC)
 	localDatetime = ts.astimezone(pytz.timezone('US/Eastern'))
 	jid = localDatetime.strftime('%Y%m%d%H%M%S%f')
-	return jid
\ No newline at end of file
+	return jid
+
+
+
+loadSMILESMemo()
+registerCalcs()
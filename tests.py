@@ -1,3 +1,1799 @@
-from django.test import TestCase
+import collections
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.http import QueryDict
+from django.test import SimpleTestCase, RequestFactory
+
+from cts_app.cts_api.cts_cache import ResultCache, MemoryCacheBackend, FileCacheBackend, NullCache, MemoTable, create_cache
+from cts_app.cts_api.cts_db import MongoHandlerPool
+from cts_app.cts_api.cts_opera import OperaBulkResolver
+from cts_app.cts_api.cts_chem_info import ChemInfoCache
+from cts_app.cts_api.cts_responses import PreparedResponse, JSONFileAsset, validate_swagger
+from cts_app.cts_api.cts_metabolizer import ProgenyTreeCache, ConcurrentTreeBuilder, prune_tree, graft_subtree, get_generation, count_nodes
+from cts_app.cts_api.cts_json import RawJSON, dumps_envelope
+from cts_app.cts_api import cts_json
+from cts_app.cts_api import cts_context
+from cts_app.cts_api import cts_metrics
+from cts_app.cts_api import cts_profiling
+from cts_app.cts_api import views
+from cts_app.cts_api.cts_registry import CalcHandler, CalcRegistry
+from cts_app.cts_api.cts_jobs import JobManager, JobQueueFullError
+from cts_app.cts_api import cts_rest
+from cts_app.cts_api.benchmarks import run as benchmarks_run
+from cts_app.cts_api.cts_concurrency import SingleFlight, AdaptiveLimiter, CircuitBreaker, CalcAdmission, AdmissionTimeoutError, CircuitOpenError
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+
+
+class BrokenCacheBackend(object):
+	"""
+	Cache backend that's always unreachable.
+	"""
+	evictions = 0
+
+	def get(self, key):
+		raise ConnectionError("cache is down")
+
+	def set(self, key, value, ttl):
+		raise ConnectionError("cache is down")
+
+
+
+class ResultCacheTests(SimpleTestCase):
+
+	def test_make_key(self):
+		key = ResultCache.make_key('CCO', 'chemaxon', 'water_sol', None, None)
+		self.assertEqual(key, ResultCache.make_key('CCO', 'chemaxon', 'water_sol', None, None))
+		self.assertNotEqual(key, ResultCache.make_key('CCO', 'chemaxon', 'water_sol', 7.4, None))
+		self.assertNotEqual(key, ResultCache.make_key('chemaxon', 'CCO', 'water_sol', None, None))
+		self.assertEqual(ResultCache.make_key({'a': 1, 'b': 2}), ResultCache.make_key({'b': 2, 'a': 1}))
+
+	def test_get_and_set(self):
+		cache = ResultCache(MemoryCacheBackend())
+		self.assertIsNone(cache.get('key'))
+		pchem_data = {'valid': True, 'data': 1.23, 'chemical': 'CCO'}
+		cache.set('key', pchem_data)
+		cached = cache.get('key')
+		self.assertEqual(cached, pchem_data)
+		cached['data'] = 4.56
+		self.assertEqual(cache.get('key')['data'], 1.23)  # a fresh copy every get
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+	def test_expired_entry(self):
+		cache = ResultCache(MemoryCacheBackend())
+		cache.set('key', {'data': 1}, ttl=-1)
+		self.assertIsNone(cache.get('key'))
+		self.assertEqual(cache.backend.size(), 0)
+
+	def test_memory_backend_lru(self):
+		backend = MemoryCacheBackend(max_entries=2)
+		backend.set('a', '1', 60)
+		backend.set('b', '2', 60)
+		backend.get('a')  # b is now least recently used
+		backend.set('c', '3', 60)
+		self.assertIsNone(backend.get('b'))
+		self.assertEqual((backend.get('a'), backend.get('c')), ('1', '3'))
+		self.assertEqual(backend.evictions, 1)
+
+	def test_file_backend(self):
+		with tempfile.TemporaryDirectory() as cache_dir:
+			cache = ResultCache(FileCacheBackend(cache_dir, max_entries=2, prune_every=1))
+			for index in range(3):
+				cache.set("key{}".format(index), {'data': index})
+			self.assertEqual(cache.backend.size(), 2)
+			self.assertEqual(cache.get('key2'), {'data': 2})
+			cache.set('expired', {'data': 3}, ttl=-1)
+			self.assertIsNone(cache.get('expired'))
+
+	def test_file_backend_temp_files(self):
+		with tempfile.TemporaryDirectory() as cache_dir:
+			backend = FileCacheBackend(cache_dir)
+			with mock.patch('os.replace', side_effect=OSError("disk full")):
+				with self.assertRaises(OSError):
+					backend.set('key', '{}', 60)
+			self.assertEqual(os.listdir(cache_dir), [])  # temp file removed
+			with mock.patch('os.getpid', return_value=1234), mock.patch('os.replace') as replace:
+				backend.set('key', '{}', 60)
+			self.assertIn('.1234.', replace.call_args[0][0])  # unique across processes, not just threads
+
+	def test_concurrent_stats(self):
+		cache = ResultCache(MemoryCacheBackend())
+		cache.set('key', {'data': 1})
+		with ThreadPoolExecutor(max_workers=8) as executor:
+			for _ in executor.map(lambda index: cache.get('key' if index % 2 else 'missing'), range(2000)):
+				pass
+		self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1000, 1000))
+
+	def test_backend_errors(self):
+		cache = ResultCache(BrokenCacheBackend())
+		with self.assertLogs(level='WARNING'):
+			cache.set('key', {'data': 1})
+			self.assertIsNone(cache.get('key'))
+		self.assertEqual(cache.stats()['errors'], 2)
+
+	def test_create_cache(self):
+		with mock.patch.dict(os.environ, {'CTS_CACHE_BACKEND': 'none'}):
+			self.assertIsInstance(create_cache('pchem'), NullCache)
+		with mock.patch.dict(os.environ, {'CTS_CACHE_BACKEND': 'memory', 'CTS_CACHE_MAX_ENTRIES': '5'}):
+			cache = create_cache('pchem')
+		self.assertIsInstance(cache.backend, MemoryCacheBackend)
+		self.assertEqual(cache.backend.max_entries, 5)
+
+
+
+class MemoTableTests(SimpleTestCase):
+
+	def test_normalize(self):
+		self.assertEqual(MemoTable.normalize("  C C\tO\n"), "C C O")
+		self.assertEqual(MemoTable.normalize("C/C=C\\\\C"), "C/C=C\\C")
+
+	def test_get_and_set(self):
+		memo = MemoTable(10)
+		self.assertIsNone(memo.get("CCO"))
+		memo.set(" CCO ", "".join(["C", "CO"]))
+		self.assertEqual(memo.get("CCO"), "CCO")
+		self.assertIs(memo.get("CCO"), memo.get(" CCO"))  # interned
+		self.assertEqual(memo.stats()['hits'], 3)
+
+	def test_lru(self):
+		memo = MemoTable(2)
+		memo.set("a", "A")
+		memo.set("b", "B")
+		memo.get("a")
+		memo.set("c", "C")
+		self.assertIsNone(memo.get("b"))
+		self.assertEqual((memo.get("a"), memo.get("c")), ("A", "C"))
+		self.assertEqual(memo.stats()['entries'], 2)
+
+	def test_dump_and_load(self):
+		memo = MemoTable(10)
+		memo.set("OCC", "CCO")
+		with tempfile.TemporaryDirectory() as memo_dir:
+			memo_path = os.path.join(memo_dir, 'memo.json')
+			memo.dump(memo_path)
+			loaded = MemoTable(10)
+			loaded.load(memo_path)
+		self.assertEqual(loaded.get("OCC"), "CCO")
+
+
+
+class MockMongoDBHandler(object):
+	"""
+	MongoDBHandler connected to a mongomock client.
+	"""
+	client = None
+
+	def __init__(self):
+		self.is_connected = False
+		self.mongodb_conn = None
+
+	def connect_to_db(self):
+		self.mongodb_conn = self.client
+		self.is_connected = self.client is not None
+
+
+
+class MockChemInfo(object):
+	"""
+	ChemInfo with DSSTox IDs from a dict, counting lookups.
+	"""
+	def __init__(self, dtxsids):
+		self.dtxsids = dtxsids
+		self.lookups = 0
+
+	def get_cheminfo(self, request_post, only_dsstox=False):
+		self.lookups += 1
+		return {'dsstoxSubstanceId': self.dtxsids.get(request_post['chemical'], "N/A")}
+
+
+
+class MockOperaCalc(object):
+	"""
+	OPERA model returning one data object per requested
+	chemical, keyed by chemical_key.
+	"""
+	def __init__(self, chemical_key='chemical'):
+		self.chemical_key = chemical_key
+		self.requests = []
+
+	def data_request_handler(self, request_dict):
+		self.requests.append(request_dict)
+		data = [
+			{self.chemical_key: chemical, 'prop': request_dict['prop'], 'data': 9.9}
+			for chemical in request_dict['chemical']
+		]
+		return {'status': True, 'valid': True, 'prop': request_dict['prop'], 'data': data}
+
+	def convert_units_for_cts(self, prop, data):
+		return dict(data, converted=True)
+
+
+
+@unittest.skipIf(mongomock is None, "mongomock isn't installed")
+class OperaBulkResolverTests(SimpleTestCase):
+
+	def setUp(self):
+		client = mongomock.MongoClient()
+		client['dsstox']['dsstox'].insert_many([
+			{'DTXSID': 'DTXSID1', 'DTXCID': 'DTXCID1'},
+			{'DTXSID': 'DTXSID2', 'DTXCID': 'DTXCID2'},
+		])
+		client['cts']['pchem'].insert_many([
+			{'dsstoxSubstanceId': 'DTXCID1', 'prop': 'water_sol', 'data': 1.0},
+			{'dsstoxSubstanceId': 'DTXCID1', 'prop': 'koc', 'data': 2.0},
+			{'dsstoxSubstanceId': 'DTXCID1', 'prop': 'kow_wph', 'ph': 5.0, 'data': 3.0},
+			{'dsstoxSubstanceId': 'DTXCID1', 'prop': 'kow_wph', 'ph': 7.4, 'data': 4.0},
+			{'dsstoxSubstanceId': 'DTXCID2', 'prop': 'water_sol', 'data': 5.0},
+		])
+		handler_class = type('ClientMongoDBHandler', (MockMongoDBHandler,), {'client': client})
+		self.db_pool = MongoHandlerPool(handler_class)
+		self.chem_info = MockChemInfo({'CCO': 'DTXSID1', 'CCC': 'DTXSID2', 'CCCC': 'DTXSID3'})
+		self.opera_calc = MockOperaCalc()
+		self.executor = ThreadPoolExecutor(max_workers=2)
+		self.resolver = OperaBulkResolver(self.db_pool, self.chem_info, lambda: self.opera_calc, self.executor)
+
+	def tearDown(self):
+		self.executor.shutdown()
+
+	def test_find_documents(self):
+		cells = [
+			{'chemical': 'CCO', 'prop': 'water_sol'},
+			{'chemical': 'CCO', 'prop': 'koc'},
+			{'chemical': 'CCC', 'prop': 'water_sol'},
+			{'chemical': 'CCC', 'prop': 'koc'},  # no document
+			{'chemical': 'CCCC', 'prop': 'water_sol'},  # no DTXCID
+			{'chemical': 'CCO', 'prop': 'water_sol'},
+		]
+		with mock.patch.object(self.db_pool, 'find_dtxcid_documents', wraps=self.db_pool.find_dtxcid_documents) as find_dtxcids, \
+				mock.patch.object(self.db_pool, 'find_pchem_documents', wraps=self.db_pool.find_pchem_documents) as find_pchem:
+			documents = self.resolver.find_documents(cells)
+		self.assertEqual(find_dtxcids.call_count, 1)  # $in queries
+		self.assertEqual(find_pchem.call_count, 1)
+		self.assertEqual(sorted(find_dtxcids.call_args[0][0]), ['DTXSID1', 'DTXSID2', 'DTXSID3'])
+		self.assertEqual(self.chem_info.lookups, 3)  # once per unique chemical
+		self.assertEqual(sorted(documents), [('CCC', 'water_sol', None), ('CCO', 'koc', None), ('CCO', 'water_sol', None)])
+		self.assertEqual(documents[('CCC', 'water_sol', None)]['data'], 5.0)
+
+	def test_find_documents_by_ph(self):
+		cells = [
+			{'chemical': 'CCO', 'prop': 'kow_wph', 'ph': 5},
+			{'chemical': 'CCO', 'prop': 'kow_wph', 'ph': '7.4'},
+			{'chemical': 'CCO', 'prop': 'kow_wph'},  # 7.4 by default
+			{'chemical': 'CCO', 'prop': 'kow_wph', 'ph': 9.0},  # no document
+		]
+		documents = self.resolver.find_documents(cells)
+		self.assertEqual(sorted(documents), [('CCO', 'kow_wph', 5.0), ('CCO', 'kow_wph', 7.4)])
+		self.assertEqual(documents[('CCO', 'kow_wph', 5.0)]['data'], 3.0)
+		self.assertEqual(documents[('CCO', 'kow_wph', 7.4)]['data'], 4.0)
+
+	def test_resolve(self):
+		cells = [
+			{'chemical': 'CCO', 'prop': 'kow_wph', 'ph': 5.0},
+			{'chemical': 'CCC', 'prop': 'water_sol'},
+			{'chemical': 'CCC', 'prop': 'koc'},
+			{'chemical': 'CCCC', 'prop': 'koc'},
+			{'chemical': 'CCO', 'prop': 'kow_wph', 'ph': 9.0},
+		]
+		results = self.resolver.resolve(cells)
+		self.assertEqual(len(results), len(cells))
+
+		self.assertEqual(results[0]['data']['data'], 3.0)  # from the DB
+		self.assertNotIn('_id', results[0]['data'])
+		self.assertTrue(results[0]['data']['converted'])
+		self.assertEqual(results[0]['request_post'], cells[0])
+		self.assertEqual(results[1]['data']['data'], 5.0)
+
+		# misses are run through the model once per prop (and pH):
+		self.assertEqual(sorted((request['prop'], tuple(request['chemical'])) for request in self.opera_calc.requests), [
+			('koc', ('CCC', 'CCCC')),
+			('kow_wph', ('CCO',)),
+		])
+		self.assertEqual(results[2]['data'], {'chemical': 'CCC', 'prop': 'koc', 'data': 9.9})
+		self.assertEqual(results[3]['data'], {'chemical': 'CCCC', 'prop': 'koc', 'data': 9.9})
+		self.assertEqual(results[4]['data'][0]['chemical'], 'CCO')
+
+	def test_resolve_without_db(self):
+		self.db_pool.handler_class.client = None
+		with self.assertLogs(level='WARNING'):
+			results = self.resolver.resolve([{'chemical': 'CCO', 'prop': 'koc'}, {'chemical': 'CCC', 'prop': 'koc'}])
+		self.assertEqual(len(self.opera_calc.requests), 1)
+		self.assertEqual([result['data']['chemical'] for result in results], ['CCO', 'CCC'])
+
+	def test_unmatched_model_response(self):
+		self.opera_calc.chemical_key = 'smiles'  # e.g., OPERA's own SMILES
+		with self.assertLogs(level='WARNING') as logs:
+			results = self.resolver.resolve([{'chemical': 'CCCC', 'prop': 'koc'}, {'chemical': 'CCC', 'prop': 'koc'}])
+		self.assertEqual([request['chemical'] for request in self.opera_calc.requests], [['CCCC', 'CCC'], ['CCCC'], ['CCC']])
+		self.assertEqual([result['data'][0]['smiles'] for result in results], ['CCCC', 'CCC'])
+		self.assertEqual(len(logs.output), 2)
+
+	def test_model_error(self):
+		self.opera_calc.data_request_handler = mock.Mock(side_effect=ConnectionError("OPERA is down"))
+		with self.assertLogs(level='WARNING'):
+			results = self.resolver.resolve([{'chemical': 'CCCC', 'prop': 'koc'}, {'chemical': 'CCCC', 'prop': 'water_sol'}])
+		self.assertEqual([result['status'] for result in results], [False, False])
+		self.assertEqual(results[0]['data'], "Cannot reach OPERA")
+
+
+
+
+class FakeAdmin(object):
+	"""
+	MongoClient.admin whose ping fails while down, or
+	blocks until released while hanging.
+	"""
+	def __init__(self):
+		self.down = False
+		self.pings = 0
+		self.hanging = None
+
+	def command(self, name):
+		self.pings += 1
+		if self.hanging is not None:
+			self.hanging.wait(5)
+		if self.down:
+			raise ConnectionError("MongoDB is down")
+		return {'ok': 1}
+
+
+
+class FakeClient(object):
+
+	def __init__(self):
+		self.admin = FakeAdmin()
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+
+
+class FakeMongoDBHandler(MockMongoDBHandler):
+	"""
+	MockMongoDBHandler with a new FakeClient per connection,
+	counting connections.
+	"""
+	available = True
+	connects = 0
+
+	def connect_to_db(self):
+		type(self).connects += 1
+		self.mongodb_conn = FakeClient()
+		self.is_connected = self.available
+
+
+
+class MongoHandlerPoolTests(SimpleTestCase):
+
+	def setUp(self):
+		self.handler_class = type('PoolMongoDBHandler', (FakeMongoDBHandler,), {})
+		self.pool = MongoHandlerPool(self.handler_class, health_check_interval=30, backoff_min=1, backoff_max=4)
+		self.now = 1000.0
+		patcher = mock.patch('cts_app.cts_api.cts_db.time.time', lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_shared_handler(self):
+		handler = self.pool.get_handler()
+		self.assertIsNotNone(handler)
+		self.now += 10
+		self.assertIs(self.pool.get_handler(), handler)
+		self.assertEqual(self.handler_class.connects, 1)
+		self.assertEqual(handler.mongodb_conn.admin.pings, 0)  # within the health check interval
+
+	def test_health_check_interval(self):
+		handler = self.pool.get_handler()
+		self.now += 31
+		self.assertIs(self.pool.get_handler(), handler)
+		self.assertEqual(handler.mongodb_conn.admin.pings, 1)
+		self.now += 10
+		self.pool.get_handler()
+		self.assertEqual(handler.mongodb_conn.admin.pings, 1)
+		self.pool.mark_failed()
+		self.pool.get_handler()
+		self.assertEqual(handler.mongodb_conn.admin.pings, 2)
+
+	def test_reconnect(self):
+		handler = self.pool.get_handler()
+		handler.mongodb_conn.admin.down = True
+		self.now += 31
+		with self.assertLogs(level='WARNING'):
+			new_handler = self.pool.get_handler()
+		self.assertIsNot(new_handler, handler)
+		self.assertTrue(new_handler.is_connected)
+		self.assertTrue(handler.mongodb_conn.closed)
+		self.assertEqual(self.handler_class.connects, 2)
+
+	def test_backoff(self):
+		self.handler_class.available = False
+		attempts = []
+		with self.assertLogs(level='WARNING'):
+			for _ in range(5):
+				self.assertIsNone(self.pool.get_handler())
+				attempts.append(self.handler_class.connects)
+				self.assertIsNone(self.pool.get_handler())  # backing off
+				self.assertEqual(self.handler_class.connects, attempts[-1])
+				self.now = self.pool.next_attempt
+		self.assertEqual(attempts, [1, 2, 3, 4, 5])
+		self.assertEqual(self.pool.backoff, 4)  # 1, 2, 4, then capped
+
+		self.handler_class.available = True
+		self.assertIsNotNone(self.pool.get_handler())
+		self.assertEqual(self.pool.backoff, 1)
+
+	def test_hanging_ping(self):
+		handler = self.pool.get_handler()
+		admin = handler.mongodb_conn.admin
+		admin.hanging = threading.Event()
+		self.now += 31
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			checking = executor.submit(self.pool.get_handler)
+			while admin.pings == 0:
+				time.sleep(0.001)
+			# other threads don't wait on the health check (or each other):
+			for _ in range(3):
+				self.assertIs(self.pool.get_handler(), handler)
+			self.assertEqual(admin.pings, 1)
+			admin.hanging.set()
+			self.assertIs(checking.result(), handler)
+		self.assertFalse(self.pool.checking)
+
+
+
+class MockChemInfoServer(object):
+	"""
+	Calc server chem info for ethanol by SMILES or CAS number,
+	counting requests.
+	"""
+	orig_smiles = {'OCC': 'OCC', '64-17-5': 'C(C)O'}  # as converted by the calc server
+
+	def __init__(self):
+		self.requests = 0
+
+	def get_cheminfo(self, request_post):
+		self.requests += 1
+		chemical = request_post['chemical']
+		data = {
+			'chemical': chemical,
+			'orig_smiles': self.orig_smiles[chemical.strip()],
+			'smiles': 'CCO',
+			'casrn': '64-17-5',
+			'dsstoxSubstanceId': 'DTXSID9020584',
+			'preferredName': 'Ethanol',
+		}
+		return {'status': True, 'request_post': dict(request_post), 'data': data}
+
+
+
+class ChemInfoCacheTests(SimpleTestCase):
+
+	def setUp(self):
+		self.server = MockChemInfoServer()
+		self.chem_info = ChemInfoCache(
+			ResultCache(MemoryCacheBackend()), ResultCache(MemoryCacheBackend()), None,
+			self.server.get_cheminfo, SingleFlight()
+		)
+
+	def test_aliases(self):
+		by_cas = self.chem_info.get_cheminfo({'chemical': '64-17-5'})
+		self.assertEqual(by_cas['data']['orig_smiles'], 'C(C)O')
+
+		by_smiles = self.chem_info.get_cheminfo({'chemical': 'CCO'})  # the cached SMILES alias
+		by_dsstox_id = self.chem_info.get_cheminfo({'chemical': 'DTXSID9020584'})
+		self.assertEqual(self.server.requests, 1)
+		self.assertEqual(by_smiles['request_post'], {'chemical': 'CCO'})
+		self.assertEqual(by_smiles['data']['chemical'], 'CCO')
+		self.assertEqual(by_smiles['data']['orig_smiles'], 'CCO')  # not the CAS request's
+		self.assertEqual(by_smiles['data']['preferredName'], 'Ethanol')
+		self.assertEqual(by_dsstox_id['data']['chemical'], 'DTXSID9020584')
+		self.assertEqual(by_dsstox_id['data']['orig_smiles'], 'CCO')
+
+		again_by_cas = self.chem_info.get_cheminfo({'chemical': ' 64-17-5 '})
+		self.assertEqual(again_by_cas['data']['chemical'], ' 64-17-5 ')
+		self.assertEqual(again_by_cas['data']['orig_smiles'], 'C(C)O')
+		self.assertEqual(by_cas['data']['chemical'], '64-17-5')  # responses aren't shared
+
+	def test_uncached_smiles(self):
+		self.chem_info.get_cheminfo({'chemical': '64-17-5'})
+		by_smiles = self.chem_info.get_cheminfo({'chemical': 'OCC'})  # not an alias
+		self.assertEqual(self.server.requests, 2)
+		self.assertEqual(by_smiles['data']['orig_smiles'], 'OCC')
+		by_cas = self.chem_info.get_cheminfo({'chemical': '64-17-5'})  # now cached as an alias of OCC's info
+		self.assertEqual(self.server.requests, 2)
+		self.assertEqual(by_cas['data']['chemical'], '64-17-5')
+		self.assertEqual(by_cas['data']['orig_smiles'], 'CCO')  # its SMILES, not OCC
+
+
+class PreparedResponseTests(SimpleTestCase):
+
+	def test_conditional_get(self):
+		prepared = PreparedResponse(b'{"metaInfo": {}}')
+		response = prepared.response(RequestFactory().get('/cts'))
+		self.assertEqual((response.status_code, response.content), (200, b'{"metaInfo": {}}'))
+		response = prepared.response(RequestFactory().get('/cts', HTTP_IF_NONE_MATCH=response['ETag']))
+		self.assertEqual(response.status_code, 304)
+
+	def test_etag_body(self):
+		first = PreparedResponse(b'{"timestamp": "1"}', etag_body=b'{}')
+		second = PreparedResponse(b'{"timestamp": "2"}', etag_body=b'{}')
+		self.assertEqual(first.etag, second.etag)
+		self.assertNotEqual(first.etag, PreparedResponse(b'{"timestamp": "1"}').etag)
+
+
+
+class SwaggerAssetTests(SimpleTestCase):
+
+	def setUp(self):
+		spec_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+		self.addCleanup(os.remove, spec_file.name)
+		with spec_file:
+			json.dump({'swagger': "2.0", 'paths': {'/cts': {}}}, spec_file, indent=4)
+		self.asset = JSONFileAsset(spec_file.name, validate_swagger)
+		self.factory = RequestFactory()
+
+	def write_spec(self, spec_json, mtime):
+		with open(self.asset.path, 'w') as spec_file:
+			spec_file.write(spec_json)
+		os.utime(self.asset.path, (mtime, mtime))
+
+	def test_gzip(self):
+		response = self.asset.response(self.factory.get('/cts/rest/swag', HTTP_ACCEPT_ENCODING='gzip, deflate'))
+		self.assertEqual(response['Content-Encoding'], 'gzip')
+		self.assertEqual(response['Vary'], 'Accept-Encoding')
+		self.assertEqual(json.loads(gzip.decompress(response.content)), {'swagger': "2.0", 'paths': {'/cts': {}}})
+
+		plain_response = self.asset.response(self.factory.get('/cts/rest/swag'))
+		self.assertFalse(plain_response.has_header('Content-Encoding'))
+		self.assertEqual(plain_response.content, b'{"swagger":"2.0","paths":{"/cts":{}}}')  # re-serialized, compact
+		self.assertNotEqual(plain_response['ETag'], response['ETag'])  # per encoding
+
+	def test_conditional_get(self):
+		for accept_encoding in ('', 'gzip'):
+			etag = self.asset.response(self.factory.get('/cts/rest/swag', HTTP_ACCEPT_ENCODING=accept_encoding))['ETag']
+			response = self.asset.response(self.factory.get('/cts/rest/swag', HTTP_ACCEPT_ENCODING=accept_encoding, HTTP_IF_NONE_MATCH='W/{}'.format(etag)))
+			self.assertEqual(response.status_code, 304)
+			self.assertEqual(response['ETag'], etag)
+
+	def test_reload(self):
+		prepared = self.asset.get_prepared()
+		self.assertIs(self.asset.get_prepared(), prepared)  # loaded once
+		etag = prepared.etag
+
+		self.write_spec('{"swagger": "2.0", "paths": {"/cts": {}, "/metrics": {}}}', self.asset.mtime + 10)
+		response = self.asset.response(self.factory.get('/cts/rest/swag', HTTP_IF_NONE_MATCH=etag))
+		self.assertEqual(response.status_code, 200)
+		self.assertIn('/metrics', json.loads(response.content)['paths'])
+
+		# an invalid edit keeps the last good spec:
+		self.write_spec('{"swagger": "2.0", "paths": {', self.asset.mtime + 10)
+		with self.assertLogs(level='WARNING'):
+			self.assertIn('/metrics', json.loads(self.asset.response().content)['paths'])
+		self.write_spec('{"swagger": "2.0"}', self.asset.mtime + 10)
+		with self.assertLogs(level='WARNING'):
+			self.assertIn('/metrics', json.loads(self.asset.response().content)['paths'])
+
+	def test_swagger_json(self):
+		response = views.getSwaggerJsonContent(self.factory.get('/cts/rest/swag', HTTP_ACCEPT_ENCODING='gzip'))
+		spec = json.loads(gzip.decompress(response.content))
+		self.assertIn('/batch/run', spec['paths'])
+
+
+
+def build_test_tree(structure, gen_limit, branching=2):
+	"""
+	Progeny tree like MetabolizerCalc().recursive's, with branching
+	products per node (named "<parent smiles>.<index>").
+	"""
+	node_ids = iter(range(1, 100000))
+
+	def build_node(smiles, generation):
+		node = {'id': next(node_ids), 'name': smiles, 'data': {'smiles': smiles, 'generation': generation}, 'children': []}
+		if generation < gen_limit:
+			node['children'] = [build_node("{}.{}".format(smiles, index), generation + 1) for index in range(branching)]
+		return node
+
+	return build_node(structure, 0)
+
+
+
+class TreeBuildCounter(object):
+	"""
+	build_tree for ProgenyTreeCache, counting (structure, gen_limit) builds.
+	"""
+	def __init__(self):
+		self.builds = []
+
+	def __call__(self, structure, gen_limit):
+		self.builds.append((structure, gen_limit))
+		return build_test_tree(structure, gen_limit)
+
+
+
+class ProgenyTreeTests(SimpleTestCase):
+
+	def test_prune_tree(self):
+		self.assertEqual(prune_tree(build_test_tree('CCO', 3), 1), build_test_tree('CCO', 1))
+
+	def test_graft_subtree(self):
+		tree = build_test_tree('CCO', 1)
+		leaf = tree['children'][1]
+		graft_subtree(leaf, build_test_tree(leaf['data']['smiles'], 2), 1)
+		self.assertEqual([node['data']['generation'] for node in get_generation(tree, 3)], [3, 3, 3, 3])
+		self.assertEqual(get_generation(tree, 3)[0]['data']['smiles'], 'CCO.1.0.0')
+		self.assertEqual(get_generation(tree, 2)[0]['data']['smiles'], 'CCO.1.0')
+
+	def test_cached_tree(self):
+		tree_cache = ProgenyTreeCache(ResultCache(MemoryCacheBackend()))
+		build_tree = TreeBuildCounter()
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 3, build_tree), build_test_tree('CCO', 3))
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 2, build_tree), build_test_tree('CCO', 2))  # pruned
+		self.assertEqual(build_tree.builds, [('CCO', 3)])
+
+		# deeper requests only expand the cached tree's leaves:
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 4, build_tree), build_test_tree('CCO', 4))
+		self.assertEqual(len(build_tree.builds), 1 + 8)
+		self.assertTrue(all(gen_limit == 1 for _, gen_limit in build_tree.builds[1:]))
+		self.assertEqual(tree_cache.stats()['extended'], 1)
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 4, build_tree), build_test_tree('CCO', 4))
+		self.assertEqual(len(build_tree.builds), 9)
+
+	def test_encoded_tree(self):
+		tree_cache = ProgenyTreeCache(ResultCache(MemoryCacheBackend()))
+		build_tree = lambda structure, gen_limit: json.dumps(build_test_tree(structure, gen_limit))  # like recursive()
+		encoded = tree_cache.get_tree('key', 'CCO', 2, build_tree, encoded=True)
+		self.assertIsInstance(encoded, RawJSON)
+		self.assertEqual(encoded.decode(), build_test_tree('CCO', 2))
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 2, build_tree, encoded=True).encoded, encoded.encoded)
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 1, build_tree, encoded=True).decode(), build_test_tree('CCO', 1))
+
+	def test_older_cache_entry(self):
+		cache = ResultCache(MemoryCacheBackend())
+		cache.set('key', {'generationLimit': 2, 'tree': build_test_tree('CCO', 2)})
+		build_tree = TreeBuildCounter()
+		self.assertEqual(ProgenyTreeCache(cache).get_tree('key', 'CCO', 1, build_tree), build_test_tree('CCO', 1))
+		self.assertEqual(build_tree.builds, [])
+
+
+
+class ConcurrentTreeBuilderTests(SimpleTestCase):
+
+	def setUp(self):
+		self.executor = ThreadPoolExecutor(max_workers=4)
+		self.builder = ConcurrentTreeBuilder(self.executor)
+
+	def tearDown(self):
+		self.executor.shutdown()
+
+	def test_build(self):
+		build_tree = TreeBuildCounter()
+		self.assertEqual(self.builder.build('CCO', 3, build_tree), build_test_tree('CCO', 3))
+		self.assertEqual(len(build_tree.builds), 1 + 2 + 4)
+		self.assertTrue(all(gen_limit == 1 for _, gen_limit in build_tree.builds))
+
+	def test_shared_products(self):
+		builds = []
+
+		def build_tree(structure, gen_limit):
+			builds.append(structure)
+			return {'id': 1, 'data': {'smiles': structure, 'generation': 0}, 'children': [
+				{'id': index + 2, 'data': {'smiles': smiles, 'generation': 1}, 'children': []}
+				for index, smiles in enumerate(['A', 'B'])
+			]}
+
+		tree = self.builder.build('CCO', 3, build_tree)
+		self.assertEqual([len(get_generation(tree, generation)) for generation in range(4)], [1, 2, 4, 8])
+		self.assertEqual(sorted(builds), ['A', 'B', 'CCO'])  # A and B are only expanded once
+		self.assertEqual([node['id'] for node in get_generation(tree, 1)], [2, 9])  # renumbered depth-first
+
+	def test_streamed_tree(self):
+		tree_cache = ProgenyTreeCache(ResultCache(MemoryCacheBackend()), self.builder)
+		build_tree = TreeBuildCounter()
+		builds = []  # builds done when each generation is sent
+		generations = []
+		for generation in cts_rest.iterMetabolizerGenerations(tree_cache.iter_tree('key', 'CCO', 3, build_tree)):
+			builds.append(len(build_tree.builds))
+			generations.append(generation)
+		self.assertEqual(builds, [1, 1, 3, 7])  # sent before the next generation is built
+		self.assertEqual([len(generation['nodes']) for generation in generations], [1, 2, 4, 8])
+		self.assertEqual([(node['id'], node['parent']) for node in generations[2]['nodes']], [(4, 2), (5, 2), (6, 3), (7, 3)])
+		self.assertEqual(tree_cache.get_tree('key', 'CCO', 3, build_tree), build_test_tree('CCO', 3))  # cached
+		cached_generations = list(cts_rest.iterMetabolizerGenerations(tree_cache.iter_tree('key', 'CCO', 3, build_tree)))
+		self.assertEqual(cached_generations, generations)
+		self.assertEqual(len(build_tree.builds), 7)
+
+	def test_population_limit(self):
+		tree = self.builder.build('CCO', 3, TreeBuildCounter(), population_limit=7)
+		self.assertEqual(count_nodes(tree), 7)
+
+	def test_likely_limit(self):
+		def build_tree(structure, gen_limit):
+			tree = build_test_tree(structure, gen_limit)
+			for index, child in enumerate(tree['children']):
+				child['data']['likelihood'] = 0.5 if index == 0 else 0.05
+			return tree
+
+		tree = self.builder.build('CCO', 2, build_tree, likely_limit=0.1)
+		self.assertEqual([len(node['children']) for node in tree['children']], [2, 0])
+
+
+
+class SingleFlightTests(SimpleTestCase):
+
+	def setUp(self):
+		self.executor = ThreadPoolExecutor(max_workers=4)
+		self.lock_dir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.executor.shutdown()
+		self.lock_dir.cleanup()
+
+	def run_concurrently(self, calls):
+		"""
+		Starts the calls together, returning their results.
+		"""
+		barrier = threading.Barrier(len(calls))
+
+		def run(call):
+			barrier.wait()
+			return call()
+
+		return [future.result() for future in [self.executor.submit(run, call) for call in calls]]
+
+	def test_coalesced_calls(self):
+		flight = SingleFlight()
+		calls = []
+
+		def func():
+			calls.append(1)
+			time.sleep(0.2)
+			return {'data': 1}
+
+		results = self.run_concurrently([lambda: flight.do('key', func)] * 3)
+		self.assertEqual(results, [{'data': 1}] * 3)
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(flight.stats(), {'in_flight': 0, 'leaders': 1, 'followers': 2, 'cross_process': False})
+
+	def test_shared_error(self):
+		flight = SingleFlight()
+
+		def func():
+			time.sleep(0.2)
+			raise ValueError("calc failed")
+
+		def call():
+			try:
+				return flight.do('key', func)
+			except ValueError as e:
+				return str(e)
+
+		self.assertEqual(self.run_concurrently([call, call]), ["calc failed"] * 2)
+		self.assertEqual(flight.do('key', lambda: 'ok'), 'ok')  # errors aren't kept
+
+	def test_cross_process_recheck(self):
+		flights = [SingleFlight(self.lock_dir.name), SingleFlight(self.lock_dir.name)]  # one per process
+		store = {}
+
+		def func():
+			time.sleep(0.2)
+			store['key'] = 'shared'
+			return 'calculated'
+
+		results = self.run_concurrently([lambda flight=flight: flight.do('key', func, lambda: store.get('key')) for flight in flights])
+		self.assertEqual(sorted(results), ['calculated', 'shared'])
+
+	def test_unrelated_keys(self):
+		flights = [SingleFlight(self.lock_dir.name), SingleFlight(self.lock_dir.name)]
+		start = time.monotonic()
+		self.run_concurrently([lambda flight=flight, key=key: flight.do(key, lambda: time.sleep(0.3)) for flight, key in zip(flights, ['A', 'B'])])
+		self.assertLess(time.monotonic() - start, 0.5)  # not serialized
+		self.assertEqual(len(os.listdir(self.lock_dir.name)), 2)
+
+	def test_prune_lock_files(self):
+		flight = SingleFlight(self.lock_dir.name, lock_max_age=60)
+		flight.do('A', lambda: 1)
+		flight.do('B', lambda: 1)
+		lock_file = os.path.join(self.lock_dir.name, os.listdir(self.lock_dir.name)[0])
+		os.utime(lock_file, (time.time() - 120, time.time() - 120))
+		flight.prune_lock_files()
+		self.assertEqual(len(os.listdir(self.lock_dir.name)), 1)
+		self.assertFalse(os.path.exists(lock_file))
+		self.assertEqual(flight.do('A', lambda: 2), 2)
+
+
+
+class AdaptiveLimiterTests(SimpleTestCase):
+
+	def test_acquire_release(self):
+		limiter = AdaptiveLimiter(initial_limit=2)
+		limiter.acquire(0)
+		limiter.acquire(0)
+		with self.assertRaises(AdmissionTimeoutError):
+			limiter.acquire(0.05)
+		limiter.release()
+		limiter.acquire(0)
+		self.assertEqual(limiter.stats()['in_flight'], 2)
+		self.assertEqual(limiter.stats()['timeouts'], 1)
+
+	def test_queued_caller(self):
+		limiter = AdaptiveLimiter(initial_limit=1)
+		limiter.acquire(0)
+		timer = threading.Timer(0.1, limiter.release)
+		timer.start()
+		limiter.acquire(5)  # gets the slot once it's released
+		timer.join()
+		self.assertEqual(limiter.stats()['in_flight'], 1)
+
+	def test_queue_full(self):
+		limiter = AdaptiveLimiter(initial_limit=1, max_queue=0)
+		limiter.acquire(0)
+		with self.assertRaises(AdmissionTimeoutError) as context:
+			limiter.acquire(5)
+		self.assertEqual(str(context.exception), "limiter queue is full")
+		self.assertEqual(limiter.stats()['rejected'], 1)
+
+	def test_increase(self):
+		limiter = AdaptiveLimiter(initial_limit=4, max_limit=5)
+		for _ in range(4):
+			limiter.adjust(0.1, True)
+		self.assertAlmostEqual(limiter.limit, 5, delta=0.1)
+		for _ in range(10):
+			limiter.adjust(0.1, True)
+		self.assertEqual(limiter.limit, 5)
+
+	def test_decrease(self):
+		limiter = AdaptiveLimiter(initial_limit=8, min_limit=2)
+		limiter.adjust(0.1, True)
+		limit = limiter.limit
+		limiter.adjust(1.0, True)  # slow
+		self.assertEqual(limiter.limit, limit * 0.75)
+		limiter.adjust(0.1, False)  # only one decrease per round trip
+		self.assertEqual(limiter.limit, limit * 0.75)
+		limiter.last_decrease = 0
+		for _ in range(10):
+			limiter.adjust(0.1, False)
+			limiter.last_decrease = 0
+		self.assertEqual(limiter.limit, 2)
+
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+	def setUp(self):
+		self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, max_reset_timeout=100)
+
+	def trip(self):
+		with self.assertLogs(level='WARNING'):
+			for _ in range(2):
+				self.breaker.before_call()
+				self.breaker.record_failure()
+
+	def test_trip(self):
+		self.breaker.record_failure()
+		self.breaker.record_success()  # failures must be consecutive
+		self.breaker.record_failure()
+		self.breaker.check()
+		self.breaker.record_success()
+		self.trip()
+		with self.assertRaises(CircuitOpenError) as context:
+			self.breaker.before_call()
+		self.assertEqual(context.exception.retry_after, 29)
+		self.assertEqual(self.breaker.stats()['trips'], 1)
+
+	def test_probe(self):
+		self.trip()
+		self.breaker.opened_at -= 30
+		self.breaker.before_call()  # the probe
+		self.assertEqual(self.breaker.state, CircuitBreaker.half_open)
+		with self.assertRaises(CircuitOpenError):
+			self.breaker.before_call()  # one probe at a time
+		with self.assertLogs(level='WARNING'):
+			self.breaker.record_success()
+		self.assertEqual(self.breaker.state, CircuitBreaker.closed)
+		self.breaker.before_call()
+
+	def test_failed_probe(self):
+		self.trip()
+		for open_timeout in [60, 100]:
+			self.breaker.opened_at -= self.breaker.open_timeout
+			self.breaker.before_call()
+			with self.assertLogs(level='WARNING'):
+				self.breaker.record_failure()
+			self.assertEqual(self.breaker.state, CircuitBreaker.open)
+			self.assertEqual(self.breaker.open_timeout, open_timeout)
+
+
+
+class CalcAdmissionTests(SimpleTestCase):
+
+	def setUp(self):
+		self.admission = CalcAdmission(
+			AdaptiveLimiter(initial_limit=2), CircuitBreaker(failure_threshold=2),
+			queue_timeout=0, ignore_errors=(ValueError,), is_failure=lambda result: result.get('status') is False
+		)
+
+	def fail(self, error):
+		raise error
+
+	def test_call(self):
+		self.assertEqual(self.admission.call(dict, status=True), {'status': True})
+		self.assertEqual(self.admission.limiter.in_flight, 0)
+		self.assertIsNotNone(self.admission.limiter.usual_latency)
+
+	def test_failures(self):
+		with self.assertRaises(ValueError):
+			self.admission.call(self.fail, ValueError("invalid input"))  # not a backend failure
+		self.assertEqual(self.admission.breaker.failures, 0)
+		self.admission.call(dict, status=False)
+		with self.assertLogs(level='WARNING'):
+			with self.assertRaises(ConnectionError):
+				self.admission.call(self.fail, ConnectionError("calc server is down"))
+		with self.assertRaises(CircuitOpenError):
+			self.admission.call(dict, status=True)
+		self.assertEqual(self.admission.limiter.in_flight, 0)
+		self.assertEqual(self.admission.stats()['circuit_state'], 2)
+
+
+
+class SpeciationGridTests(SimpleTestCase):
+
+	def test_ph_grid(self):
+		self.assertEqual(len(cts_rest.getPHGrid({'pH_grid': True})), 141)
+		self.assertEqual(cts_rest.getPHGrid({'pH_grid': {'lower': 6, 'upper': 8, 'increment': 0.5}}), [6.0, 6.5, 7.0, 7.5, 8.0])
+		self.assertEqual(cts_rest.getPHGrid({'pH_grid': {'lower': 7, 'upper': 7}}), [7.0])
+		self.assertEqual(cts_rest.getPHGrid({'pH_grid': {'lower': 0, 'upper': 0.3, 'increment': 0.1}}), [0.0, 0.1, 0.2, 0.3])
+
+	def test_invalid_ph_grid(self):
+		for ph_grid in [{'lower': 8, 'upper': 6}, {'upper': 15}, {'increment': 0}, {'increment': 0.001}, {'lower': 'acidic'}]:
+			with self.assertRaises(cts_rest.CalcRequestError) as context:
+				cts_rest.getPHGrid({'chemical': 'CC(=O)O', 'pH_grid': ph_grid})
+			self.assertEqual(context.exception.response_obj['pH_grid'], ph_grid)
+
+	def test_split_distribution(self):
+		micro_dist_data = {
+			'CC(O)=O': [[4.0, 82.0], [4.5, 59.0], [5.0, 36.2]],
+			'CC([O-])=O': [[4.0, 18.0], [4.5, 41.0], [5.0, 63.8], [5.5, 85.0]],
+		}
+		self.assertEqual(cts_rest.splitMicrospeciesDistribution(micro_dist_data, [4.0, 4.5, 5.0]), [
+			{'pH': 4.0, 'microspecies': {'CC(O)=O': 82.0, 'CC([O-])=O': 18.0}},
+			{'pH': 4.5, 'microspecies': {'CC(O)=O': 59.0, 'CC([O-])=O': 41.0}},
+			{'pH': 5.0, 'microspecies': {'CC(O)=O': 36.2, 'CC([O-])=O': 63.8}},
+		])
+		self.assertEqual(cts_rest.splitMicrospeciesDistribution({'C': [[0.30000000000000004, 1.0]]}, [0.3]), [
+			{'pH': 0.3, 'microspecies': {'C': 1.0}},
+		])
+
+	def test_grid_data(self):
+		speciation_results = {'status': True, 'data': {'pka': {'microDistData': {'C': [[6.0, 100.0], [7.0, 100.0]]}}}}
+		with mock.patch.object(cts_rest, 'getSpeciationData', return_value=speciation_results) as get_speciation_data:
+			results = cts_rest.getSpeciationGridData({'chemical': 'C', 'pH_grid': {'lower': 6, 'upper': 7, 'increment': 1}})
+		get_speciation_data.assert_called_once_with({'chemical': 'C', 'pKa_pH_lower': 6.0, 'pKa_pH_upper': 7.0, 'pKa_pH_increment': 1.0})
+		self.assertEqual(results['pH_grid'], [6.0, 7.0])
+		self.assertEqual(results['distribution'], [{'pH': 6.0, 'microspecies': {'C': 100.0}}, {'pH': 7.0, 'microspecies': {'C': 100.0}}])
+		self.assertNotIn('distribution', speciation_results)  # cached results aren't changed
+
+	def test_grid_data_without_distribution(self):
+		with mock.patch.object(cts_rest, 'getSpeciationData', return_value={'status': True, 'data': {}}):
+			with self.assertLogs(level='WARNING'):
+				results = cts_rest.getSpeciationGridData({'chemical': 'C', 'pH_grid': True})
+		self.assertIsNone(results['distribution'])
+
+
+
+class MetaInfoCalc(object):
+	def __init__(self):
+		self.meta_info = {'metaInfo': {'model': "calc", 'timestamp': "20200101000000000000"}, 'links': []}
+
+
+
+class MetaInfoJSONTests(SimpleTestCase):
+
+	def test_with_fields(self):
+		self.assertEqual(json.loads(RawJSON.encode({'a': 1}).with_fields({'b': [2]}).encoded), {'a': 1, 'b': [2]})
+		self.assertEqual(json.loads(RawJSON.encode({}).with_fields({'b': 2}).encoded), {'b': 2})
+
+	def test_timestamp(self):
+		handler = CalcHandler('calc', MetaInfoCalc)
+		for timestamp in ["20240101000000000000", "20240101000000000001"]:
+			meta_info = json.loads(dumps_envelope(handler.get_meta_info_json(timestamp)))
+			self.assertEqual(meta_info, {'metaInfo': {'model': "calc", 'timestamp': timestamp}, 'links': []})
+		self.assertEqual(handler.timestamp_keys, ('metaInfo',))
+
+
+
+@unittest.skipIf(cts_json.orjson is None, "orjson isn't installed")
+class OrjsonTests(SimpleTestCase):
+
+	def test_same_as_json(self):
+		request_post = QueryDict('chemical=CCO&calc=epi&calc=test')
+		obj = {
+			'request_post': request_post,
+			'data': collections.OrderedDict([('b', [request_post]), ('a', 1)]),
+			7.4: 'pH',
+		}
+		with mock.patch.object(cts_json, 'use_orjson', True):
+			orjson_encoded = cts_json.dumps(obj)
+		with mock.patch.object(cts_json, 'use_orjson', False):
+			json_encoded = cts_json.dumps(obj)
+		self.assertNotEqual(orjson_encoded, json_encoded)  # orjson's, without separator spaces
+		self.assertEqual(json.loads(orjson_encoded), json.loads(json_encoded))
+		self.assertEqual(json.loads(orjson_encoded)['request_post'], {'chemical': 'CCO', 'calc': 'test'})
+		self.assertEqual(list(json.loads(orjson_encoded)['data']), ['b', 'a'])
+
+
+
+class DeferredExecutor(object):
+	"""
+	Executor that runs submitted calls when run_all() is called.
+	"""
+	def __init__(self):
+		self.calls = []
+
+	def submit(self, func, *args):
+		self.calls.append((func, args))
+
+	def run_all(self):
+		calls, self.calls = self.calls, []
+		for func, args in calls:
+			func(*args)
+
+
+
+class JobManagerTests(SimpleTestCase):
+
+	def setUp(self):
+		self.executor = DeferredExecutor()
+		self.manager = JobManager(ResultCache(MemoryCacheBackend()), self.executor, ttl=60, stale_timeout=60, max_queued=2)
+		self.runs = []
+
+	def run_job(self, progress):
+		self.runs.append(1)
+		progress(1, 2)
+		progress(2, 2)
+		return b'{"data": 1}', 200
+
+	def test_run(self):
+		job = self.manager.submit('run', {'calc': 'epi', 'request': {'chemical': 'CCO'}}, self.run_job)
+		self.assertEqual((job['status'], job['calc']), ('queued', 'epi'))
+		self.executor.run_all()
+		job = self.manager.get_job(job['jobId'])
+		self.assertEqual(job['status'], 'done')
+		self.assertEqual(job['progress'], {'done': 2, 'total': 2})
+		self.assertEqual(self.manager.get_result(job['jobId']), b'{"data": 1}')
+		self.assertEqual(self.manager.stats()['completed'], 1)
+
+	def test_deduplicated(self):
+		job = self.manager.submit('run', {'calc': 'epi'}, self.run_job)
+		self.assertEqual(self.manager.submit('run', {'calc': 'epi'}, self.run_job)['jobId'], job['jobId'])  # queued
+		self.executor.run_all()
+		self.manager.submit('run', {'calc': 'epi'}, self.run_job)  # done
+		self.executor.run_all()
+		self.assertEqual(len(self.runs), 1)
+		self.assertEqual(self.manager.stats()['deduplicated'], 2)
+		self.assertNotEqual(self.manager.submit('run', {'calc': 'test'}, self.run_job)['jobId'], job['jobId'])
+
+	def test_rerun_failed(self):
+		def run_job(progress):
+			self.runs.append(1)
+			return b'{"error": "calc unavailable"}', 503
+
+		job = self.manager.submit('run', {'calc': 'epi'}, run_job)
+		with self.assertLogs(level='WARNING'):
+			self.executor.run_all()
+		self.assertEqual(self.manager.get_job(job['jobId'])['status'], 'failed')
+		self.assertIsNone(self.manager.get_result(job['jobId']))
+		self.manager.submit('run', {'calc': 'epi'}, self.run_job)
+		self.executor.run_all()
+		self.assertEqual(len(self.runs), 2)
+		self.assertEqual(self.manager.get_job(job['jobId'])['status'], 'done')
+
+	def test_rerun_expired_result(self):
+		job = self.manager.submit('run', {'calc': 'epi'}, self.run_job)
+		self.executor.run_all()
+		del self.manager.store.backend.entries[self.manager.result_key(job['jobId'])]  # evicted
+		self.manager.submit('run', {'calc': 'epi'}, self.run_job)
+		self.executor.run_all()
+		self.assertEqual(len(self.runs), 2)
+
+	def test_rerun_stale(self):
+		job = self.manager.submit('run', {'calc': 'epi'}, self.run_job)
+		self.executor.calls = []  # its process exited
+		with mock.patch('time.time', return_value=job['updated'] + 120):
+			self.assertEqual(self.manager.submit('run', {'calc': 'epi'}, self.run_job)['status'], 'queued')
+		self.executor.run_all()
+		self.assertEqual(len(self.runs), 1)
+
+	def test_queue_full(self):
+		self.manager.submit('run', {'calc': 'epi'}, self.run_job)
+		self.manager.submit('run', {'calc': 'test'}, self.run_job)
+		with self.assertRaises(JobQueueFullError):
+			self.manager.submit('run', {'calc': 'sparc'}, self.run_job)
+		self.executor.run_all()
+		self.manager.submit('run', {'calc': 'sparc'}, self.run_job)
+
+
+
+class PchemTableExecutorTests(SimpleTestCase):
+
+	def test_executor_per_calc(self):
+		with mock.patch.dict(cts_rest.calc_concurrency_limits, {'sparc': 2}), mock.patch.object(cts_rest, 'pchem_table_executors', {}):
+			sparc_executor = cts_rest.getPchemTableExecutor('sparc')
+			self.assertIs(cts_rest.getPchemTableExecutor('sparc'), sparc_executor)
+			self.assertIsNot(cts_rest.getPchemTableExecutor('chemaxon'), sparc_executor)
+			self.assertEqual(sparc_executor._max_workers, min(2, cts_rest.pchem_table_workers))
+			self.assertIs(cts_rest.getPchemTableExecutor('test'), cts_rest.getPchemTableExecutor('testws'))  # alias
+			for executor in cts_rest.pchem_table_executors.values():
+				executor.shutdown()
+
+
+
+class PchemRequestEchoTests(SimpleTestCase):
+
+	def setUp(self):
+		self.calc_requests = []
+		patches = [
+			mock.patch.object(cts_rest, 'pchem_cache', ResultCache(MemoryCacheBackend())),
+			mock.patch.object(cts_rest.CTS_REST, 'requestPchemData', lambda rest_obj, calc, request_dict: self.request_pchem_data(request_dict)),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def request_pchem_data(self, request_dict):
+		"""
+		Calculator response that echoes the request, like OPERA's from the DB.
+		"""
+		self.calc_requests.append(request_dict)
+		time.sleep(0.1)
+		data = dict(request_dict, data=1.23)
+		return {'status': True, 'request_post': dict(request_dict), 'data': data, 'orig_smiles': request_dict['orig_smiles'], 'valid': True}
+
+	def get_pchem_data(self, orig_smiles, workflow):
+		request_dict = {'chemical': 'CCO', 'orig_smiles': orig_smiles, 'calc': 'opera', 'prop': 'water_sol', 'workflow': workflow}
+		return cts_rest.CTS_REST().getPchemData('opera', request_dict), request_dict
+
+	def assert_own_echo(self, pchem_data, request_dict):
+		self.assertEqual(pchem_data['request_post'], request_dict)
+		self.assertEqual(pchem_data['orig_smiles'], request_dict['orig_smiles'])
+		self.assertEqual(pchem_data['data'], dict(request_dict, data=1.23))
+		self.assertNotIn('requestEcho', pchem_data)
+
+	def test_cache_hit(self):
+		first, first_request = self.get_pchem_data('OCC', 'pchem')
+		second, second_request = self.get_pchem_data('C(O)C', 'gentrans')
+		self.assertEqual(len(self.calc_requests), 1)
+		self.assert_own_echo(first, first_request)
+		self.assert_own_echo(second, second_request)
+
+	def test_single_flight_follower(self):
+		with ThreadPoolExecutor(max_workers=2) as executor:
+			futures = [executor.submit(self.get_pchem_data, orig_smiles, workflow) for orig_smiles, workflow in [('OCC', 'pchem'), ('C(O)C', 'gentrans')]]
+			results = [future.result() for future in futures]
+		self.assertEqual(len(self.calc_requests), 1)
+		for pchem_data, request_dict in results:
+			self.assert_own_echo(pchem_data, request_dict)
+
+	def test_missing_field(self):
+		self.get_pchem_data('OCC', 'pchem')
+		request_dict = {'chemical': 'CCO', 'orig_smiles': 'CCO', 'calc': 'opera', 'prop': 'water_sol'}
+		pchem_data = cts_rest.CTS_REST().getPchemData('opera', request_dict)
+		self.assertNotIn('workflow', pchem_data['data'])
+		self.assertEqual(list(pchem_data), ['status', 'request_post', 'data', 'orig_smiles', 'valid'])  # same order
+
+	def test_calc_alias(self):
+		for calc in ('test', 'testws'):
+			request_dict = {'chemical': 'CCO', 'orig_smiles': 'CCO', 'calc': calc, 'prop': 'water_sol'}
+			pchem_data = cts_rest.CTS_REST().getPchemData(calc, request_dict)
+			self.assertEqual(pchem_data['request_post']['calc'], calc)
+		self.assertEqual(len(self.calc_requests), 1)  # same cache entry
+		with mock.patch.object(cts_rest, 'calc_admission', {}), mock.patch.object(cts_rest, 'calc_admission_enabled', True):
+			self.assertEqual(cts_rest.requestCalculator('test', lambda: 'ok'), 'ok')
+			self.assertEqual(list(cts_rest.calc_admission), ['testws'])  # one limiter
+
+
+
+class BenchmarkCompareTests(SimpleTestCase):
+
+	def setUp(self):
+		self.baseline = {
+			'fast': {'requests': 200, 'errors': 0, 'throughput': 2000.0, 'p50_ms': 0.3, 'p99_ms': 15.0, 'peak_kb': 90.0},
+			'slow': {'requests': 200, 'errors': 0, 'throughput': 300.0, 'p50_ms': 25.0, 'p99_ms': 45.0, 'peak_kb': 150.0},
+			'broken': {'requests': 200, 'errors': 200, 'throughput': 1000.0, 'p50_ms': 0.5, 'p99_ms': 20.0, 'peak_kb': 90.0},
+		}
+
+	def test_noise(self):
+		results = {
+			'fast': dict(self.baseline['fast'], p50_ms=2.5, p99_ms=40.0),  # under the noise floor, p99 isn't gated
+			'slow': dict(self.baseline['slow'], p50_ms=28.0, p99_ms=120.0),
+		}
+		self.assertEqual(benchmarks_run.compare(results, self.baseline, 0.25), {})
+
+	def test_regressions(self):
+		results = {
+			'fast': dict(self.baseline['fast'], peak_kb=200.0),
+			'slow': dict(self.baseline['slow'], p50_ms=40.0, throughput=200.0),
+			'broken': dict(self.baseline['broken'], errors=0, p50_ms=25.0, throughput=300.0),  # fixed, not slower
+		}
+		regressions = benchmarks_run.compare(results, self.baseline, 0.25)
+		self.assertEqual(sorted(regressions), ['fast', 'slow'])
+		self.assertEqual(len(regressions['slow']), 2)
+
+		results = {'slow': dict(self.baseline['slow'], errors=3)}
+		self.assertEqual(benchmarks_run.compare(results, self.baseline, 0.25), {'slow': ["errors 3 > 0"]})
+
+	def test_run_repeated(self):
+		runs = iter([
+			{'requests': 200, 'errors': 0, 'throughput': 300.0, 'p50_ms': 25.0, 'p99_ms': 45.0},
+			{'requests': 200, 'errors': 0, 'throughput': 100.0, 'p50_ms': 80.0, 'p99_ms': 300.0},  # e.g., a GC pause
+			{'requests': 200, 'errors': 0, 'throughput': 320.0, 'p50_ms': 24.0, 'p99_ms': 40.0},
+		])
+		with mock.patch.object(benchmarks_run, 'run_scenario', lambda *args: next(runs)):
+			result = benchmarks_run.run_repeated(None, 200, 8, False, 3)
+		self.assertEqual(result, {'requests': 200, 'errors': 0, 'throughput': 300.0, 'p50_ms': 25.0, 'p99_ms': 45.0})
+
+
+
+class TraceContextTests(SimpleTestCase):
+
+	def setUp(self):
+		self.factory = RequestFactory()
+
+	def get_trace_id(self, **headers):
+		return cts_context.get_trace_id(self.factory.get('/cts/rest/molecule', **headers))
+
+	def test_request_id(self):
+		self.assertEqual(self.get_trace_id(HTTP_X_REQUEST_ID='req-1.a_B'), 'req-1.a_B')
+		for request_id in ['req-1\n', 'req 1', 'req-1\r\nSet-Cookie: a=b', '"req"', 'x' * 65, '']:
+			trace_id = self.get_trace_id(HTTP_X_REQUEST_ID=request_id)
+			self.assertNotEqual(trace_id, request_id)
+			self.assertRegex(trace_id, r'\A[0-9a-f]{32}\Z')  # a new one
+
+	def test_traceparent(self):
+		trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+		self.assertEqual(self.get_trace_id(HTTP_TRACEPARENT='00-{}-00f067aa0ba902b7-01'.format(trace_id)), trace_id)
+		self.assertEqual(self.get_trace_id(HTTP_X_REQUEST_ID='req-1', HTTP_TRACEPARENT='00-{}-00f067aa0ba902b7-01'.format(trace_id)), 'req-1')
+		for traceparent in [
+			'00-{}-00f067aa0ba902b7-01'.format(trace_id.upper()),
+			'00-{}-00f067aa0ba902b7-01'.format('0' * 32),
+			'00-{}-{}-01'.format(trace_id, '0' * 16),
+			'ff-{}-00f067aa0ba902b7-01'.format(trace_id),
+			'00-{}-00f067aa0ba902b7-01'.format(trace_id[:-1] + 'g'),
+			'00-{}\n-00f067aa0ba902b7-01'.format(trace_id[:-1]),
+		]:
+			self.assertNotIn(self.get_trace_id(HTTP_TRACEPARENT=traceparent), traceparent)
+
+	def test_trace_view(self):
+		def request_calc(calc):
+			with cts_metrics.time_stage('calculator', calc):
+				pass
+
+		@cts_context.trace_view
+		def view(request):
+			with cts_metrics.track_request('runCalc', 'epi'):
+				with cts_metrics.time_stage('filter'):
+					pass
+				with ThreadPoolExecutor(max_workers=2) as executor:
+					futures = [executor.submit(cts_context.run_in_context(request_calc), calc) for calc in ['epi', 'test']]
+					for future in futures:
+						future.result()
+			return views.HttpResponse(b'{}', content_type='application/json')
+
+		with mock.patch.object(cts_context, 'server_timing_enabled', True), mock.patch.object(cts_context, 'request_log_enabled', True):
+			with self.assertLogs('cts_app.cts_api.requests', level='INFO') as logs:
+				response = view(self.factory.get('/cts/rest/epi/run', HTTP_X_REQUEST_ID='req-1'))
+		self.assertEqual(response['X-Request-ID'], 'req-1')
+		self.assertRegex(response['Server-Timing'], r'\Afilter;dur=[0-9.]+, calculator;dur=[0-9.]+;desc="(epi,test|test,epi)", total;dur=[0-9.]+\Z')
+		request_data = logs.records[0].data
+		self.assertEqual((request_data['trace_id'], request_data['entry'], request_data['calc'], request_data['status']), ('req-1', 'runCalc', 'epi', 200))
+		self.assertEqual(sorted((span['stage'], span['calc']) for span in request_data['spans']), [('calculator', 'epi'), ('calculator', 'test'), ('filter', None)])
+		self.assertIsNone(cts_context.get_context())
+
+		response = view(self.factory.get('/cts/rest/epi/run'))
+		self.assertRegex(response['X-Request-ID'], r'\A[0-9a-f]{32}\Z')
+		self.assertFalse(response.has_header('Server-Timing'))
+
+	def test_trace_async_view(self):
+		@cts_context.trace_view
+		async def view(request):
+			return views.HttpResponse(cts_context.get_context().trace_id)
+
+		response = async_to_sync(view)(self.factory.get('/cts/rest/molecule', HTTP_X_REQUEST_ID='req-2'))
+		self.assertEqual((response['X-Request-ID'], response.content), ('req-2', b'req-2'))
+
+	def test_json_log_trace_id(self):
+		@cts_context.trace_view
+		def view(request):
+			record = logging.LogRecord('cts', logging.WARNING, __file__, 1, "calc error", None, None)
+			return views.HttpResponse(cts_context.JSONLogFormatter().format(record))
+
+		log_record = json.loads(view(self.factory.get('/cts/rest/epi/run', HTTP_X_REQUEST_ID='req-3')).content)
+		self.assertEqual((log_record['trace_id'], log_record['message'], log_record['level']), ('req-3', "calc error", 'WARNING'))
+
+
+
+class PchemCalcRecorder(object):
+	"""
+	Stands in for CTS_REST.requestPchemData, recording requests
+	and the most concurrent requests per calc.
+	"""
+	def __init__(self, delay=0.02):
+		self.delay = delay
+		self.requests = []
+		self.running = collections.Counter()
+		self.max_running = collections.Counter()
+		self.lock = threading.Lock()
+
+	def request_pchem_data(self, calc, request_dict):
+		with self.lock:
+			self.requests.append(request_dict)
+			self.running[calc] += 1
+			self.max_running[calc] = max(self.max_running[calc], self.running[calc])
+		try:
+			time.sleep(self.delay)
+			return {'status': True, 'valid': True, 'calc': calc, 'prop': request_dict['prop'], 'data': "{} {}".format(calc, request_dict['chemical'])}
+		finally:
+			with self.lock:
+				self.running[calc] -= 1
+
+	def patch(self, test_case):
+		"""
+		Starts the patches for test_case (with no cached p-chem
+		data, and chemicals used as is rather than filtered).
+		"""
+		patches = [
+			mock.patch.object(cts_rest, 'pchem_cache', ResultCache(MemoryCacheBackend())),
+			mock.patch.object(cts_rest.CTS_REST, 'requestPchemData', lambda rest_obj, calc, request_dict: self.request_pchem_data(calc, request_dict)),
+			mock.patch.object(cts_rest.CTS_REST, 'filterRequestSmiles', lambda rest_obj, request_dict: dict(request_dict, orig_smiles=request_dict['chemical'])),
+		]
+		for patch in patches:
+			patch.start()
+			test_case.addCleanup(patch.stop)
+
+
+
+class BatchRunTests(SimpleTestCase):
+
+	def setUp(self):
+		self.calcs = PchemCalcRecorder()
+		self.calcs.patch(self)
+
+	def run_batch(self, request_dict):
+		return json.loads(cts_rest.CTS_REST().runBatch(request_dict).content)
+
+	def test_validation(self):
+		valid = {'chemicals': ['CCO'], 'calcs': ['chemaxon'], 'props': ['water_sol']}
+		for key in ('chemicals', 'calcs', 'props'):
+			for value in (None, [], 'CCO'):
+				response = self.run_batch(dict(valid, **{key: value}))
+				self.assertEqual(response['error'], "'{}' must be a list with at least one item".format(key))
+		self.assertIn("Not p-chem calcs: metabolizer, nope", self.run_batch(dict(valid, calcs=['chemaxon', 'metabolizer', 'nope']))['error'])
+		with mock.patch.object(cts_rest, 'batch_max_cells', 3):
+			self.assertEqual(self.run_batch(dict(valid, chemicals=['CCO', 'CCC'], props=['water_sol', 'koc']))['error'], "Batch has 4 cells, max is 3")
+		self.assertEqual(self.calcs.requests, [])
+
+	def test_table(self):
+		request_dict = {'chemicals': ['CCO', 'CCC'], 'calcs': ['chemaxon', 'epi'], 'props': ['water_sol', 'koc'], 'ph': 7.0}
+		table = self.run_batch(request_dict)['data']
+		self.assertEqual(
+			[(cell['chemical'], cell['calc'], cell['prop']) for cell in table],
+			[(chemical, calc, prop) for chemical in request_dict['chemicals'] for calc in request_dict['calcs'] for prop in request_dict['props']]
+		)
+		self.assertEqual(table[6]['data']['data'], "epi CCC")
+		self.assertEqual({request['ph'] for request in self.calcs.requests}, {7.0})  # other inputs are passed along
+
+	def test_calc_limits(self):
+		request_dict = {'chemicals': ["C{}".format(i) for i in range(6)], 'calcs': ['chemaxon', 'sparc'], 'props': ['water_sol', 'koc']}
+		with mock.patch.dict(cts_rest.batch_calc_limits, {'chemaxon': 3, 'sparc': 1}):
+			table = self.run_batch(request_dict)['data']
+		self.assertEqual(len(table), 24)
+		self.assertEqual(len(self.calcs.requests), 24)
+		self.assertEqual(self.calcs.max_running['sparc'], 1)
+		self.assertLessEqual(self.calcs.max_running['chemaxon'], 3)
+		self.assertGreater(self.calcs.max_running['chemaxon'], 1)  # concurrent, up to its limit
+
+	def test_cell_errors(self):
+		def request_pchem_data(rest_obj, calc, request_dict):
+			if request_dict['chemical'] == 'CCC':
+				raise ConnectionError("calc server is down")
+			return {'status': True, 'data': 1.0}
+
+		with mock.patch.object(cts_rest.CTS_REST, 'requestPchemData', request_pchem_data), self.assertLogs(level='WARNING'):
+			table = self.run_batch({'chemicals': ['CCO', 'CCC'], 'calcs': ['chemaxon'], 'props': ['water_sol']})['data']
+		self.assertEqual(table[0]['data']['data'], 1.0)
+		self.assertIn('error', table[1])
+
+
+
+def read_stream(response):
+	return b''.join(response.streaming_content).decode('utf-8')
+
+
+
+class StreamingTests(SimpleTestCase):
+
+	def setUp(self):
+		self.factory = RequestFactory()
+		self.calcs = PchemCalcRecorder(delay=0)
+		self.calcs.patch(self)
+
+	def test_get_stream_format(self):
+		request = self.factory.post('/cts/rest/epi/run')
+		self.assertIsNone(views.get_stream_format(request, {}))
+		self.assertIsNone(views.get_stream_format(request, {'stream': 'xml'}))
+		self.assertEqual(views.get_stream_format(request, {'stream': 'sse'}), 'sse')
+		self.assertEqual(views.get_stream_format(request, {'stream': 'ndjson'}), 'ndjson')
+		self.assertEqual(views.get_stream_format(request, {'stream': True}), 'ndjson')
+		self.assertEqual(views.get_stream_format(request, {'stream': 'true'}), 'ndjson')
+		self.assertEqual(views.get_stream_format(self.factory.post('/', HTTP_ACCEPT='text/event-stream'), {}), 'sse')
+		self.assertEqual(views.get_stream_format(self.factory.post('/', HTTP_ACCEPT='application/x-ndjson, */*'), {}), 'ndjson')
+		self.assertEqual(views.get_stream_format(self.factory.post('/', HTTP_ACCEPT='text/event-stream'), {'stream': 'ndjson'}), 'ndjson')  # input first
+
+	def test_ndjson(self):
+		response = cts_rest.streamResponse(iter([('cell', {'a': 1}), ('done', {'cells': 1})]), 'ndjson')
+		self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+		self.assertEqual(response['Cache-Control'], 'no-cache')
+		content = read_stream(response)
+		self.assertTrue(content.endswith("\n"))
+		self.assertEqual([json.loads(line) for line in content.splitlines()], [{'a': 1, 'event': 'cell'}, {'cells': 1, 'event': 'done'}])
+
+	def test_sse(self):
+		response = cts_rest.streamResponse(iter([('cell', {'a': "x\ny"}), ('done', {'cells': 1})]), 'sse')
+		self.assertEqual(response['Content-Type'], 'text/event-stream')
+		events = read_stream(response).split("\n\n")
+		self.assertEqual(events[-1], "")
+		self.assertEqual(events[0].split("\n"), ["event: cell", 'data: {"a":"x\\ny"}'])  # one data line
+		self.assertEqual(events[1], 'event: done\ndata: {"cells":1}')
+
+	def test_batch_stream(self):
+		request_dict = {'chemicals': ['CCO', 'CCC'], 'calcs': ['chemaxon', 'epi'], 'props': ['water_sol']}
+		response = cts_rest.CTS_REST().runBatch(request_dict, 'ndjson')
+		records = [json.loads(line) for line in read_stream(response).splitlines()]
+		self.assertEqual(records[0]['event'], 'metaInfo')
+		self.assertEqual(records[-1], {'event': 'done', 'cells': 4})
+		cells = sorted(records[1:-1], key=lambda record: record['index'])
+		self.assertEqual([record['event'] for record in cells], ['cell'] * 4)
+		self.assertEqual([(record['chemical'], record['calc']) for record in cells], [('CCO', 'chemaxon'), ('CCO', 'epi'), ('CCC', 'chemaxon'), ('CCC', 'epi')])
+
+	def test_batch_stream_error(self):
+		response = cts_rest.CTS_REST().runBatch({'chemicals': []}, 'sse')
+		events = read_stream(response).split("\n\n")
+		self.assertTrue(events[1].startswith("event: error\n"))
+		self.assertEqual(events[2:], [""])
+
+
+
+class AsyncViewTests(SimpleTestCase):
+	"""
+	The async views (CTS_ASYNC_VIEWS) respond like the sync ones.
+	"""
+	def setUp(self):
+		self.factory = RequestFactory()
+		self.calcs = PchemCalcRecorder(delay=0)
+		self.calcs.patch(self)
+		chem_info = ChemInfoCache(ResultCache(MemoryCacheBackend()), ResultCache(MemoryCacheBackend()), None, MockChemInfoServer().get_cheminfo, SingleFlight())
+		for patch in [mock.patch.object(cts_rest, 'gen_jid', lambda: "20240101000000000000"), mock.patch.object(cts_rest, 'chem_info_cache', chem_info)]:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def post(self, request_dict, **headers):
+		return self.factory.post('/cts/rest/', json.dumps(request_dict), content_type='application/json', **headers)
+
+	def get_content(self, response):
+		if not response.streaming:
+			return response.content
+		if not response.is_async:
+			return b''.join(response.streaming_content)
+
+		async def read():
+			return b''.join([chunk async for chunk in response.streaming_content])
+		return async_to_sync(read)()
+
+	def assert_same_response(self, sync_view, async_view, request, *args):
+		sync_response = sync_view(request, *args)
+		async_response = async_to_sync(async_view)(request, *args)
+		self.assertEqual(async_response.status_code, sync_response.status_code)
+		self.assertEqual(async_response['Content-Type'], sync_response['Content-Type'])
+		self.assertTrue(async_response.has_header('X-Request-ID'))
+		self.assertEqual(self.get_content(async_response), self.get_content(sync_response))
+		return async_response
+
+	def test_run_calc(self):
+		request = self.post({'chemical': 'CCO', 'calc': 'chemaxon', 'prop': 'water_sol'})
+		response = self.assert_same_response(views.runCalc, views.runCalcAsync, request, 'chemaxon')
+		self.assertEqual(json.loads(response.content)['data']['data'], "chemaxon CCO")
+		with self.assertLogs(level='WARNING'):
+			self.assert_same_response(views.runCalc, views.runCalcAsync, self.post({'chemical': 'CCO', 'calc': 'nope'}), 'nope')
+
+	def test_run_calc_stream(self):
+		request = self.post({'chemical': 'CCO', 'calc': 'chemaxon', 'prop': 'water_sol', 'stream': 'ndjson'})
+		response = self.assert_same_response(views.runCalc, views.runCalcAsync, request, 'chemaxon')
+		self.assertTrue(response.is_async)  # sent record by record
+
+	def test_run_batch(self):
+		request_dict = {'chemicals': ['CCO', 'CCC'], 'calcs': ['chemaxon', 'epi'], 'props': ['water_sol']}
+		self.assert_same_response(views.runBatch, views.runBatchAsync, self.post(request_dict))
+		self.assert_same_response(views.runBatch, views.runBatchAsync, self.post({'chemicals': []}))
+
+	def test_chem_info(self):
+		self.assert_same_response(views.get_chem_info, views.get_chem_info_async, self.post({'chemical': '64-17-5'}))
+		request = self.factory.post('/cts/rest/molecule', {'chemical': 'OCC'})  # form data
+		response = self.assert_same_response(views.get_chem_info, views.get_chem_info_async, request)
+		self.assertEqual(json.loads(response.content)['request_post'], {'chemical': 'OCC'})
+
+
+
+class MockEpiCalc(object):
+	"""
+	EpiCalc returning every prop (water solubility by two methods)
+	for each request, counting requests.
+	"""
+	propMap = {
+		'water_sol': {'result_key': 'water_solubility', 'methods': {'WSKOW': "WSKOWWIN", 'WATERNT': "WATERNT"}},
+		'kow_no_ph': {'result_key': 'log_kow'},
+		'henrys_law_con': {'result_key': 'henrys_law_constant'},
+	}
+	requests = []
+
+	def data_request_handler(self, request_dict):
+		self.requests.append(dict(request_dict))
+		time.sleep(0.05)
+		return {
+			'status': True,
+			'valid': True,
+			'request_post': dict(request_dict),
+			'data': [
+				{'prop': 'water_solubility', 'method': 'WSKOW', 'data': 1.0},
+				{'prop': 'water_solubility', 'method': 'WATERNT', 'data': 2.0},
+				{'prop': 'log_kow', 'data': 3.0},
+				{'prop': 'henrys_law_constant', 'data': 4.0},
+			],
+		}
+
+
+
+class AllPropsCalcHandlerTests(SimpleTestCase):
+
+	def setUp(self):
+		MockEpiCalc.requests = []
+		registry = CalcRegistry(cts_rest.requestCalculator)
+		registry.register(cts_rest.AllPropsCalcHandler('epi', MockEpiCalc, MetaInfoCalc, cts_rest.pickEpiProp))
+		patches = [
+			mock.patch.object(cts_rest, 'calc_registry', registry),
+			mock.patch.object(cts_rest, 'pchem_cache', ResultCache(MemoryCacheBackend())),
+			mock.patch.object(cts_rest, 'calc_admission_enabled', False),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def get_pchem_data(self, prop, chemical='CCO'):
+		return cts_rest.CTS_REST().getPchemData('epi', {'chemical': chemical, 'orig_smiles': chemical, 'calc': 'epi', 'prop': prop})
+
+	def test_one_request_per_chemical(self):
+		kow = self.get_pchem_data('kow_no_ph')
+		water_sol = self.get_pchem_data('water_sol')
+		henrys_law = self.get_pchem_data('henrys_law_con')
+		self.assertEqual(len(MockEpiCalc.requests), 1)
+		self.assertEqual((kow['prop'], kow['data']), ('kow_no_ph', 3.0))
+		self.assertEqual(henrys_law['data'], 4.0)
+		self.assertEqual(water_sol['prop'], 'water_sol')
+		self.assertEqual([(item['method'], item['data']) for item in water_sol['data']], [("WSKOWWIN", 1.0), ("WATERNT", 2.0)])  # table method names
+		self.assertEqual(water_sol['request_post']['prop'], 'water_sol')  # each request's own
+
+		self.get_pchem_data('kow_no_ph', 'CCC')
+		self.assertEqual(len(MockEpiCalc.requests), 2)
+
+	def test_concurrent_props(self):
+		with ThreadPoolExecutor(max_workers=3) as executor:
+			results = list(executor.map(self.get_pchem_data, ['water_sol', 'kow_no_ph', 'henrys_law_con']))
+		self.assertEqual(len(MockEpiCalc.requests), 1)
+		self.assertEqual([pchem_data['prop'] for pchem_data in results], ['water_sol', 'kow_no_ph', 'henrys_law_con'])
+		self.assertEqual(results[2]['data'], 4.0)
+
+
+
+class MetricsTests(SimpleTestCase):
+
+	def test_text_format(self):
+		registry = cts_metrics.MetricsRegistry()
+		errors = registry.counter('test_errors_total', "Test errors.", ('calc', 'prop'))
+		in_flight = registry.gauge('test_in_flight', "Test requests in flight.")
+		seconds = registry.histogram('test_seconds', "Test request time.", ('calc',), buckets=(0.1, 1.0))
+		registry.add_stats('test_cache', lambda: {'backend': 'MemoryCacheBackend', 'hits': 3, 'hit_rate': 0.75})
+		errors.inc('epi', 'water "sol"\n')
+		errors.inc('epi', 'water "sol"\n')
+		in_flight.inc()
+		in_flight.dec()
+		seconds.observe(0.05, 'epi')
+		seconds.observe(0.5, 'epi')
+		seconds.observe(5, 'epi')
+		self.assertEqual(registry.render(), "\n".join([
+			'# HELP test_errors_total Test errors.',
+			'# TYPE test_errors_total counter',
+			'test_errors_total{calc="epi",prop="water \\"sol\\"\\n"} 2',
+			'# HELP test_in_flight Test requests in flight.',
+			'# TYPE test_in_flight gauge',
+			'test_in_flight 0',
+			'# HELP test_seconds Test request time.',
+			'# TYPE test_seconds histogram',
+			'test_seconds_bucket{calc="epi",le="0.1"} 1',
+			'test_seconds_bucket{calc="epi",le="1.0"} 2',
+			'test_seconds_bucket{calc="epi",le="+Inf"} 3',
+			'test_seconds_sum{calc="epi"} 5.55',
+			'test_seconds_count{calc="epi"} 3',
+			'# TYPE test_cache_hit_rate gauge',
+			'test_cache_hit_rate 0.75',
+			'# TYPE test_cache_hits gauge',
+			'test_cache_hits 3',
+		]) + "\n")
+
+	def test_label_sets_limit(self):
+		counter = cts_metrics.Counter('test_total', "Test.", ('calc',))
+		with mock.patch.object(cts_metrics, 'max_label_sets', 2):
+			for calc in ['epi', 'test', 'opera', 'opera']:
+				counter.inc(calc)
+		self.assertEqual(counter.values, {('epi',): 1, ('test',): 1, ('other',): 2})
+
+	def test_metrics_view(self):
+		with self.assertRaises(ValueError):
+			with cts_metrics.track_request('metricsTest', 'epi', 'water_sol'):
+				raise ValueError("calc error")
+		response = views.getMetrics(RequestFactory().get('/cts/rest/metrics'))
+		self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+		lines = response.content.decode('utf-8').splitlines()
+		self.assertIn('# TYPE cts_request_seconds histogram', lines)
+		self.assertIn('cts_request_errors_total{entry="metricsTest",calc="epi",prop="water_sol"} 1', lines)
+		self.assertIn('cts_request_seconds_count{entry="metricsTest",calc="epi",prop="water_sol"} 1', lines)
+		self.assertIn('cts_requests_in_flight{entry="metricsTest",calc="epi"} 0', lines)
+
+
+
+class MockBulkChemInfoCache(object):
+	"""
+	chem_info_cache stand-in for bulk /molecule requests,
+	recording lookups and the most running at once.
+	"""
+	def __init__(self, delay=0.02):
+		self.delay = delay
+		self.requests = []
+		self.running = 0
+		self.max_running = 0
+		self.lock = threading.Lock()
+
+	def get_cheminfo(self, request_post):
+		with self.lock:
+			self.requests.append(request_post)
+			self.running += 1
+			self.max_running = max(self.max_running, self.running)
+		try:
+			time.sleep(self.delay)
+			if request_post['chemical'] == 'not a chemical':
+				raise ValueError("invalid chemical")
+			return {'status': True, 'data': {'smiles': request_post['chemical'].strip()}, 'request_post': request_post}
+		finally:
+			with self.lock:
+				self.running -= 1
+
+
+
+class MoleculeBulkTests(SimpleTestCase):
+
+	def setUp(self):
+		self.chem_info = MockBulkChemInfoCache()
+		for patch in [mock.patch.object(cts_rest, 'chem_info_cache', self.chem_info), mock.patch.object(cts_rest, 'chem_info_bulk_concurrency', 2)]:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def get_records(self, request_post):
+		response = cts_rest.streamChemicalEditorData(request_post)
+		return [json.loads(line) for line in read_stream(response).splitlines()]
+
+	def test_order_and_duplicates(self):
+		chemicals = ['CCO', 'CCC', ' CCO ', 'CCCC', 'CCC', 'CCCCC']
+		records = self.get_records({'chemicals': chemicals, 'get_structure_data': True})
+		self.assertEqual(records[-1], {'event': 'done', 'count': 6, 'unique': 4})
+		molecules = records[:-1]
+		self.assertTrue(all(molecule['event'] == 'molecule' for molecule in molecules))
+		self.assertEqual([(molecule['index'], molecule['chemical']) for molecule in molecules], list(enumerate(chemicals)))
+		self.assertEqual([molecule['data']['smiles'] for molecule in molecules], ['CCO', 'CCC', 'CCO', 'CCCC', 'CCC', 'CCCCC'])
+		self.assertNotIn('request_post', molecules[0])
+		self.assertEqual([request['chemical'] for request in self.chem_info.requests], ['CCO', 'CCC', 'CCCC', 'CCCCC'])  # first of each, in order
+		self.assertTrue(all(request['get_structure_data'] for request in self.chem_info.requests))
+		self.assertLessEqual(self.chem_info.max_running, 2)
+
+	def test_chemical_error(self):
+		with self.assertLogs(level='WARNING'):
+			records = self.get_records({'chemicals': ['CCO', 'not a chemical', 'CCC']})
+		self.assertEqual(records[1], {'event': 'molecule', 'status': False, 'error': "Cannot validate chemical", 'index': 1, 'chemical': 'not a chemical'})
+		self.assertEqual(records[2]['data'], {'smiles': 'CCC'})
+
+	def test_invalid_chemicals(self):
+		for chemicals in [None, 'CCO', []]:
+			response = cts_rest.streamChemicalEditorData({'chemicals': chemicals})
+			self.assertIn('error', json.loads(response.content))
+		with mock.patch.object(cts_rest, 'chem_info_bulk_max', 2):
+			response = cts_rest.streamChemicalEditorData({'chemicals': ['CCO', 'CCC', 'CCCC']})
+		self.assertEqual(json.loads(response.content), {'error': "Request has 3 chemicals, max is 2"})
+		self.assertEqual(self.chem_info.requests, [])
+
+
+
+class ProfilingTests(SimpleTestCase):
+
+	def setUp(self):
+		self.factory = RequestFactory()
+		profile_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(profile_dir.cleanup)
+		self.profile_dir = profile_dir.name
+		patches = [
+			mock.patch.object(cts_profiling, 'profiling_enabled', True),
+			mock.patch.object(cts_profiling, 'profile_dir', self.profile_dir),
+			mock.patch.object(cts_profiling, 'profile_max_files', 3),
+			mock.patch.object(cts_profiling, 'profile_sample_rate', 0),
+		]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+		@cts_profiling.profile_view
+		def slow_view(request):
+			time.sleep(0.02)
+			return views.HttpResponse(b'{}', content_type='application/json')
+		self.view = slow_view
+
+	def get_response(self, **headers):
+		return self.view(self.factory.get('/cts/rest/epi/run', **headers))
+
+	def test_requested_profile(self):
+		for mode in ['sample', 'cprofile']:
+			response = self.get_response(HTTP_X_CTS_PROFILE=mode)
+			profile_id = response['X-CTS-Profile-Id']
+			summary = cts_profiling.list_profiles()[0]
+			self.assertEqual((summary['id'], summary['mode'], summary['path']), (profile_id, mode, '/cts/rest/epi/run'))
+			self.assertGreaterEqual(summary['wallMs'], 20)
+			self.assertIn(profile_id + '.json', summary['files'])
+			self.assertIn(profile_id + ('.prof' if mode == 'cprofile' else '.wall.collapsed'), summary['files'])
+
+	def test_not_profiled(self):
+		response = self.get_response()
+		self.assertFalse(response.has_header('X-CTS-Profile-Id'))
+		with mock.patch.object(cts_profiling, 'profile_sample_rate', 1), mock.patch.object(cts_profiling, 'profile_slow_ms', 1000):
+			self.get_response()  # sampled, but not slow
+		with mock.patch.object(cts_profiling, 'profiling_enabled', False):
+			self.get_response(HTTP_X_CTS_PROFILE='sample')
+		self.assertEqual(os.listdir(self.profile_dir), [])
+
+	def test_slow_sampled_profile(self):
+		with mock.patch.object(cts_profiling, 'profile_sample_rate', 1), mock.patch.object(cts_profiling, 'profile_slow_ms', 10):
+			response = self.get_response()
+		self.assertFalse(response.has_header('X-CTS-Profile-Id'))  # only for requested profiles
+		self.assertEqual(len(cts_profiling.list_profiles()), 1)
+
+	def test_prune(self):
+		profile_ids = [self.get_response(HTTP_X_CTS_PROFILE='sample')['X-CTS-Profile-Id'] for _ in range(5)]
+		self.assertEqual([summary['id'] for summary in cts_profiling.list_profiles()], profile_ids[:1:-1])  # newest 3
+		self.assertEqual([summary['id'] for summary in cts_profiling.list_profiles(limit=2)], profile_ids[:2:-1])
+		self.assertFalse(any(name.startswith(profile_ids[0]) for name in os.listdir(self.profile_dir)))
+
+	def test_profiles_view(self):
+		self.get_response(HTTP_X_CTS_PROFILE='sample')
+		response = views.getProfiles(self.factory.get('/cts/rest/profiles', {'min_ms': 60000}))
+		self.assertEqual(json.loads(response.content), {'profileDir': self.profile_dir, 'profiles': []})
+		response = views.getProfiles(self.factory.get('/cts/rest/profiles', {'limit': 'all'}))
+		self.assertIn('error', json.loads(response.content))
+		with mock.patch.object(cts_profiling, 'profiling_enabled', False):
+			self.assertEqual(views.getProfiles(self.factory.get('/cts/rest/profiles')).status_code, 404)
@@ -1,7 +1,14 @@
 #  https://docs.djangoproject.com/en/1.6/intro/tutorial03/
+import os
 from django.urls import path
 from . import views
 
+# Async views for ASGI deployments (sync views are used otherwise):
+if os.environ.get('CTS_ASYNC_VIEWS') == 'True':
+	run_calc_view, run_batch_view, chem_info_view = views.runCalcAsync, views.runBatchAsync, views.get_chem_info_async
+else:
+	run_calc_view, run_batch_view, chem_info_view = views.runCalc, views.runBatch, views.get_chem_info
+
 urlpatterns = [
 	path('v2/', views.showSwaggerPageV2),
 	path('v2/swag/', views.getSwaggerJsonContentV2),
@@ -11,9 +18,18 @@ urlpatterns = [
 urlpatterns += [
 	path('', views.showSwaggerPage),
 	path('swag', views.getSwaggerJsonContent),
-	path('molecule', views.get_chem_info),
+	path('metrics', views.getMetrics),
+	path('profiles', views.getProfiles),
+	path('molecule', chem_info_view),
+	path('molecule/bulk', views.get_chem_info_bulk),
+	path('batch/run', run_batch_view),
+	path('batch/jobs', views.submitBatchJob),
+	path('pchem/run', views.runPchemTable),
+	path('jobs/<str:job_id>', views.getJob),
+	path('jobs/<str:job_id>/result', views.getJobResult),
 	path('<str:calc>/inputs', views.getCalcInputs),
-	path('<str:calc>/run', views.runCalc),
+	path('<str:calc>/run', run_calc_view),
+	path('<str:calc>/jobs', views.submitCalcJob),
 	path('<str:endpoint>', views.getCalcEndpoints),
 ]
 
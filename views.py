@@ -4,6 +4,13 @@ CTS REST URLs - Swagger UI
 """
 
 from cts_app.cts_api import cts_rest
+from cts_app.cts_api import cts_async
+from cts_app.cts_api import cts_metrics
+from cts_app.cts_api import cts_json
+from cts_app.cts_api import cts_profiling
+from cts_app.cts_api.cts_profiling import profile_view
+from cts_app.cts_api.cts_context import trace_view
+from cts_app.cts_api.cts_responses import JSONFileAsset, validate_swagger
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpRequest, HttpResponse
 from django.template.loader import render_to_string
@@ -14,20 +21,17 @@ import logging
 import os
 
 root_path = os.path.abspath(os.path.dirname(__file__))
+swagger_asset = JSONFileAsset(root_path + '/static/cts_api/swagger.json', validate_swagger)
+swagger_v2_asset = JSONFileAsset(root_path + '/static/cts_api/swagger-v2.json', validate_swagger)
 
 
 
 @csrf_exempt
 def getSwaggerJsonContent(request):
 	"""
-	Opens up swagger.json content
+	Returns swagger.json content
 	"""
-	swag = open(root_path + '/static/cts_api/swagger.json', 'r').read()
-	swag_filtered = swag.replace('\n', '').strip()
-	swag_obj = json.loads(swag_filtered)
-	response = HttpResponse()
-	response.write(json.dumps(swag_obj))
-	return response
+	return swagger_asset.response(request)
 
 
 
@@ -50,14 +54,35 @@ def showSwaggerPageV2(request):
 @csrf_exempt
 def getSwaggerJsonContentV2(request):
 	"""
-	Opens up swagger.json content
+	Returns swagger-v2.json content
 	"""
-	swag = open(root_path + '/static/cts_api/swagger-v2.json', 'r').read()
-	swag_filtered = swag.replace('\n', '').strip()
-	swag_obj = json.loads(swag_filtered)
-	response = HttpResponse()
-	response.write(json.dumps(swag_obj))
-	return response
+	return swagger_v2_asset.response(request)
+
+
+
+@csrf_exempt
+def getMetrics(request):
+	"""
+	Request metrics in Prometheus text format
+	"""
+	return HttpResponse(cts_metrics.registry.render(), content_type=cts_metrics.content_type)
+
+
+
+@csrf_exempt
+def getProfiles(request):
+	"""
+	Recent saved request profiles, newest first (with CTS_PROFILING)
+	"""
+	if not cts_profiling.profiling_enabled:
+		return HttpResponse(json.dumps({'error': "profiling is off"}), content_type='application/json', status=404)
+	try:
+		min_ms = float(request.GET.get('min_ms', 0))
+		limit = int(request.GET.get('limit', 50))
+	except ValueError:
+		return HttpResponse(json.dumps({'error': "min_ms and limit must be numbers"}), content_type='application/json')
+	profiles = cts_profiling.list_profiles(min_ms, limit)
+	return HttpResponse(cts_json.dumps({'profileDir': cts_profiling.profile_dir, 'profiles': profiles}), content_type='application/json')
 
 
 
@@ -66,27 +91,24 @@ def getCTSEndpoints(request):
 	"""
 	CTS REST calculator endpoints
 	"""
-	cts_obj = cts_rest.CTS_REST()
-	return cts_obj.getCTSREST()
+	return cts_rest.getCTSRESTResponse(request)
 
 
 
 @csrf_exempt
 def getCalcEndpoints(request, endpoint=None):
 
-	cts_obj = cts_rest.CTS_REST()
-
-	if not endpoint in cts_obj.endpoints:
+	if not endpoint in cts_rest.getSharedCTSREST().endpoints:
 		return HttpResponse(json.dumps({'error': "endpoint not recognized"}), content_type='application/json')		
 	else:
-		return cts_rest.CTS_REST().getCalcEndpoints(endpoint)
+		return cts_rest.getCalcEndpointsResponse(endpoint, request)
 
 
 
 @csrf_exempt
 def getCalcInputs(request, calc=None):
 
-	request_params = json.loads(request.body)
+	request_params = cts_json.loads(request.body)
 
 	prop, chemical = None, None
 
@@ -97,17 +119,19 @@ def getCalcInputs(request, calc=None):
 		chemical = request_params['chemical']
 
 	try:
-		return cts_rest.CTS_REST().getCalcInputs(chemical, calc, prop)
+		return cts_rest.getCalcInputsResponse(chemical, calc, prop, request)
 	except Exception as e:
 		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json')
 
 
 
 @csrf_exempt
+@trace_view
+@profile_view
 def runCalc(request, calc=None):
 	request_params = smiles_backslash_fix_for_swagger(request)
 	try:
-		return cts_rest.CTS_REST().runCalc(calc, request_params)
+		return cts_rest.getSharedCTSREST().runCalc(calc, request_params, get_stream_format(request, request_params))
 	except Exception as e:
 		logging.warning("~~~ exception occurring at cts_api views runCalc!")
 		logging.warning("exception: {}".format(e))
@@ -116,18 +140,122 @@ def runCalc(request, calc=None):
 
 
 @csrf_exempt
-def get_chem_info(request):
+@trace_view
+async def runCalcAsync(request, calc=None):
+	"""
+	Async version of runCalc for ASGI deployments.
+	"""
+	request_params = smiles_backslash_fix_for_swagger(request)
+	try:
+		return await cts_async.runCalc(calc, request_params, get_stream_format(request, request_params))
+	except Exception as e:
+		logging.warning("~~~ exception occurring at cts_api views runCalcAsync!")
+		logging.warning("exception: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error requesting data from {}".format(calc)}), content_type='application/json')
 
-	request_post = {}
-	if 'message' in request.POST:
-		# accounts for request from nodejs (e.g., cts_stress)
-		request_post = json.loads(request.POST.get('message'))
-	else:
-		request_post = request.POST
 
-	if len(request_post) < 1 and len(request.body) > 1:
-		# accounts for request being in body (e.g., postman)
-		request_post = json.loads(request.body.decode('utf-8'))
+
+@csrf_exempt
+@trace_view
+@profile_view
+def runBatch(request):
+	"""
+	Runs p-chem data for a matrix of chemicals, calcs, and props.
+	"""
+	try:
+		request_params = cts_json.loads(request.body)
+		return cts_rest.getSharedCTSREST().runBatch(request_params, get_stream_format(request, request_params))
+	except Exception as e:
+		logging.warning("exception at cts_api views runBatch: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error running batch request"}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+async def runBatchAsync(request):
+	"""
+	Async version of runBatch for ASGI deployments.
+	"""
+	try:
+		request_params = cts_json.loads(request.body)
+		return await cts_async.runBatch(request_params, get_stream_format(request, request_params))
+	except Exception as e:
+		logging.warning("exception at cts_api views runBatchAsync: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error running batch request"}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+@profile_view
+def runPchemTable(request):
+	"""
+	Runs every applicable calc for one chemical's props.
+	"""
+	try:
+		request_params = cts_json.loads(request.body)
+		return cts_rest.getSharedCTSREST().runPchemTable(request_params)
+	except Exception as e:
+		logging.warning("exception at cts_api views runPchemTable: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error running p-chem table request"}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+def submitCalcJob(request, calc=None):
+	"""
+	Submits a runCalc job, returning its ID and status at once.
+	"""
+	request_params = smiles_backslash_fix_for_swagger(request)
+	try:
+		return cts_rest.submitCalcJob(calc, request_params)
+	except Exception as e:
+		logging.warning("exception at cts_api views submitCalcJob: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error submitting job for {}".format(calc)}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+def submitBatchJob(request):
+	"""
+	Submits a runBatch job, returning its ID and status at once.
+	"""
+	try:
+		request_params = cts_json.loads(request.body)
+		return cts_rest.submitBatchJob(request_params)
+	except Exception as e:
+		logging.warning("exception at cts_api views submitBatchJob: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error submitting batch job"}), content_type='application/json')
+
+
+
+@csrf_exempt
+def getJob(request, job_id=None):
+	"""
+	Job status and progress
+	"""
+	return cts_rest.getJobResponse(job_id)
+
+
+
+@csrf_exempt
+def getJobResult(request, job_id=None):
+	"""
+	Job result, once the job's done
+	"""
+	return cts_rest.getJobResultResponse(job_id)
+
+
+
+@csrf_exempt
+@trace_view
+@profile_view
+def get_chem_info(request):
+
+	request_post = get_chem_info_request(request)
 
 	# request_params = smiles_backslash_fix_for_swagger(request_post)
 	try:
@@ -139,6 +267,40 @@ def get_chem_info(request):
 
 
 @csrf_exempt
+@trace_view
+@profile_view
+def get_chem_info_bulk(request):
+	"""
+	Chemical information for a list of chemicals, streamed
+	in input order as NDJSON (or server-sent events).
+	"""
+	try:
+		request_post = cts_json.loads(request.body)
+		return cts_rest.streamChemicalEditorData(request_post, get_stream_format(request, request_post) or 'ndjson')
+	except Exception as e:
+		logging.warning("cts rest exception: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error getting chemical information"}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+async def get_chem_info_async(request):
+	"""
+	Async version of get_chem_info for ASGI deployments.
+	"""
+	request_post = get_chem_info_request(request)
+	try:
+		return await cts_async.getChemicalEditorData(request_post)
+	except Exception as e:
+		logging.warning("cts rest exception: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error getting chemical information"}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+@profile_view
 def cts_rest_proxy(request):
 	"""
 	CTS API v2 entry point.
@@ -148,20 +310,65 @@ def cts_rest_proxy(request):
 	if request.method == "GET":
 		# handle get request (return calc info)
 		try:
-			return cts_rest.CTS_REST().getCalcInputs(request_params['chemical'], request_params['calc'], request_params['prop'])
+			return cts_rest.getCalcInputsResponse(request_params['chemical'], request_params['calc'], request_params['prop'], request)
 		except Exception as e:
 			return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json')
 
 	elif request.method == "POST":
 		# run calc model
+		calc = request_params.get('calc')
+		try:
+			return cts_rest.getSharedCTSREST().runCalc(calc, request_params)
+		except Exception as e:
+			logging.warning("exception: {}".format(e))
+			return HttpResponse(json.dumps({'error': "Error requesting data from {}".format(calc)}), content_type='application/json')
+
+
+
+@csrf_exempt
+@trace_view
+async def cts_rest_proxy_async(request):
+	"""
+	Async version of cts_rest_proxy for ASGI deployments.
+	"""
+	request_params = smiles_backslash_fix_for_swagger(request)
+
+	if request.method == "GET":
 		try:
-			return cts_rest.CTS_REST().runCalc(calc, request_params)
+			return await cts_async.getCalcInputs(request_params['chemical'], request_params['calc'], request_params['prop'], request)
+		except Exception as e:
+			return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json')
+
+	elif request.method == "POST":
+		calc = request_params.get('calc')
+		try:
+			return await cts_async.runCalc(calc, request_params)
 		except Exception as e:
 			logging.warning("exception: {}".format(e))
 			return HttpResponse(json.dumps({'error': "Error requesting data from {}".format(calc)}), content_type='application/json')
 
 
 
+def get_chem_info_request(request):
+	"""
+	Gets chemical info request inputs from a nodejs message,
+	POST form, or JSON body.
+	"""
+	request_post = {}
+	if 'message' in request.POST:
+		# accounts for request from nodejs (e.g., cts_stress)
+		request_post = json.loads(request.POST.get('message'))
+	else:
+		request_post = request.POST
+
+	if len(request_post) < 1 and len(request.body) > 1:
+		# accounts for request being in body (e.g., postman)
+		request_post = json.loads(request.body.decode('utf-8'))
+
+	return request_post
+
+
+
 def smiles_backslash_fix_for_swagger(request):
 	"""
 	Workaround for backslash encoding issue that occurs when using
@@ -169,7 +376,7 @@ def smiles_backslash_fix_for_swagger(request):
 	"""
 	try:
 		request_body = request.body
-		request_params = json.loads(request_body)
+		request_params = cts_json.loads(request_body)
 	except ValueError as ve:
 		# swagger api issue with not encoding backslash in smiles properly
 		logging.warning("trouble converting request body to json obj, checking for backslashes in smiles..")
@@ -182,4 +389,24 @@ def smiles_backslash_fix_for_swagger(request):
 		else:
 			request_params = request.POST
 
-	return request_params
\ No newline at end of file
+	return request_params
+
+
+
+def get_stream_format(request, request_params):
+	"""
+	Opt-in streaming for run requests, either with a "stream" input
+	("ndjson" or "sse") or an Accept header of application/x-ndjson
+	or text/event-stream. Returns None for a regular response.
+	"""
+	stream = request_params.get('stream')
+	if stream in ('ndjson', 'sse'):
+		return stream
+	elif stream is True or stream == 'true':
+		return 'ndjson'
+	accept = request.META.get('HTTP_ACCEPT', '')
+	if 'text/event-stream' in accept:
+		return 'sse'
+	elif 'application/x-ndjson' in accept:
+		return 'ndjson'
+	return None